@@ -1,11 +1,26 @@
 
 import os
 import json
+import asyncio
+import heapq
+import contextvars
+import mmap
+import random
+import re
+import sqlite3
+import struct
+import sys
+import threading
 import time as pytime
-from typing import Tuple, Dict, Any, Optional
+import zlib
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Tuple, Dict, Any, Optional, List
+from urllib.parse import urlencode
 
 import requests
-from flask import Flask, request, jsonify, session, render_template_string, Response
+from flask import Flask, request, jsonify, session, Response, g, has_request_context, send_file, redirect
 
 # ---- Page constants (info & update allowlist)
 PAGE_INFO_FIELDS = ",".join([
@@ -47,11 +62,123 @@ SETTINGS: Dict[str, Any] = {
     "cooldown_until": 0,
     "last_usage": {},
     "poll_intervals": {"notif": 60, "conv": 120},
-    "_last_events": [],
     "throttle": {"global_min_interval": float(os.environ.get("GLOBAL_MIN_INTERVAL", "1.0")),
                  "per_page_min_interval": float(os.environ.get("PER_PAGE_MIN_INTERVAL", "2.0"))},
-    "last_call_ts": {},
-    "_recent_posts": []}
+    "last_call_ts": {}}
+
+# ----------------------------
+# Request tracing (span tree) & slow-call profiling
+# ----------------------------
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0") or 0)  # 0..1, header X-Trace: 1 forces
+TRACE_MAX = int(os.environ.get("TRACE_MAX", "200"))
+TRACE_PROFILE_MS = int(os.environ.get("TRACE_PROFILE_MS", "0") or 0)  # keep cProfile output for requests slower than this (0 = off)
+
+SETTINGS["_traces"] = deque(maxlen=TRACE_MAX)
+# context-local (not thread-local) so concurrent ASGI requests on one event loop keep separate trees
+_TRACE_CV: "contextvars.ContextVar[Optional[dict]]" = contextvars.ContextVar("trace_state", default=None)
+
+def _trace_active() -> bool:
+    st = _TRACE_CV.get()
+    return bool(st and st["stack"])
+
+def _trace_start(name: str, **attrs):
+    t0 = pytime.perf_counter()
+    root = {"name": name, "attrs": attrs, "start_ms": 0.0, "dur_ms": None, "children": []}
+    st = {"trace": {"id": os.urandom(6).hex(), "ts": pytime.time(), "t0": t0, "root": root, "profile": None},
+          "stack": [root], "profiler": None}
+    if TRACE_PROFILE_MS > 0:
+        try:
+            import cProfile
+            prof = cProfile.Profile()
+            prof.enable()
+            st["profiler"] = prof
+        except Exception:
+            st["profiler"] = None
+    _TRACE_CV.set(st)
+
+def _trace_finish(status: Optional[int] = None) -> Optional[dict]:
+    st = _TRACE_CV.get()
+    if not st or not st["stack"]:
+        return None
+    tr = st["trace"]
+    root = tr["root"]
+    root["dur_ms"] = round((pytime.perf_counter() - tr["t0"]) * 1000.0, 3)
+    if status is not None:
+        root["attrs"]["status"] = status
+    prof = st["profiler"]
+    if prof is not None:
+        try:
+            prof.disable()
+            if root["dur_ms"] >= TRACE_PROFILE_MS:
+                import io, pstats
+                buf = io.StringIO()
+                pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(40)
+                tr["profile"] = buf.getvalue()
+        except Exception:
+            pass
+    st["stack"] = []
+    _TRACE_CV.set(None)
+    out = {"id": tr["id"], "ts": int(tr["ts"]), "name": root["name"], "status": root["attrs"].get("status"),
+           "dur_ms": root["dur_ms"], "root": root, "profile": tr["profile"]}
+    SETTINGS["_traces"].append(out)
+    return out
+
+@contextmanager
+def _trace_span(name: str, **attrs):
+    st = _TRACE_CV.get()
+    if not st or not st["stack"]:
+        yield None
+        return
+    t0 = pytime.perf_counter()
+    span = {"name": name, "attrs": attrs, "start_ms": round((t0 - st["trace"]["t0"]) * 1000.0, 3), "dur_ms": None, "children": []}
+    st["stack"][-1]["children"].append(span)
+    st["stack"].append(span)
+    try:
+        yield span
+    except Exception as e:
+        span["attrs"]["error"] = str(e)[:200]
+        raise
+    finally:
+        span["dur_ms"] = round((pytime.perf_counter() - t0) * 1000.0, 3)
+        if st["stack"] and st["stack"][-1] is span:
+            st["stack"].pop()
+
+def _traced(name: str):
+    """Decorator: record a span per call; first positional arg is kept as label, (data, status) results tag status."""
+    def deco(fn):
+        import functools
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _trace_active():
+                return fn(*args, **kwargs)
+            with _trace_span(name, arg=str(args[0])[:120] if args else "") as sp:
+                res = fn(*args, **kwargs)
+                if isinstance(res, tuple) and len(res) == 2 and isinstance(res[1], int):
+                    sp["attrs"]["status"] = res[1]
+                return res
+        return wrapper
+    return deco
+
+@app.before_request
+def _trace_before_request():
+    if (request.path or "").startswith("/api/debug/traces"):
+        return
+    forced = (request.headers.get("X-Trace") or "").strip().lower() in ("1", "true", "yes")
+    if forced or (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE):
+        _trace_start(f"{request.method} {request.path}", endpoint=request.endpoint or "")
+
+@app.after_request
+def _trace_after_request(resp):
+    tr = _trace_finish(resp.status_code)
+    if tr:
+        resp.headers["X-Trace-Id"] = tr["id"]
+    return resp
+
+@app.teardown_request
+def _trace_teardown_request(exc):
+    # after_request is skipped on some error paths; never leak a trace into the next request on this thread
+    if _trace_active():
+        _trace_finish(500 if exc else None)
 
 # ----------------------------
 # Simple PIN gate for /api/* (except webhook & pin endpoints)
@@ -94,63 +221,302 @@ def api_pin_logout():
 # ----------------------------
 # Helpers: tokens
 # ----------------------------
+_TOKENS_CACHE: Dict[str, Any] = {"mtime": None, "data": {}}
+
 def load_tokens() -> Dict[str, Any]:
-    if not os.path.exists(TOKENS_FILE):
+    # read on nearly every request: parse once per file change (callers get their own top-level dict)
+    try:
+        mtime = os.path.getmtime(TOKENS_FILE)
+    except OSError:
         return {}
-    with open(TOKENS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if _TOKENS_CACHE["mtime"] != mtime:
+        with open(TOKENS_FILE, "r", encoding="utf-8") as f:
+            _TOKENS_CACHE["data"] = json.load(f)
+        _TOKENS_CACHE["mtime"] = mtime
+    return dict(_TOKENS_CACHE["data"])
 
 def save_tokens(data: dict):
     import os as _os
     _os.makedirs(_os.path.dirname(TOKENS_FILE) or ".", exist_ok=True)
     with open(TOKENS_FILE, "w", encoding="utf-8") as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    _TOKENS_CACHE["mtime"] = None
 
 def app_cfg() -> Tuple[Optional[str], Optional[str]]:
     a = SETTINGS.get("app", {}) or {}
     return a.get("app_id"), a.get("app_secret")
 
+# ----------------------------
+# Helpers: app pool (extra Graph apps, each with its own page tokens, usage budget and cooldown)
+# ----------------------------
+DEFAULT_APP = "default"  # SETTINGS["app"] + PAGE_TOKENS/tokens.json; its usage state lives in SETTINGS itself
+_APPS: Dict[str, Dict[str, Any]] = {}
+_TOKEN_APP: Dict[str, str] = {}
+_APPS_LOCK = threading.Lock()
+
+def _load_app_pool():
+    """FB_APPS='[{"name":"b","app_id":"..","app_secret":"..","page_tokens":{"<page_id>":"<token>"},"user_token":".."}]'"""
+    try: raw = json.loads(os.environ.get("FB_APPS", "") or "[]")
+    except Exception: raw = []
+    for i, a in enumerate(raw if isinstance(raw, list) else []):
+        if not isinstance(a, dict): continue
+        name = str(a.get("name") or a.get("app_id") or f"app{i + 1}")
+        if name == DEFAULT_APP: continue
+        _APPS[name] = {"app_id": str(a.get("app_id") or ""), "app_secret": str(a.get("app_secret") or ""),
+                       "user_token": str(a.get("user_token") or ""),
+                       "page_tokens": {str(k): str(v) for k, v in (a.get("page_tokens") or {}).items() if k and v},
+                       "cooldown_until": 0, "last_usage": {}, "usage_top": 0, "discovered": False}
+        for tok in [_APPS[name]["user_token"], *_APPS[name]["page_tokens"].values()]:
+            if tok: _TOKEN_APP[tok] = name
+
+_load_app_pool()
+
+def _app_state(app_name: Optional[str]) -> Dict[str, Any]:
+    return _APPS.get(app_name, SETTINGS) if app_name else SETTINGS
+
+def _app_for_token(token: Optional[str]) -> str:
+    return _TOKEN_APP.get(token or "", DEFAULT_APP)
+
+def _app_throttle_key(app_name: Optional[str]) -> str:
+    return "global" if not app_name or app_name == DEFAULT_APP else f"app:{app_name}"
+
+def _app_headroom(app_name: str) -> int:
+    """Percent of the app's X-App-Usage budget still free (0 while it cools down)."""
+    st = _app_state(app_name)
+    if int(st.get("cooldown_until", 0) or 0) > pytime.time():
+        return 0
+    return max(0, 100 - int(st.get("usage_top", 0) or 0))
+
+def _pool_page_tokens(page_id: str) -> List[Tuple[str, str]]:
+    """(app, page token) for every pooled app that can act on the page; apps with a user token list their pages once."""
+    out = []
+    for name, a in list(_APPS.items()):
+        if a["user_token"] and not a["discovered"] and page_id not in a["page_tokens"]:
+            a["discovered"] = True
+            _app_discover_pages(name)
+        tok = a["page_tokens"].get(page_id)
+        if tok: out.append((name, tok))
+    return out
+
+def _app_discover_pages(name: str) -> Dict[str, str]:
+    """List the pages of a pooled app's user token into its page tokens (replacing older ones); returns what was read."""
+    a = _APPS[name]
+    data, st = graph_get("me/accounts", {"limit": 200}, a["user_token"])
+    found: Dict[str, str] = {}
+    if st == 200 and isinstance(data, dict):
+        found = {str(p["id"]): p["access_token"] for p in data.get("data", []) if p.get("id") and p.get("access_token")}
+    with _APPS_LOCK:
+        for pid, tok in found.items():
+            a["page_tokens"][pid] = tok
+            _TOKEN_APP[tok] = name
+    return found
+
+def _app_pool_status() -> Dict[str, Any]:
+    now = int(pytime.time())
+    names = [DEFAULT_APP, *_APPS.keys()]
+    return {n: {"headroom": _app_headroom(n), "usage_top": int(_app_state(n).get("usage_top", 0) or 0),
+                "cooldown_remaining": max(0, int(_app_state(n).get("cooldown_until", 0) or 0) - now),
+                "pages": len(_APPS[n]["page_tokens"]) if n in _APPS else None} for n in names}
+
 # ----------------------------
 # Helpers: throttle and guard
 # ----------------------------
-def _wait_throttle(key: str):
-    now = pytime.time()
-    last_ts = SETTINGS["last_call_ts"].get(key, 0.0)
-    if key.startswith("page:"):
-        gap = SETTINGS["throttle"]["per_page_min_interval"]
-    else:
-        gap = SETTINGS["throttle"]["global_min_interval"]
-    g_last = SETTINGS["last_call_ts"].get("global", 0.0)
-    g_gap = SETTINGS["throttle"]["global_min_interval"]
-    sleep_for = max(0.0, last_ts + gap - now, g_last + g_gap - now)
-    if sleep_for > 0:
-        pytime.sleep(sleep_for)
-    SETTINGS["last_call_ts"][key] = pytime.time()
-    SETTINGS["last_call_ts"]["global"] = pytime.time()
+# Outbound Graph calls wait at a per-app gate that hands out one slot per global_min_interval.
+# Waiters are grouped into priority lanes and served by stride scheduling: every lane gets slots in
+# proportion to its weight, so replies jump ahead of a publishing burst but background work still moves.
+LANES = ("interactive", "read", "publish", "background")
+LANE_WEIGHTS: Dict[str, float] = {"interactive": 8, "read": 4, "publish": 2, "background": 1}
+try:
+    LANE_WEIGHTS.update({k: float(v) for k, v in json.loads(os.environ.get("LANE_WEIGHTS", "") or "{}").items() if k in LANES and float(v) > 0})
+except Exception:
+    pass
+
+_LANE_CV: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("graph_lane", default=None)
+_GATE: Dict[str, Any] = {"pid": None}
+_GATE_START = threading.Lock()
+GATE_CHECK_SEC = 1.0  # how often a waiter checks that the dispatcher is alive
+GATE_STALL_SEC = float(os.environ.get("GATE_STALL_SEC", "30"))  # then it stops waiting for a grant and spaces the call itself
+_LANE_STATS: Dict[str, Dict[str, Any]] = {l: {"waits": deque(maxlen=512), "granted": 0} for l in LANES}
+
+@contextmanager
+def graph_lane(lane: str):
+    """Run the block's Graph calls in `lane` (one of LANES)."""
+    tok = _LANE_CV.set(lane)
+    try:
+        yield
+    finally:
+        _LANE_CV.reset(tok)
+
+def _current_lane(default: str = "read") -> str:
+    return _LANE_CV.get() or default
+
+# endpoints an agent is waiting on in the inbox (the sync and async variants share endpoint names)
+INTERACTIVE_ENDPOINTS = {"api_list_conversations", "api_get_conversation", "api_send_message", "api_unified_inbox"}
+
+@app.before_request
+def _lane_before_request():
+    _LANE_CV.set("interactive" if request.endpoint in INTERACTIVE_ENDPOINTS else None)
+
+@app.teardown_request
+def _lane_teardown_request(exc):
+    _LANE_CV.set(None)
+
+def _gate() -> Dict[str, Any]:
+    if _GATE["pid"] != os.getpid():  # fresh state (and dispatcher) in each forked worker
+        _GATE.update(pid=os.getpid(), cond=threading.Condition(), waiters={}, passes={}, thread=None)
+    t = _GATE["thread"]
+    if t is None or not t.is_alive():  # restarted on the same state, so queued waiters are still served
+        with _GATE_START:
+            if _GATE["thread"] is t:
+                _GATE["thread"] = threading.Thread(target=_gate_loop, args=(_GATE["cond"],), name="graph-gate", daemon=True)
+                _GATE["thread"].start()
+    return _GATE
+
+def _gate_enqueue(w: Dict[str, Any]):
+    gt = _gate()
+    with gt["cond"]:
+        lanes = gt["waiters"].setdefault(w["scope"], {})
+        passes = gt["passes"].setdefault(w["scope"], {})
+        q = lanes.setdefault(w["lane"], deque())
+        if not q:  # a lane waking up from idle gets no banked credit
+            active = [passes.get(l, 0.0) for l, dq in lanes.items() if dq]
+            passes[w["lane"]] = max(passes.get(w["lane"], 0.0), min(active) if active else 0.0)
+        q.append(w)
+        gt["cond"].notify()
+
+def _gate_remove(w: Dict[str, Any]):
+    gt = _gate()
+    with gt["cond"]:
+        q = gt["waiters"].get(w["scope"], {}).get(w["lane"])
+        if q and w in q: q.remove(w)
+
+def _gate_pick(scope: str, now: float) -> Tuple[Optional[Dict[str, Any]], float]:
+    """Next waiter for `scope` (lowest pass among lanes whose head-most eligible waiter may go now), or when to look again."""
+    thr, ts = SETTINGS["throttle"], SETTINGS["last_call_ts"]
+    scope_ready = ts.get(scope, 0.0) + thr["global_min_interval"]
+    if now < scope_ready:
+        return None, scope_ready
+    passes = _GATE["passes"][scope]
+    best, wake = None, float("inf")
+    for lane, q in _GATE["waiters"][scope].items():
+        for w in q:
+            ready = now if w["key"] == scope else ts.get(w["key"], 0.0) + thr["per_page_min_interval"]
+            if ready <= now:
+                if best is None or (passes[lane], -LANE_WEIGHTS.get(lane, 1.0)) < (passes[best["lane"]], -LANE_WEIGHTS.get(best["lane"], 1.0)):
+                    best = w
+                break
+            wake = min(wake, ready)
+    return best, wake
+
+def _gate_pass(now: float) -> float:
+    """Grant every waiter that may go at `now`; returns when to look again."""
+    wake = float("inf")
+    for scope in list(_GATE["waiters"]):
+        while True:
+            w, at = _gate_pick(scope, now)
+            if w is None:
+                wake = min(wake, at)
+                break
+            _GATE["waiters"][scope][w["lane"]].remove(w)
+            _GATE["passes"][scope][w["lane"]] += 1.0 / LANE_WEIGHTS.get(w["lane"], 1.0)
+            SETTINGS["last_call_ts"][scope] = SETTINGS["last_call_ts"][w["key"]] = now
+            st = _LANE_STATS[w["lane"]]
+            st["waits"].append(now - w["ts"]); st["granted"] += 1
+            try:
+                w["grant"]()
+            except Exception:  # e.g. the event loop of an async waiter is gone; nobody is left to wake
+                pass
+    return wake
+
+def _gate_loop(cond: threading.Condition):
+    with cond:
+        while True:
+            try:
+                wake = _gate_pass(pytime.time())
+            except Exception:
+                app.logger.exception("graph gate: dispatch pass failed")
+                wake = pytime.time() + 0.05  # state is only touched under the lock: try again shortly
+            cond.wait(None if wake == float("inf") else max(0.001, wake - pytime.time()))
+
+def _gate_stalled(w: Dict[str, Any]) -> Optional[float]:
+    """
+    Called by a waiter every GATE_CHECK_SEC: restarts a dead dispatcher, and after GATE_STALL_SEC takes the waiter
+    out of the queue and returns how long to sleep so the call still keeps the throttle intervals (None: keep waiting).
+    """
+    gt = _gate()
+    if pytime.time() - w["ts"] < GATE_STALL_SEC:
+        return None
+    with gt["cond"]:
+        q = gt["waiters"].get(w["scope"], {}).get(w["lane"])
+        if not q or w not in q:
+            return None  # granted meanwhile
+        q.remove(w)
+        thr, ts = SETTINGS["throttle"], SETTINGS["last_call_ts"]
+        now = pytime.time()
+        ready = max(now, ts.get(w["scope"], 0.0) + thr["global_min_interval"], ts.get(w["key"], 0.0) + thr["per_page_min_interval"])
+        ts[w["scope"]] = ts[w["key"]] = ready  # book the slot so the dispatcher spaces the next call after it
+    return ready - now
+
+def _wait_throttle(key: str, scope: str = "global", lane: Optional[str] = None):
+    ev = threading.Event()
+    w = {"key": key, "scope": scope, "lane": lane or _current_lane(), "ts": pytime.time(), "grant": ev.set}
+    with _trace_span("throttle", key=key, lane=w["lane"]) as sp:
+        _gate_enqueue(w)
+        while not ev.wait(GATE_CHECK_SEC):
+            delay = _gate_stalled(w)
+            if delay is not None:
+                pytime.sleep(delay)
+                break
+        if sp is not None: sp["attrs"]["sleep_ms"] = round((pytime.time() - w["ts"]) * 1000.0, 1)
+
+async def _await_throttle(key: str, scope: str = "global", lane: Optional[str] = None):
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    w = {"key": key, "scope": scope, "lane": lane or _current_lane(), "ts": pytime.time(),
+         "grant": lambda: loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))}
+    with _trace_span("throttle", key=key, lane=w["lane"]) as sp:
+        _gate_enqueue(w)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), GATE_CHECK_SEC)
+                    break
+                except asyncio.TimeoutError:
+                    delay = _gate_stalled(w)
+                    if delay is not None:
+                        await asyncio.sleep(delay)
+                        break
+        except asyncio.CancelledError:
+            _gate_remove(w)
+            raise
+        if sp is not None: sp["attrs"]["sleep_ms"] = round((pytime.time() - w["ts"]) * 1000.0, 1)
+
+def _lane_stats() -> Dict[str, Any]:
+    gt = _gate()
+    with gt["cond"]:
+        queued = {l: sum(len(lanes.get(l) or ()) for lanes in gt["waiters"].values()) for l in LANES}
+    out = {}
+    for l in LANES:
+        waits = sorted(_LANE_STATS[l]["waits"])
+        pct = lambda p: round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000.0, 1) if waits else 0.0
+        out[l] = {"weight": LANE_WEIGHTS[l], "queued": queued[l], "granted": _LANE_STATS[l]["granted"],
+                  "wait_ms_p50": pct(0.5), "wait_ms_p95": pct(0.95), "wait_ms_max": pct(1.0)}
+    return out
 
 def _hash_content(s: str) -> str:
     import hashlib
     return hashlib.sha256((s or "").strip().encode("utf-8")).hexdigest()
 
-def _recent_content_guard(kind: str, key: str, content: str, within_sec: int = 3600) -> bool:
-    now = int(pytime.time())
-    h = _hash_content(content)
-    SETTINGS["_recent_posts"] = [x for x in SETTINGS["_recent_posts"] if now - x["ts"] <= within_sec]
-    for x in SETTINGS["_recent_posts"]:
-        if x["type"] == kind and x["key"] == key and x["content_hash"] == h:
-            return True
-    SETTINGS["_recent_posts"].append({"ts": now, "type": kind, "key": key, "content_hash": h})
-    return False
-
 # ----------------------------
 # Helpers: Graph API + Rate-limit
 # ----------------------------
-def _update_usage_and_cooldown(r: requests.Response):
+def _update_usage_and_cooldown(r: requests.Response, app_name: Optional[str] = None):
+    st = _app_state(app_name)
     try:
         hdr = r.headers or {}
         usage = hdr.get("x-app-usage") or hdr.get("X-App-Usage") or ""
         pusage = hdr.get("x-page-usage") or hdr.get("X-Page-Usage") or ""
-        SETTINGS["last_usage"] = {"app": usage, "page": pusage}
+        st["last_usage"] = {"app": usage, "page": pusage}
         for key in ["x-app-usage", "X-App-Usage", "x-page-usage", "X-Page-Usage"]:
             if key in hdr:
                 try:
@@ -159,107 +525,342 @@ def _update_usage_and_cooldown(r: requests.Response):
                         u = json.loads(u)
                     top = max(int(u.get("call_count", 0)), int(u.get("total_time", 0)), int(u.get("total_cputime", 0)))
                     now = int(pytime.time())
-                    if top >= 90: SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), now + 300)
-                    elif top >= 80: SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), now + 120)
+                    if key.lower() == "x-app-usage": st["usage_top"], st["usage_ts"] = top, now
+                    if top >= 90: st["cooldown_until"] = max(st.get("cooldown_until", 0), now + 300)
+                    elif top >= 80: st["cooldown_until"] = max(st.get("cooldown_until", 0), now + 120)
                 except Exception:
                     pass
     except Exception:
         pass
 
-def _respect_cooldown() -> int:
+def _respect_cooldown(app_name: Optional[str] = None) -> int:
     now = int(pytime.time())
-    cu = int(SETTINGS.get("cooldown_until", 0) or 0)
+    cu = int(_app_state(app_name).get("cooldown_until", 0) or 0)
     if now < cu:
         return cu - now
     return 0
 
-def _handle_429_and_maybe_retry(r: requests.Response, attempt: int):
+def _note_429(r, app_name: Optional[str] = None) -> int:
     try:
         ra = int(r.headers.get("Retry-After", "0") or "0")
     except Exception:
         ra = 300
-    SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), int(pytime.time()) + max(ra, 120))
-    if attempt == 0 and ra <= 5:
-        pytime.sleep(ra or 1)
-        return None, -1
-    return {"error": "RATE_LIMIT", "retry_after": ra}, 429
+    st = _app_state(app_name)
+    st["cooldown_until"] = max(st.get("cooldown_until", 0), int(pytime.time()) + max(ra, 120))
+    return ra
 
-def graph_get(path: str, params: Dict[str, Any], token: Optional[str], ttl: int = 0, ctx_key: Optional[str] = None):
-    rem = _respect_cooldown()
-    if rem > 0:
-        return {"error": "RATE_LIMIT", "retry_after": rem}, 429
-    url = f"{GRAPH_BASE}/{path}"
-    headers = {"Authorization": f"Bearer {token}"} if token else {}
-    attempts = 0
-    while True:
-        try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.get(url, params=params, headers=headers, timeout=60)
-            _update_usage_and_cooldown(r)
-            if r.status_code == 429:
-                data, st = _handle_429_and_maybe_retry(r, attempts)
-                if st == -1: attempts += 1; continue
-                return data, st
-            if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
-            return r.json(), 200
-        except requests.RequestException as e:
-            return {"error": str(e)}, 500
+# ----------------------------
+# Helpers: retry policy, idempotency guard and per-endpoint circuit breaker
+# ----------------------------
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "8"))
+CB_FAILURE_THRESHOLD = int(os.environ.get("CB_FAILURE_THRESHOLD", "5"))
+CB_OPEN_SEC = float(os.environ.get("CB_OPEN_SEC", "30"))
+
+# Graph error codes: throttling (app/user/page/BUC) and "try again later" failures
+GRAPH_THROTTLE_CODES = {4, 17, 32, 613} | set(range(80001, 80015))
+GRAPH_TRANSIENT_CODES = {1, 2, 341}
+
+_BREAKERS: Dict[str, Dict[str, float]] = {}
+_BREAKER_LOCK = threading.Lock()
+
+def _graph_error_class(status: int, data: Any) -> str:
+    """'ok' | 'rate_limit' | 'transient' | 'permanent' for a (data, status) pair from Graph or from our own helpers."""
+    if status < 400:
+        return "ok"
+    if status == 429:
+        return "rate_limit"
+    err = data.get("error") if isinstance(data, dict) else None
+    if isinstance(err, dict):
+        if err.get("is_transient"):
+            return "transient"
+        try: code = int(err.get("code") or 0)
+        except (TypeError, ValueError): code = 0
+        if code in GRAPH_THROTTLE_CODES:
+            return "rate_limit"
+        if code in GRAPH_TRANSIENT_CODES:
+            return "transient"
+    if status >= 500:
+        return "transient"
+    return "permanent"
+
+def _is_retryable(data: Any, status: int) -> bool:
+    return _graph_error_class(status, data) in ("rate_limit", "transient") and not is_outcome_unknown(data)
+
+def _outcome_unknown(data: Any) -> Dict[str, Any]:
+    """Tag a transient failure of a non-idempotent write that reached Graph: it may have been applied, so never resend it."""
+    out = dict(data) if isinstance(data, dict) else {"error": data}
+    out["outcome_unknown"] = True
+    return out
+
+def is_outcome_unknown(data: Any) -> bool:
+    return isinstance(data, dict) and bool(data.get("outcome_unknown"))
+
+def _retry_delay(attempt: int, app_name: Optional[str] = None) -> Optional[float]:
+    """Jittered exponential backoff; waits out a short cooldown, gives up (None) on a long one."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)) * random.uniform(0.5, 1.0)
+    rem = _respect_cooldown(app_name)
+    if rem > RETRY_MAX_DELAY:
+        return None
+    return max(delay, float(rem))
 
-def graph_post(path: str, data: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None):
-    rem = _respect_cooldown()
+def _endpoint_key(method: str, path: str) -> str:
+    segs = [x for x in (path or "").split("/") if x]
+    last = segs[-1] if segs else ""
+    kind = last if len(segs) > 1 and not last.replace("_", "").isdigit() else "node"
+    return f"{method} {kind}"
+
+def _breaker_wait(key: str) -> float:
+    with _BREAKER_LOCK:
+        b = _BREAKERS.get(key)
+        return max(0.0, b["open_until"] - pytime.time()) if b else 0.0
+
+def _breaker_record(key: str, failed: bool):
+    with _BREAKER_LOCK:
+        b = _BREAKERS.setdefault(key, {"failures": 0, "open_until": 0.0})
+        if failed:
+            b["failures"] += 1
+            if b["failures"] >= CB_FAILURE_THRESHOLD:
+                # (re)open; after CB_OPEN_SEC calls flow again and one more failure re-opens at once
+                b["open_until"] = pytime.time() + CB_OPEN_SEC
+        else:
+            b["failures"], b["open_until"] = 0, 0.0
+
+def _circuit_open(key: str, wait: float):
+    return {"error": "CIRCUIT_OPEN", "endpoint": key, "retry_after": int(wait) + 1}, 503
+
+def _request_not_sent(e: Exception) -> bool:
+    """True when the request provably never reached Graph, so even a non-idempotent POST may be resent."""
+    if httpx is not None and isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    msg = str(e)
+    return isinstance(e, requests.ConnectionError) and ("NewConnectionError" in msg or "Failed to resolve" in msg)
+
+def _rewind_files(files: Optional[Dict[str, Any]]):
+    for v in (files or {}).values():
+        fh = v[1] if isinstance(v, tuple) and len(v) > 1 else v
+        if hasattr(fh, "seek"):
+            try: fh.seek(0)
+            except Exception: pass
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+_HTTP: Dict[str, Any] = {"pid": None, "session": None}
+
+def _http() -> requests.Session:
+    """Keep-alive session for Graph calls, one per process (pooled sockets must not be shared across a fork)."""
+    if _HTTP["session"] is None or _HTTP["pid"] != os.getpid():
+        sess = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        _HTTP.update(pid=os.getpid(), session=sess)
+    return _HTTP["session"]
+
+def _graph_request(method: str, path: str, token: Optional[str], ctx_key: Optional[str], timeout: float,
+                   idempotent: bool = False, idempotency_key: Optional[str] = None, **kw):
+    """
+    Shared sync Graph call. GETs and callers passing idempotent=True are retried on transient errors;
+    other POSTs only when the request never left. idempotency_key replays a stored success instead of resending.
+    """
+    app_name = _app_for_token(token)
+    rem = _respect_cooldown(app_name)
     if rem > 0:
+        if method != "GET" and _can_defer_write():
+            return _defer_write(path, token, ctx_key, kw.get("data"), kw.get("files"), app_name)
         return {"error": "RATE_LIMIT", "retry_after": rem}, 429
+    if idempotency_key:
+        done = _idem_get(idempotency_key)
+        if done is not None:
+            return done, 200
+    ep = _endpoint_key(method, path)
     url = f"{GRAPH_BASE}/{path}"
     headers = {"Authorization": f"Bearer {token}"} if token else {}
-    attempts = 0
+    safe = method == "GET" or idempotent
+    attempt = 0
     while True:
+        wait = _breaker_wait(ep)
+        if wait > 0:
+            return _circuit_open(ep, wait)
+        sent = True
         try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.post(url, data=data, headers=headers, timeout=120)
-            _update_usage_and_cooldown(r)
+            scope = _app_throttle_key(app_name)
+            _wait_throttle(ctx_key or scope, scope, _current_lane("read" if method == "GET" else "publish"))
+            _rewind_files(kw.get("files"))
+            r = _http().request(method, url, headers=headers, timeout=timeout, **kw)
+            _update_usage_and_cooldown(r, app_name)
             if r.status_code == 429:
-                data2, st = _handle_429_and_maybe_retry(r, attempts)
-                if st == -1: attempts += 1; continue
-                return data2, st
-            if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
-            return r.json(), 200
+                ra = _note_429(r, app_name)
+                if attempt == 0 and ra <= 5:
+                    pytime.sleep(ra or 1)
+                    attempt += 1
+                    continue
+                return {"error": "RATE_LIMIT", "retry_after": ra}, 429
+            try: data = r.json()
+            except ValueError: data = {"error": r.text}
+            status = r.status_code if r.status_code >= 400 else 200
         except requests.RequestException as e:
-            return {"error": str(e)}, 500
+            data, status = {"error": str(e)}, 500
+            sent = not _request_not_sent(e)
+        cls = _graph_error_class(status, data)
+        _breaker_record(ep, cls == "transient")
+        if cls == "ok":
+            if idempotency_key: _idem_put(idempotency_key, data)
+            return data, 200
+        if cls != "permanent" and attempt + 1 < RETRY_MAX_ATTEMPTS and (safe or not sent):
+            delay = _retry_delay(attempt, app_name)
+            if delay is not None:
+                with _trace_span("retry.backoff", attempt=attempt + 1, delay_ms=round(delay * 1000.0, 1), cls=cls):
+                    pytime.sleep(delay)
+                attempt += 1
+                continue
+        if _is_token_error(data):
+            token_mark_invalid(token, data)
+        if cls != "permanent" and not safe and sent:
+            data = _outcome_unknown(data)
+        return data, status
+
+@_traced("graph.get")
+def graph_get(path: str, params: Dict[str, Any], token: Optional[str], ttl: int = 0, ctx_key: Optional[str] = None):
+    return _graph_request("GET", path, token, ctx_key, 60, params=params)
+
+@_traced("graph.post")
+def graph_post(path: str, data: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None,
+               idempotent: bool = False, idempotency_key: Optional[str] = None):
+    return _graph_request("POST", path, token, ctx_key, 120, idempotent=idempotent, idempotency_key=idempotency_key, data=data)
+
+@_traced("graph.post_multipart")
+def graph_post_multipart(path: str, files: Dict[str, Any], form: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None,
+                         idempotent: bool = False, idempotency_key: Optional[str] = None):
+    return _graph_request("POST", path, token, ctx_key, 300, idempotent=idempotent, idempotency_key=idempotency_key, files=files, data=form)
+
 
-def graph_post_multipart(path: str, files: Dict[str, Any], form: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None):
-    rem = _respect_cooldown()
+# ----------------------------
+# Helpers: async Graph API (ASGI mode)
+# ----------------------------
+try:
+    import httpx
+except ImportError:  # async helpers fall back to the sync ones in a thread
+    httpx = None
+
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "200"))
+_ASYNC_CLIENT: Dict[str, Any] = {"client": None, "loop": None}
+
+def _async_client():
+    """One shared httpx.AsyncClient per event loop (connection pool reused by every coroutine)."""
+    loop = asyncio.get_running_loop()
+    if _ASYNC_CLIENT["client"] is None or _ASYNC_CLIENT["loop"] is not loop:
+        limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=min(50, ASYNC_MAX_CONNECTIONS))
+        _ASYNC_CLIENT["client"] = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(60.0, connect=10.0))
+        _ASYNC_CLIENT["loop"] = loop
+    return _ASYNC_CLIENT["client"]
+
+async def _async_client_close():
+    cl = _ASYNC_CLIENT.get("client")
+    _ASYNC_CLIENT["client"], _ASYNC_CLIENT["loop"] = None, None
+    if cl is not None:
+        try: await cl.aclose()
+        except Exception: pass
+
+async def _graph_request_async(method: str, path: str, token: Optional[str], ctx_key: Optional[str], timeout: float,
+                               idempotent: bool = False, idempotency_key: Optional[str] = None, **kw):
+    app_name = _app_for_token(token)
+    rem = _respect_cooldown(app_name)
     if rem > 0:
+        if method != "GET" and _can_defer_write():
+            return await asyncio.to_thread(_defer_write, path, token, ctx_key, kw.get("data"), kw.get("files"), app_name)
         return {"error": "RATE_LIMIT", "retry_after": rem}, 429
+    if idempotency_key:
+        done = await asyncio.to_thread(_idem_get, idempotency_key)
+        if done is not None:
+            return done, 200
+    ep = _endpoint_key(method, path)
     url = f"{GRAPH_BASE}/{path}"
     headers = {"Authorization": f"Bearer {token}"} if token else {}
-    attempts = 0
+    safe = method == "GET" or idempotent
+    attempt = 0
     while True:
+        wait = _breaker_wait(ep)
+        if wait > 0:
+            return _circuit_open(ep, wait)
+        sent = True
         try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.post(url, files=files, data=form, headers=headers, timeout=300)
-            _update_usage_and_cooldown(r)
+            scope = _app_throttle_key(app_name)
+            await _await_throttle(ctx_key or scope, scope, _current_lane("read" if method == "GET" else "publish"))
+            r = await _async_client().request(method, url, headers=headers, timeout=timeout, **kw)
+            _update_usage_and_cooldown(r, app_name)
             if r.status_code == 429:
-                data2, st = _handle_429_and_maybe_retry(r, attempts)
-                if st == -1: attempts += 1; continue
-                return data2, st
-            if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
-            return r.json(), 200
-        except requests.RequestException as e:
-            return {"error": str(e)}, 500
+                ra = _note_429(r, app_name)
+                if attempt == 0 and ra <= 5:
+                    attempt += 1
+                    await asyncio.sleep(ra or 1)
+                    continue
+                return {"error": "RATE_LIMIT", "retry_after": ra}, 429
+            try: data = r.json()
+            except ValueError: data = {"error": r.text}
+            status = r.status_code if r.status_code >= 400 else 200
+        except httpx.HTTPError as e:
+            data, status = {"error": str(e)}, 500
+            sent = not _request_not_sent(e)
+        cls = _graph_error_class(status, data)
+        _breaker_record(ep, cls == "transient")
+        if cls == "ok":
+            if idempotency_key: await asyncio.to_thread(_idem_put, idempotency_key, data)
+            return data, 200
+        if cls != "permanent" and attempt + 1 < RETRY_MAX_ATTEMPTS and (safe or not sent):
+            delay = _retry_delay(attempt, app_name)
+            if delay is not None:
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+        if _is_token_error(data):
+            await asyncio.to_thread(token_mark_invalid, token, data)
+        if cls != "permanent" and not safe and sent:
+            data = _outcome_unknown(data)
+        return data, status
+
+async def graph_get_async(path: str, params: Dict[str, Any], token: Optional[str], ttl: int = 0, ctx_key: Optional[str] = None):
+    if httpx is None:
+        return await asyncio.to_thread(graph_get, path, params, token, ttl, ctx_key)
+    with _trace_span("graph.get", arg=path) as sp:
+        res = await _graph_request_async("GET", path, token, ctx_key, 60, params=params)
+        if sp is not None: sp["attrs"]["status"] = res[1]
+        return res
+
+async def graph_post_async(path: str, data: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None,
+                           idempotent: bool = False, idempotency_key: Optional[str] = None):
+    if httpx is None:
+        return await asyncio.to_thread(graph_post, path, data, token, ctx_key, idempotent, idempotency_key)
+    with _trace_span("graph.post", arg=path) as sp:
+        res = await _graph_request_async("POST", path, token, ctx_key, 120, idempotent=idempotent, idempotency_key=idempotency_key, data=data)
+        if sp is not None: sp["attrs"]["status"] = res[1]
+        return res
+
+async def graph_post_multipart_async(path: str, files: Dict[str, Any], form: Dict[str, Any], token: Optional[str], ctx_key: Optional[str] = None,
+                                     idempotent: bool = False, idempotency_key: Optional[str] = None):
+    if httpx is None:
+        return await asyncio.to_thread(graph_post_multipart, path, files, form, token, ctx_key, idempotent, idempotency_key)
+    with _trace_span("graph.post_multipart", arg=path) as sp:
+        res = await _graph_request_async("POST", path, token, ctx_key, 300, idempotent=idempotent, idempotency_key=idempotency_key, files=files, data=form)
+        if sp is not None: sp["attrs"]["status"] = res[1]
+        return res
 
 
 # ------- ENV-based page tokens (no app id/secret needed) -------
+_ENV_TOKENS: Dict[str, Any] = {"raw": None, "parsed": ({}, [])}
+_ENV_PAGES: Dict[str, Any] = {"pages": None, "ts": 0.0, "loose": {}}
+ENV_PAGES_TTL_SEC = int(os.environ.get("ENV_PAGES_TTL_SEC", "3600"))
+
 def _env_get_tokens():
     raw = os.environ.get("PAGE_TOKENS", "") or ""
+    if _ENV_TOKENS["raw"] != raw:
+        _ENV_TOKENS["parsed"], _ENV_TOKENS["raw"] = _env_parse_tokens(raw), raw
+    mapping, loose_tokens = _ENV_TOKENS["parsed"]
+    return dict(mapping), list(loose_tokens)
+
+def _env_parse_tokens(raw: str):
     mapping, loose_tokens = {}, []
     raw = raw.strip()
     if not raw:
@@ -292,11 +893,15 @@ def _env_resolve_loose_tokens(existing: dict):
     for tok in loose:
         d, st = graph_get("me", {"fields":"id,name"}, tok, ttl=0)
         if st==200 and isinstance(d, dict) and d.get("id"):
-            pid=str(d["id"]); existing.setdefault(pid, tok)
+            pid=str(d["id"]); existing.setdefault(pid, tok); _ENV_PAGES["loose"][pid] = tok
             pages.append({"id": pid, "name": d.get("name",""), "access_token": tok})
     return pages
 
-def _env_pages_list():
+def _env_pages_list(refresh: bool = False):
+    # one Graph call per ENV page/loose token: resolved once (at warmup) and reused for ENV_PAGES_TTL_SEC
+    cached = _ENV_PAGES["pages"]
+    if cached is not None and not refresh and pytime.time() - _ENV_PAGES["ts"] < ENV_PAGES_TTL_SEC:
+        return [dict(p) for p in cached]
     mp, _ = _env_get_tokens()
     pages=[]
     for pid, tok in mp.items():
@@ -307,179 +912,1411 @@ def _env_pages_list():
         except Exception: pass
         pages.append({"id": str(pid), "name": name or str(pid), "access_token": tok})
     pages.extend(_env_resolve_loose_tokens(mp))
+    _ENV_PAGES.update(pages=[dict(p) for p in pages], ts=pytime.time())
     return pages
+
+@_traced("token")
 def get_page_access_token(page_id: str, user_token: str) -> Optional[str]:
+    """Page token from the app with the most remaining headroom among those that hold one for this page."""
+    pooled = [c for c in _pool_page_tokens(str(page_id)) if token_usable(c[1])] if _APPS else []
+    tok = _default_page_token(page_id, user_token)
+    if tok: pooled.append((DEFAULT_APP, tok))
+    if not pooled:
+        return None
+    return max(pooled, key=lambda c: _app_headroom(c[0]))[1]
+
+def _default_page_token(page_id: str, user_token: str) -> Optional[str]:
     # ENV first
+    # tokens known to be invalid (token health) are passed over so the next source gets a chance
     mp, _ = _env_get_tokens()
-    if str(page_id) in mp:
+    if str(page_id) in mp and token_usable(mp[str(page_id)]):
         return mp[str(page_id)]
+    if str(page_id) in _ENV_PAGES["loose"] and token_usable(_ENV_PAGES["loose"][str(page_id)]):
+        return _ENV_PAGES["loose"][str(page_id)]
 
-    store = load_tokens()
-    pages = store.get("pages") or {}
-    if page_id in pages:
+    pages = load_tokens().get("pages") or {}
+    if page_id in pages and token_usable(pages[page_id]):
         return pages[page_id]
+    if not user_token:
+        return None
+    tok = _refresh_store_pages(user_token).get(page_id)
+    return tok if tok and token_usable(tok) else None
+
+def _refresh_store_pages(user_token: str) -> Dict[str, str]:
+    """Re-read page tokens from me/accounts into tokens.json; returns the new mapping ({} on failure)."""
     data, st = graph_get("me/accounts", {"limit": 200}, user_token, ttl=0)
+    found = {}
     if st == 200 and isinstance(data, dict):
-        found = {}
         for p in data.get("data", []):
             pid = str(p.get("id")); pat = p.get("access_token")
             if pid and pat: found[pid] = pat
-        if found: store["pages"] = found; save_tokens(store)
-        return found.get(page_id)
-    return None
+        if found:
+            store = load_tokens(); store["pages"] = {**(store.get("pages") or {}), **found}; save_tokens(store)
+    return found
 
 def _ctx_key_for_page(page_id: str) -> str:
     return f"page:{page_id}"
 
 # ----------------------------
-# UI
+# Local store (SQLite): jobs and other durable state
 # ----------------------------
-INDEX_HTML = r"""<!DOCTYPE html>
-<html lang="vi">
-<head>
-  <meta charset="utf-8"/>
-  <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>Thang 5 chi (Completed)</title>
-  <style>
+DB_FILE = os.environ.get("DB_FILE", "app.db")
+DATA_DIR = os.environ.get("DATA_DIR", "data")
 
-    :root{
-      --bg:#f6f7f9;
-      --card-bg:#ffffff;
-      --text:#222;
-      --muted:#6b7280;
-      --border:#e6e8eb;
-      --primary:#1976d2;
-      --radius:12px;
-      --shadow:0 6px 18px rgba(10,10,10,.06);
-    }
-    *{box-sizing:border-box}
-    html,body{height:100%}
-    body{
-      font-family:system-ui,Segoe UI,Arial,sans-serif;
-      margin:0;
-      background:var(--bg);
-      color:var(--text);
-    }
-    .container{
-      max-width:1100px;
-      margin:18px auto;
-      padding:0 16px;
-    }
-    h1{margin:0 0 12px;font-size:22px}
-    h3{margin:0 0 8px;font-size:16px}
-    .tabs{
-      position:sticky; top:0; z-index:10;
-      display:flex; gap:8px; padding:8px 0; background:var(--bg);
-      border-bottom:1px solid var(--border);
-    }
-    .tabs button{
-      padding:8px 12px; border:1px solid var(--border);
-      border-radius:999px; background:#fff; cursor:pointer;
-      font-size:13px; line-height:1;
-    }
-    .tabs button.active{background:var(--primary);color:#fff;border-color:var(--primary)}
-    .panel{display:none}
-    .panel.active{display:block}
-    .row{display:flex;gap:12px;flex-wrap:wrap}
-    .col{flex:1 1 420px;min-width:320px}
-    textarea,input,select{
-      width:100%; padding:9px 10px; border:1px solid var(--border);
-      border-radius:10px; background:var(--card-bg);
-      font-size:14px; outline:none;
-    }
-    textarea{resize:vertical}
-    input[type="file"]{padding:6px}
-    .card{
-      border:1px solid var(--border);
-      background:var(--card-bg);
-      border-radius:var(--radius);
-      padding:12px;
-      box-shadow:var(--shadow);
-    }
-    .list{
-      padding:4px; max-height:320px; overflow:auto; background:#fafafa;
-      border-radius:10px; border:1px dashed var(--border);
-      overscroll-behavior:contain;
-    }
-    /* chat bubbles */
-    .msg{display:flex;margin:6px 0}
-    .msg.me{justify-content:flex-end}
-    .bubble{max-width:78%;padding:9px 11px;border-radius:16px;line-height:1.4;word-break:break-word;white-space:pre-wrap}
-    .me .bubble{background:#e7f3ff;border:1px solid #cfe7ff}
-    .other .bubble{background:#f5f5f5;border:1px solid #ebebeb}
-    .meta{font-size:12px;color:#666;margin-top:4px}
-    .conv-item{padding:8px 10px;display:flex;align-items:center;gap:8px}
-    .conv-item + .conv-item{border-top:1px dashed var(--border)}
-    .conv-title{flex:1 1 auto;overflow:hidden;text-overflow:ellipsis;white-space:nowrap}
-    .dot{min-width:10px;width:10px;height:10px;border-radius:50%}
-    .dot.red{background:#e53935}
-    .dot.green{background:#43a047}
-    .status{margin-top:6px;font-size:12px;color:var(--muted);word-break:break-word}
-    .item{padding:6px 8px;border-bottom:1px dashed var(--border); background:transparent}
-    .item:last-child{border-bottom:none}
-    .muted{color:var(--muted)}
-    .btn{
-      padding:8px 12px;border:1px solid var(--border);border-radius:10px;background:#fff;cursor:pointer;
-      font-size:13px;
-    }
-    .btn.primary{background:var(--primary);color:#fff;border-color:var(--primary)}
-    .grid{display:grid;gap:8px;grid-template-columns:repeat(2,minmax(220px,1fr))}
-    .toolbar{display:flex;gap:8px;flex-wrap:wrap}
-    a{color:var(--primary);text-decoration:none}
-    a:hover{text-decoration:underline}
-    .pin-overlay{position:fixed;inset:0;background:rgba(250,250,252,.96);display:none;align-items:center;justify-content:center;z-index:9999}
-    .pin-box{border:1px solid var(--border);border-radius:16px;padding:18px;min-width:300px;background:#fff;box-shadow:var(--shadow)}
-    @media (max-width: 768px){
-      .col{min-width:100%}
-      .grid{grid-template-columns:1fr}
-      .list{max-height:260px}
-      h1{font-size:18px}
-    }
+_DB_LOCAL = threading.local()
+_DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        type TEXT NOT NULL,
+        status TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after REAL NOT NULL,
+        created REAL NOT NULL,
+        updated REAL NOT NULL,
+        locked_by TEXT,
+        locked_at REAL)""",
+    "CREATE INDEX IF NOT EXISTS jobs_ready ON jobs(status, type, run_after)",
+    "CREATE INDEX IF NOT EXISTS jobs_created ON jobs(created)",
+]
 
+IDEMPOTENCY_TTL_SEC = int(os.environ.get("IDEMPOTENCY_TTL_SEC", str(7 * 86400)))
+_DB_SCHEMA += [
+    "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, result TEXT NOT NULL, ts REAL NOT NULL)",
+]
 
+def _idem_get(key: str) -> Optional[Any]:
+    row = _db().execute("SELECT result FROM idempotency WHERE key=? AND ts > ?", (key, pytime.time() - IDEMPOTENCY_TTL_SEC)).fetchone()
+    return json.loads(row["result"]) if row else None
 
+def _idem_put(key: str, result: Any):
+    now = pytime.time()
+    conn = _db()
+    conn.execute("INSERT OR REPLACE INTO idempotency(key,result,ts) VALUES (?,?,?)", (key, json.dumps(result, ensure_ascii=False), now))
+    if random.random() < 0.01:
+        conn.execute("DELETE FROM idempotency WHERE ts < ?", (now - IDEMPOTENCY_TTL_SEC,))
 
+def _db() -> sqlite3.Connection:
+    """Per-thread connection (re-opened after fork); autocommit, WAL, schema created on first use."""
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is not None and getattr(_DB_LOCAL, "pid", None) == os.getpid():
+        return conn
+    os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    for stmt in _DB_SCHEMA:
+        conn.execute(stmt)
+    _DB_LOCAL.conn, _DB_LOCAL.pid = conn, os.getpid()
+    return conn
 
+def _stage_upload(file) -> Dict[str, str]:
+    """Copy an uploaded werkzeug FileStorage to DATA_DIR/uploads so a job can read it after the request is gone."""
+    d = os.path.join(DATA_DIR, "uploads")
+    os.makedirs(d, exist_ok=True)
+    safe = "".join(ch for ch in (file.filename or "upload") if ch.isalnum() or ch in "._-")[-80:] or "upload"
+    path = os.path.join(d, f"{os.urandom(8).hex()}_{safe}")
+    file.save(path)
+    return {"path": path, "filename": file.filename or safe, "mimetype": file.mimetype or "application/octet-stream",
+            "sha256": _file_sha256(path)}
 
+def _stage_link(staged: Dict[str, str]) -> Dict[str, str]:
+    """Give another job its own name for an already staged file (hard link, copy as fallback) so each can clean up independently."""
+    base = os.path.basename(staged["path"]).split("_", 1)[-1]
+    path = os.path.join(os.path.dirname(staged["path"]), f"{os.urandom(8).hex()}_{base}")
+    try:
+        os.link(staged["path"], path)
+    except OSError:
+        import shutil
+        shutil.copyfile(staged["path"], path)
+    return dict(staged, path=path)
 
+def _discard_staged(payload: dict):
+    for f in [payload.get("file") or {}, *(payload.get("files") or {}).values()]:
+        if f.get("path"):
+            try: os.remove(f["path"])
+            except OSError: pass
 
+# ----------------------------
+# Image preprocessing: validate, downscale per target, strip metadata, recompress (cached by content hash)
+# ----------------------------
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # uploads are forwarded unchanged
+    Image = ImageOps = None
 
+IMAGE_PROFILES: Dict[str, Dict[str, int]] = {
+    "avatar": {"max_side": 1024, "quality": 90},
+    "cover": {"max_side": 1640, "quality": 90},
+    "photo": {"max_side": 2048, "quality": 85},
+}
+IMAGE_CACHE_MAX_MB = int(os.environ.get("IMAGE_CACHE_MAX_MB", "512"))
 
+def _file_sha256(path: str) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
+def _validate_image(file) -> bool:
+    """Cheap structural check on an upload (no full decode); True when Pillow is not installed."""
+    if Image is None:
+        return True
+    try:
+        with Image.open(file.stream) as im:
+            im.verify()
+        return True
+    except Exception:
+        return False
+    finally:
+        file.stream.seek(0)
 
+def _temp_beside(path: str) -> str:
+    """A new, uniquely named temp file next to `path` (same filesystem, so os.replace onto `path` is atomic)."""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return tmp
 
+def _image_cache_trim(cache_dir: str):
+    files = []
+    for name in os.listdir(cache_dir):
+        fp = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(fp)
+            files.append((st.st_atime, st.st_size, fp))
+        except OSError:
+            pass
+    total, limit = sum(f[1] for f in files), IMAGE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, fp in sorted(files):
+        if total <= limit:
+            break
+        try:
+            os.remove(fp)
+            total -= size
+        except OSError:
+            pass
 
+def prepare_image(staged: Dict[str, str], profile: str) -> Dict[str, str]:
+    """Return a staged-file dict for the processed image, or `staged` itself if it cannot (or need not) be processed."""
+    if Image is None or profile not in IMAGE_PROFILES:
+        return staged
+    cfg = IMAGE_PROFILES[profile]
+    cache_dir = os.path.join(DATA_DIR, "imgcache")
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = _file_sha256(staged["path"])
+    base = os.path.join(cache_dir, f"{digest}-{profile}")
+    for ext, mime in ((".jpg", "image/jpeg"), (".png", "image/png")):
+        if os.path.exists(base + ext):
+            os.utime(base + ext)
+            return {"path": base + ext, "filename": os.path.splitext(staged["filename"])[0] + ext, "mimetype": mime}
+    with _trace_span("image.prepare", profile=profile, bytes_in=os.path.getsize(staged["path"])) as sp:
+        tmp = None
+        try:
+            with Image.open(staged["path"]) as im:
+                im = ImageOps.exif_transpose(im)
+                im.thumbnail((cfg["max_side"], cfg["max_side"]), Image.LANCZOS)
+                has_alpha = im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info)
+                tmp = _temp_beside(base)  # unique per call: two threads preparing the same image never share it
+                # saving without exif/icc/info drops camera metadata and GPS
+                if has_alpha:
+                    ext, mime = ".png", "image/png"
+                    im.save(tmp, "PNG", optimize=True)
+                else:
+                    ext, mime = ".jpg", "image/jpeg"
+                    im.convert("RGB").save(tmp, "JPEG", quality=cfg["quality"], optimize=True, progressive=True)
+            if os.path.getsize(tmp) >= os.path.getsize(staged["path"]) and staged["mimetype"] == mime:
+                os.remove(tmp)  # already small: keep the original bytes
+                return staged
+            os.replace(tmp, base + ext)
+            if sp is not None: sp["attrs"]["bytes_out"] = os.path.getsize(base + ext)
+        except Exception:
+            if tmp:
+                try: os.remove(tmp)
+                except OSError: pass
+            return staged
+    _image_cache_trim(cache_dir)
+    return {"path": base + ext, "filename": os.path.splitext(staged["filename"])[0] + ext, "mimetype": mime}
 
-/* ===== Fanpage list: 1 dòng, checkbox sát mép phải ===== */
-.list .item {
-  display: flex;
-  align-items: center;
-  justify-content: space-between;
-  padding: 6px 10px;
-  border-bottom: 1px solid #eee;
-  white-space: nowrap;          /* không xuống dòng */
-  overflow: hidden;
-}
+# ----------------------------
+# Background jobs: durable queue + per-pool worker threads
+# ----------------------------
+JOB_CONCURRENCY: Dict[str, int] = {"publish": 2, "upload": 1, "profile": 1, "deferred": 1, "moderation": 1, "sync": 1}
+try:
+    JOB_CONCURRENCY.update({k: int(v) for k, v in json.loads(os.environ.get("JOB_CONCURRENCY", "") or "{}").items()})
+except Exception:
+    pass
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE = float(os.environ.get("JOB_BACKOFF_BASE", "5"))
+JOB_BACKOFF_MAX = float(os.environ.get("JOB_BACKOFF_MAX", "600"))
+JOB_STALE_SEC = int(os.environ.get("JOB_STALE_SEC", "900"))  # a 'running' job not heard from this long is assumed lost (worker restart)
+JOB_HEARTBEAT_SEC = max(1.0, min(float(os.environ.get("JOB_HEARTBEAT_SEC", "60")), JOB_STALE_SEC / 3))
+JOB_WORKERS_ENABLED = os.environ.get("JOB_WORKERS", "1") != "0"
+JOB_FILE_KEEP_SEC = int(os.environ.get("JOB_FILE_KEEP_SEC", str(3 * 86400)))  # staged files of failed jobs stay retryable this long
 
-.list .item label {
-  display: flex;
-  align-items: center;
-  justify-content: space-between;
-  width: 100%;
-}
+JOB_HANDLERS: Dict[str, Dict[str, Any]] = {}
+_JOB_STATE: Dict[str, Any] = {"pid": None, "threads": [], "wake": threading.Event(), "lock": threading.Lock(), "running": set()}
 
-.list .item .page-name{
-  flex: 1 1 auto;
-  min-width: 0;                /* allow text to shrink instead of pushing */
-  color: inherit;
-  text-align: left;
-  overflow: hidden;
-  text-overflow: ellipsis;
-  white-space: nowrap;
-}
+def job_handler(job_type: str, pool: str, lane: str = "publish"):
+    """Register fn(payload) -> (data, status) for `job_type`, executed by the `pool` workers with Graph calls in `lane`."""
+    def deco(fn):
+        JOB_HANDLERS[job_type] = {"fn": fn, "pool": pool, "lane": lane}
+        return fn
+    return deco
 
-.list .item input[type="checkbox"]{
-  flex-shrink: 0 !important;
+# Access tokens never go into a stored payload (jobs, scheduled_posts). The process that queued a job keeps them in
+# memory; anywhere else (another worker, after a restart, a scheduled fire) they are looked up again when it runs.
+_JOB_TOKEN_KEYS = ("page_token", "user_token", "token")
+_JOB_TOKENS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+JOB_TOKENS_MAX = 10000
+
+def _strip_tokens(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(payload without tokens, the tokens); the payload lists the stripped names under "_tokens"."""
+    clean, held = dict(payload), {}
+    for k in _JOB_TOKEN_KEYS:
+        tok = clean.pop(k, None)
+        if tok: held[k] = tok
+    if isinstance(clean.get("pages"), list):  # bulk jobs: [{page_id, page_token}, ...]
+        pages = []
+        for pg in clean["pages"]:
+            if isinstance(pg, dict) and pg.get("page_token"):
+                held.setdefault("pages", {})[str(pg.get("page_id"))] = pg["page_token"]
+                pg = {k: v for k, v in pg.items() if k != "page_token"}
+            pages.append(pg)
+        clean["pages"] = pages
+    if held:
+        clean["_tokens"] = sorted(set(clean.get("_tokens") or []) | set(held))
+    return clean, held
+
+def _restore_tokens(job_id: str, payload: Dict[str, Any]) -> Optional[str]:
+    """Put the stripped tokens back into `payload`; returns the name of one that cannot be found any more."""
+    held = _JOB_TOKENS.get(job_id) or {}
+    user = (load_tokens().get("user_long") or {}).get("access_token")
+    for k in payload.pop("_tokens", None) or []:
+        if k == "pages":
+            known, pages = held.get("pages") or {}, []
+            for pg in payload.get("pages") or []:
+                tok = known.get(str(pg["page_id"])) or _background_page_token(str(pg["page_id"]))
+                if tok: pages.append(dict(pg, page_token=tok))
+                else: payload.setdefault("skipped", {})[pg["page_id"]] = {"status": 403, "data": {"error": "NO_PAGE_TOKEN"}}
+            payload["pages"] = pages
+            continue
+        tok = held.get(k)
+        if not tok and k == "page_token":
+            tok = _background_page_token(str(payload.get("page_id") or ""))
+        elif not tok and k == "token":  # graph_write: the page its throttle key names, else the user
+            ctx = str(payload.get("ctx_key") or "")
+            tok = _background_page_token(ctx[len("page:"):]) if ctx.startswith("page:") else user
+        elif not tok:
+            tok = user
+        if not tok and k != "user_token":
+            return k
+        payload[k] = tok
+    return None
+
+def enqueue_job(job_type: str, payload: Dict[str, Any], run_after: Optional[float] = None, max_attempts: Optional[int] = None,
+                job_id: Optional[str] = None) -> str:
+    """Queue a job; a caller-chosen job_id makes the insert a no-op when that job already exists."""
+    if job_type not in JOB_HANDLERS:
+        raise ValueError(f"unknown job type {job_type}")
+    now = pytime.time()
+    job_id = job_id or os.urandom(8).hex()
+    payload, held = _strip_tokens(payload)
+    if _trace_active():
+        payload["_trace"] = True
+    cur = _db().execute(
+        "INSERT OR IGNORE INTO jobs(id,type,status,payload,attempts,max_attempts,run_after,created,updated) VALUES (?,?,?,?,?,?,?,?,?)",
+        (job_id, job_type, "queued", json.dumps(payload, ensure_ascii=False), 0,
+         int(max_attempts or JOB_MAX_ATTEMPTS), float(run_after or now), now, now))
+    if held and cur.rowcount == 1:  # an existing job keeps the tokens it was queued with
+        _JOB_TOKENS[job_id] = held
+        while len(_JOB_TOKENS) > JOB_TOKENS_MAX:
+            _JOB_TOKENS.popitem(last=False)
+    _ensure_job_workers()
+    _JOB_STATE["wake"].set()
+    return job_id
+
+def _job_row(row) -> Dict[str, Any]:
+    out = {k: row[k] for k in ("id", "type", "status", "attempts", "max_attempts", "run_after", "created", "updated", "error")}
+    out["result"] = json.loads(row["result"]) if row["result"] else None
+    res = out["result"]
+    if isinstance(res, dict) and res.get("permalink_pending"):
+        # permalinks are resolved after the job finished; merge them in on read
+        pl = _db().execute("SELECT status, permalink_url FROM permalinks WHERE object_id=?", (str(res["permalink_pending"]),)).fetchone()
+        if pl and pl["status"] != "pending":
+            res.pop("permalink_pending", None)
+            if pl["permalink_url"]: res["permalink_url"] = pl["permalink_url"]
+    return out
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    row = _db().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+    return _job_row(row) if row else None
+
+def _claim_job(types) -> Optional[sqlite3.Row]:
+    conn = _db()
+    now = pytime.time()
+    marks = ",".join("?" * len(types))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            f"UPDATE jobs SET status='queued', locked_by=NULL, updated=? WHERE status='running' AND locked_at < ? AND type IN ({marks})",
+            (now, now - JOB_STALE_SEC, *types))
+        row = conn.execute(
+            f"SELECT * FROM jobs WHERE status='queued' AND run_after <= ? AND type IN ({marks}) ORDER BY run_after LIMIT 1",
+            (now, *types)).fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET status='running', locked_by=?, locked_at=?, updated=? WHERE id=?",
+                         (f"{os.getpid()}:{threading.get_ident()}", now, now, row["id"]))
+        conn.execute("COMMIT")
+        return row
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _job_retry_delay(attempts: int, app_name: Optional[str] = None) -> float:
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    delay = delay * (0.5 + random.random() / 2)
+    rem = _respect_cooldown(app_name)
+    if rem > 0:
+        # never wake up while Graph still has the job's app in cooldown
+        delay = max(delay, rem + random.uniform(1.0, 5.0))
+    return delay
+
+def _job_finish(job_id: str, status: str, result: Any = None, error: Optional[str] = None, run_after: Optional[float] = None):
+    now = pytime.time()
+    _db().execute(
+        "UPDATE jobs SET status=?, result=?, error=?, run_after=COALESCE(?, run_after), locked_by=NULL, locked_at=NULL, updated=? WHERE id=?",
+        (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, run_after, now, job_id))
+    if status != "queued":
+        _JOB_TOKENS.pop(job_id, None)
+    if status == "failed":
+        _ledger_failed(job_id, error)
+
+def _run_job(row):
+    # while listed here the heartbeat keeps locked_at fresh, so a long upload is never reclaimed as stale
+    _JOB_STATE["running"].add(row["id"])
+    try:
+        _execute_job(row)
+    finally:
+        _JOB_STATE["running"].discard(row["id"])
+
+def _job_heartbeat_loop():
+    while True:
+        pytime.sleep(JOB_HEARTBEAT_SEC)
+        ids = list(_JOB_STATE["running"])
+        if not ids:
+            continue
+        try:
+            _db().execute(f"UPDATE jobs SET locked_at=? WHERE status='running' AND id IN ({','.join('?' * len(ids))})",
+                          (pytime.time(), *ids))
+        except sqlite3.Error:
+            pass
+
+def _execute_job(row):
+    job_type, payload = row["type"], json.loads(row["payload"])
+    attempts = int(row["attempts"]) + 1
+    _db().execute("UPDATE jobs SET attempts=? WHERE id=?", (attempts, row["id"]))
+    handler = JOB_HANDLERS.get(job_type)
+    if not handler:
+        _job_finish(row["id"], "failed", error="UNKNOWN_JOB_TYPE")
+        return
+    missing = _restore_tokens(row["id"], payload)
+    if missing:
+        _job_finish(row["id"], "failed", result={"error": "NO_PAGE_TOKEN", "missing": missing}, error="NO_PAGE_TOKEN")
+        return
+    if payload.get("page_token") and not token_usable(payload["page_token"]):
+        # swap in a live token before spending a throttle slot; a page with none left fails without a Graph call
+        fresh = _background_page_token(str(payload.get("page_id") or ""))
+        if not fresh:
+            _job_finish(row["id"], "failed", result={"error": "PAGE_TOKEN_INVALID"}, error="PAGE_TOKEN_INVALID")
+            return
+        payload["page_token"] = fresh
+    traced = payload.pop("_trace", False) or (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE)
+    if traced:
+        _trace_start(f"job {job_type}", job_id=row["id"], attempt=attempts)
+    status = 500
+    app_name = _app_for_token(payload.get("page_token") or payload.get("token"))
+    try:
+        payload["_job_id"] = row["id"]
+        with graph_lane(handler["lane"]):
+            data, status = handler["fn"](payload)
+        payload.pop("_job_id", None)
+        if status < 400:
+            _job_finish(row["id"], "done", result=data)
+            _discard_staged(payload)
+        elif is_outcome_unknown(data):
+            # the write may have gone through: requeueing could publish twice, so stop and let a person check the page
+            _job_finish(row["id"], "failed", result=data, error="UNKNOWN_OUTCOME")
+        elif _is_retryable(data, status) and attempts < int(row["max_attempts"]):
+            _job_finish(row["id"], "queued", result=data, run_after=pytime.time() + _job_retry_delay(attempts, app_name))
+        else:
+            # staged files outlive a failure so /api/jobs/<id>/retry works; uploads_gc removes them later
+            _job_finish(row["id"], "failed", result=data, error=str((data or {}).get("error") if isinstance(data, dict) else data)[:500])
+    except Exception as e:
+        if attempts < int(row["max_attempts"]):
+            _job_finish(row["id"], "queued", error=str(e)[:500], run_after=pytime.time() + _job_retry_delay(attempts, app_name))
+        else:
+            _job_finish(row["id"], "failed", error=str(e)[:500])
+    finally:
+        if traced:
+            _trace_finish(status)
+
+RECURRING_JOBS: Dict[str, float] = {}
+
+def recurring_job(job_type: str, every_sec: float, pool: str, lane: str = "background"):
+    """job_handler that also runs on its own every `every_sec` (payload {})."""
+    def deco(fn):
+        job_handler(job_type, pool, lane)(fn)
+        RECURRING_JOBS[job_type] = float(every_sec)
+        return fn
+    return deco
+
+def _ensure_recurring_jobs():
+    # the interval slot is part of the job id, so every process may offer the run and only one row lands
+    now = pytime.time()
+    if now - _JOB_STATE.get("recurring_ts", 0.0) < 30:
+        return
+    _JOB_STATE["recurring_ts"] = now
+    for job_type, every in RECURRING_JOBS.items():
+        busy = _db().execute("SELECT 1 FROM jobs WHERE type=? AND status IN ('queued','running') LIMIT 1", (job_type,)).fetchone()
+        if not busy:
+            enqueue_job(job_type, {}, max_attempts=1, job_id=f"{job_type}:{int(now // every)}")
+
+def _staged_paths(payload: Dict[str, Any]) -> List[str]:
+    files = [payload.get("file") or {}, *(payload.get("files") or {}).values()]
+    return [f["path"] for f in files if isinstance(f, dict) and f.get("path")]
+
+@recurring_job("uploads_gc", 3600, pool="sync")
+def _job_uploads_gc(p: dict):
+    """Remove staged uploads older than JOB_FILE_KEEP_SEC that no queued/running job or pending schedule still needs."""
+    d = os.path.join(DATA_DIR, "uploads")
+    if not os.path.isdir(d):
+        return {"removed": 0}, 200
+    live = set()
+    for r in _db().execute("SELECT payload FROM jobs WHERE status IN ('queued','running') UNION ALL "
+                           "SELECT payload FROM scheduled_posts WHERE status='pending'"):
+        live.update(os.path.abspath(x) for x in _staged_paths(json.loads(r["payload"])))
+    cutoff, removed = pytime.time() - JOB_FILE_KEEP_SEC, 0
+    for name in os.listdir(d):
+        fp = os.path.abspath(os.path.join(d, name))
+        try:
+            if os.path.getmtime(fp) < cutoff and fp not in live:
+                os.remove(fp); removed += 1
+        except OSError:
+            pass
+    return {"removed": removed}, 200
+
+def _job_worker(pool: str):
+    while True:
+        types = [t for t, h in JOB_HANDLERS.items() if h["pool"] == pool]
+        row = None
+        try:
+            _ensure_recurring_jobs()
+            row = _claim_job(types) if types else None
+        except Exception:
+            row = None
+        if row is None:
+            _JOB_STATE["wake"].wait(1.0)
+            _JOB_STATE["wake"].clear()
+            continue
+        _run_job(row)
+
+def _ensure_job_workers():
+    """Start worker threads lazily, once per process (gunicorn --preload forks after import)."""
+    if not JOB_WORKERS_ENABLED or _JOB_STATE["pid"] == os.getpid():
+        return
+    with _JOB_STATE["lock"]:
+        if _JOB_STATE["pid"] == os.getpid():
+            return
+        _JOB_STATE["wake"] = threading.Event()
+        _JOB_STATE["threads"] = []
+        _JOB_STATE["running"] = set()
+        threading.Thread(target=_job_heartbeat_loop, name="job-heartbeat", daemon=True).start()
+        for pool, n in JOB_CONCURRENCY.items():
+            for i in range(max(0, int(n))):
+                t = threading.Thread(target=_job_worker, args=(pool,), name=f"job-{pool}-{i}", daemon=True)
+                t.start()
+                _JOB_STATE["threads"].append(t)
+        _JOB_STATE["pid"] = os.getpid()
+
+
+# ----------------------------
+# Deferred writes: during a cooldown, writes made on behalf of a request are queued instead of rejected
+# ----------------------------
+DEFER_WRITES = os.environ.get("DEFER_WRITES", "1") != "0"
+DEFER_DRAIN_GAP_SEC = float(os.environ.get("DEFER_DRAIN_GAP_SEC", "2"))
+
+def _can_defer_write() -> bool:
+    # job workers are durable already: a 429 there just requeues the job after the cooldown
+    return DEFER_WRITES and has_request_context()
+
+def _defer_write(path: str, token: Optional[str], ctx_key: Optional[str], data: Optional[Dict[str, Any]], files: Optional[Dict[str, Any]],
+                 app_name: Optional[str] = None):
+    """Persist a Graph POST as a graph_write job due when the cooldown lifts, one every DEFER_DRAIN_GAP_SEC after that."""
+    staged = {}
+    for field, v in (files or {}).items():
+        name, fh, mime = (tuple(v) + (None, None))[:3] if isinstance(v, tuple) else (getattr(v, "name", field), v, None)
+        d = os.path.join(DATA_DIR, "uploads")
+        os.makedirs(d, exist_ok=True)
+        dst = os.path.join(d, f"{os.urandom(8).hex()}_deferred")
+        if hasattr(fh, "seek"): fh.seek(0)
+        with open(dst, "wb") as out:
+            while True:
+                chunk = fh.read(1 << 20)
+                if not chunk: break
+                out.write(chunk)
+        staged[field] = {"path": dst, "filename": os.path.basename(str(name)), "mimetype": mime or "application/octet-stream"}
+    row = _db().execute("SELECT MAX(run_after) AS t FROM jobs WHERE type='graph_write' AND status='queued'").fetchone()
+    run_after = max(float(_app_state(app_name).get("cooldown_until", 0) or 0), float((row["t"] if row else None) or 0) + DEFER_DRAIN_GAP_SEC, pytime.time())
+    # the lane goes along so an inbox reply drains ahead of background writes, as it would have run live
+    job_id = enqueue_job("graph_write", {"path": path, "data": data or {}, "files": staged, "token": token, "ctx_key": ctx_key,
+                                         "lane": _current_lane("publish")}, run_after=run_after)
+    return {"deferred": True, "job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}", "run_after": run_after}, 202
+
+@job_handler("graph_write", pool="deferred")
+def _job_graph_write(p: dict):
+    key = f"{p['_job_id']}:write"
+    lane = p.get("lane") if p.get("lane") in LANES else "publish"
+    with graph_lane(lane):
+        if not p.get("files"):
+            return graph_post(p["path"], p.get("data") or {}, p.get("token"), ctx_key=p.get("ctx_key"), idempotency_key=key)
+        opened = {k: (f["filename"], open(f["path"], "rb"), f["mimetype"]) for k, f in p["files"].items()}
+        try:
+            return graph_post_multipart(p["path"], opened, p.get("data") or {}, p.get("token"), ctx_key=p.get("ctx_key"), idempotency_key=key)
+        finally:
+            for v in opened.values(): v[1].close()
+
+# ----------------------------
+# Scheduled posting: time-ordered heap + durable table, one timer thread per process
+# ----------------------------
+SCHEDULE_SPREAD_SEC = float(os.environ.get("SCHEDULE_SPREAD_SEC", "15"))      # min gap between any two scheduled fires
+SCHEDULE_PAGE_GAP_SEC = float(os.environ.get("SCHEDULE_PAGE_GAP_SEC", "60"))  # min gap between fires on the same page
+SCHEDULE_RESYNC_SEC = float(os.environ.get("SCHEDULE_RESYNC_SEC", "30"))      # pick up rows inserted by other workers
+SCHEDULE_JOB_TYPES = {"feed": "publish_feed", "photo": "publish_photo", "video": "publish_video", "reel": "publish_reel"}
+
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS scheduled_posts (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        page_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        due_at REAL NOT NULL,
+        fire_at REAL NOT NULL,
+        status TEXT NOT NULL,
+        job_id TEXT,
+        created REAL NOT NULL,
+        updated REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS scheduled_pending ON scheduled_posts(status, fire_at)",
+    "CREATE INDEX IF NOT EXISTS scheduled_page ON scheduled_posts(page_id, fire_at)",
+]
+
+_SCHED: Dict[str, Any] = {"pid": None, "heap": [], "cond": threading.Condition(), "thread": None}
+
+def _schedule_slot(due_at: float, page_id: str) -> float:
+    """Earliest time >= due_at that keeps SCHEDULE_SPREAD_SEC to every pending fire and SCHEDULE_PAGE_GAP_SEC on the same page."""
+    widest = max(SCHEDULE_SPREAD_SEC, SCHEDULE_PAGE_GAP_SEC)
+    rows = _db().execute(
+        "SELECT fire_at, page_id FROM scheduled_posts WHERE status='pending' AND fire_at > ? ORDER BY fire_at",
+        (due_at - widest,)).fetchall()
+    t = due_at
+    # rows are sorted and t only moves forward, so one pass settles every conflict
+    for r in rows:
+        need = SCHEDULE_PAGE_GAP_SEC if r["page_id"] == page_id else SCHEDULE_SPREAD_SEC
+        if abs(r["fire_at"] - t) < need:
+            t = r["fire_at"] + need
+    return t
+
+def _schedule_push(fire_at: float, sid: str):
+    with _SCHED["cond"]:
+        heapq.heappush(_SCHED["heap"], (fire_at, sid))
+        _SCHED["cond"].notify()
+
+def schedule_post(kind: str, page_id: str, payload: Dict[str, Any], due_at: float) -> Dict[str, Any]:
+    now = pytime.time()
+    sid = os.urandom(8).hex()
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        fire_at = _schedule_slot(max(due_at, now), page_id)
+        conn.execute(
+            "INSERT INTO scheduled_posts(id,kind,page_id,payload,due_at,fire_at,status,created,updated) VALUES (?,?,?,?,?,?,?,?,?)",
+            (sid, kind, page_id, json.dumps(_strip_tokens(payload)[0], ensure_ascii=False), due_at, fire_at, "pending", now, now))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    _ensure_scheduler()
+    _schedule_push(fire_at, sid)
+    return {"id": sid, "page_id": page_id, "kind": kind, "due_at": due_at, "fire_at": fire_at}
+
+def _fire_scheduled(sid: str):
+    conn = _db()
+    row = conn.execute("SELECT * FROM scheduled_posts WHERE id=? AND status='pending'", (sid,)).fetchone()
+    if not row:
+        return
+    now = pytime.time()
+    if row["fire_at"] > now + 0.5:
+        _schedule_push(row["fire_at"], sid)  # moved after this heap entry was queued
+        return
+    rem = _respect_cooldown(_app_for_token(_background_page_token(row["page_id"])))
+    if rem > 0:
+        fire_at = _schedule_slot(now + rem + random.uniform(1.0, 5.0), row["page_id"])
+        conn.execute("UPDATE scheduled_posts SET fire_at=?, updated=? WHERE id=? AND status='pending'", (fire_at, now, sid))
+        _schedule_push(fire_at, sid)
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.execute("UPDATE scheduled_posts SET status='fired', updated=? WHERE id=? AND status='pending'", (now, sid))
+        if cur.rowcount:
+            payload = json.loads(row["payload"])
+            job_id, _ = ledger_claim(row["page_id"], row["kind"], _publish_text(payload), payload.get("campaign_id"),
+                                     check_duplicate=False, digest=(payload.get("file") or {}).get("sha256"))
+            enqueue_job(SCHEDULE_JOB_TYPES[row["kind"]], payload, job_id=job_id)
+            conn.execute("UPDATE scheduled_posts SET job_id=? WHERE id=?", (job_id, sid))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _scheduler_reload():
+    rows = _db().execute("SELECT id, fire_at FROM scheduled_posts WHERE status='pending'").fetchall()
+    with _SCHED["cond"]:
+        _SCHED["heap"] = [(r["fire_at"], r["id"]) for r in rows]
+        heapq.heapify(_SCHED["heap"])
+
+def _scheduler_loop():
+    next_sync = 0.0
+    while True:
+        try:
+            if pytime.time() >= next_sync:
+                _scheduler_reload()
+                next_sync = pytime.time() + SCHEDULE_RESYNC_SEC
+            due = None
+            with _SCHED["cond"]:
+                heap = _SCHED["heap"]
+                now = pytime.time()
+                if heap and heap[0][0] <= now:
+                    due = heapq.heappop(heap)[1]
+                else:
+                    wait = min(heap[0][0] - now if heap else SCHEDULE_RESYNC_SEC, max(0.0, next_sync - now))
+                    _SCHED["cond"].wait(timeout=max(0.05, wait))
+            if due:
+                _fire_scheduled(due)
+        except Exception:
+            pytime.sleep(1.0)
+
+def _ensure_scheduler():
+    if not JOB_WORKERS_ENABLED or _SCHED["pid"] == os.getpid():
+        return
+    with _JOB_STATE["lock"]:
+        if _SCHED["pid"] == os.getpid():
+            return
+        _SCHED["cond"] = threading.Condition()
+        _SCHED["heap"] = []
+        _SCHED["thread"] = threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True)
+        _SCHED["thread"].start()
+        _SCHED["pid"] = os.getpid()
+
+# ----------------------------
+# Permalink resolution: off the publish path, coalesced into ?ids=a,b,c reads across pages
+# ----------------------------
+PERMALINK_BATCH_WINDOW = float(os.environ.get("PERMALINK_BATCH_WINDOW", "2.0"))
+PERMALINK_MAX_ATTEMPTS = int(os.environ.get("PERMALINK_MAX_ATTEMPTS", "6"))
+GRAPH_MAX_IDS = 50
+
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS permalinks (
+        object_id TEXT PRIMARY KEY,
+        page_id TEXT NOT NULL,
+        job_id TEXT,
+        status TEXT NOT NULL,
+        permalink_url TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL,
+        updated REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS permalinks_job ON permalinks(job_id)",
+]
+
+# pending: object_id -> {"page_id", "page_token", "attempts", "not_before", "single"}
+_PERMALINKS: Dict[str, Any] = {"pid": None, "pending": {}, "lock": threading.Lock(), "wake": threading.Event()}
+
+def queue_permalink(data: dict, obj_id, page_id: str, page_token: str, job_id: Optional[str] = None):
+    """Mark `data` as awaiting its permalink and hand the id to the batch resolver (no Graph call here)."""
+    if not obj_id:
+        return
+    obj_id, now = str(obj_id), pytime.time()
+    _db().execute(
+        "INSERT OR IGNORE INTO permalinks(object_id,page_id,job_id,status,created,updated) VALUES (?,?,?,?,?,?)",
+        (obj_id, page_id, job_id, "pending", now, now))
+    data["permalink_pending"] = obj_id
+    _ensure_permalink_resolver()
+    with _PERMALINKS["lock"]:
+        _PERMALINKS["pending"][obj_id] = {"page_id": page_id, "page_token": page_token, "attempts": 0, "not_before": 0.0, "single": False}
+    _PERMALINKS["wake"].set()
+
+def _permalink_done(obj_id: str, status: str, url: Optional[str] = None):
+    _db().execute("UPDATE permalinks SET status=?, permalink_url=?, updated=? WHERE object_id=?",
+                  (status, url, pytime.time(), obj_id))
+    if url:
+        _db().execute("UPDATE publish_ledger SET permalink_url=?, updated=? WHERE (job_id, page_id) = "
+                      "(SELECT job_id, page_id FROM permalinks WHERE object_id=?)", (url, pytime.time(), obj_id))
+
+def _permalink_read(token: str, ids: List[str], ctx_key: Optional[str]) -> Tuple[Dict[str, str], int]:
+    if len(ids) == 1:
+        data, st = graph_get(ids[0], {"fields": "permalink_url"}, token, ttl=0, ctx_key=ctx_key)
+        data = {ids[0]: data} if st == 200 else data
+    else:
+        data, st = graph_get("", {"ids": ",".join(ids), "fields": "permalink_url"}, token, ttl=0, ctx_key=ctx_key)
+    if st != 200 or not isinstance(data, dict):
+        return {}, st
+    return {oid: (data.get(oid) or {})["permalink_url"] for oid in ids if (data.get(oid) or {}).get("permalink_url")}, st
+
+def _resolve_permalink_batch(batch: Dict[str, dict], user_token: Optional[str] = None):
+    """One ?ids= read for ids of any pages with the user token; ids it does not return are read with their page token."""
+    ids = list(batch)
+    found, status, multi = {}, {}, {}
+    if user_token:
+        found, st = _permalink_read(user_token, ids, None)
+        status, multi = dict.fromkeys(ids, st), dict.fromkeys(ids, len(ids) > 1)
+    by_token: Dict[str, List[str]] = {}
+    for oid in ids:
+        if oid not in found and batch[oid].get("page_token"):
+            by_token.setdefault(batch[oid]["page_token"], []).append(oid)
+    for tok, oids in by_token.items():
+        got, st = _permalink_read(tok, oids, _ctx_key_for_page(batch[oids[0]]["page_id"]))
+        found.update(got)
+        status.update(dict.fromkeys(oids, st))
+        multi.update(dict.fromkeys(oids, len(oids) > 1))
+    retry = {}
+    for oid in ids:
+        ent = batch[oid]
+        if oid in found:
+            _permalink_done(oid, "resolved", found[oid])
+            continue
+        st = status.get(oid, 0)
+        ent["attempts"] += 1
+        _db().execute("UPDATE permalinks SET attempts=?, updated=? WHERE object_id=?", (ent["attempts"], pytime.time(), oid))
+        if ent["attempts"] >= PERMALINK_MAX_ATTEMPTS or (st < 500 and st not in (0, 200, 429) and not multi[oid]):
+            _permalink_done(oid, "failed")
+            continue
+        # videos/reels get their permalink only after processing; back off. One bad id fails a whole
+        # multi-id read, so ids from a failed batch are retried one by one.
+        ent["not_before"] = pytime.time() + min(120.0, 5.0 * (2 ** ent["attempts"]))
+        ent["single"] = ent["single"] or (st != 200 and multi.get(oid, False))
+        retry[oid] = ent
+    if retry:
+        with _PERMALINKS["lock"]:
+            _PERMALINKS["pending"].update(retry)
+
+def _permalink_batches(now: float) -> List[Tuple[Optional[str], Dict[str, dict]]]:
+    """Take the ready ids off the pending set: one batch across pages with the user token, else one per page token."""
+    user = (load_tokens().get("user_long") or {}).get("access_token")
+    groups: Dict[Optional[str], Dict[str, dict]] = {}
+    batches = []
+    with _PERMALINKS["lock"]:
+        pending = _PERMALINKS["pending"]
+        for oid in [k for k, v in pending.items() if v["not_before"] <= now and (user or v.get("page_token"))]:
+            ent = pending.pop(oid)
+            if ent["single"]:
+                batches.append((user, {oid: ent}))
+            else:
+                groups.setdefault(user or ent["page_token"], {})[oid] = ent
+        if pending:
+            _PERMALINKS["wake"].set()
+    for key, ents in groups.items():
+        keys = list(ents)
+        for i in range(0, len(keys), GRAPH_MAX_IDS):
+            batches.append((user, {k: ents[k] for k in keys[i:i + GRAPH_MAX_IDS]}))
+    return batches
+
+def _permalink_resolver_loop():
+    _LANE_CV.set("background")
+    while True:
+        _PERMALINKS["wake"].wait(PERMALINK_BATCH_WINDOW * 5)
+        _PERMALINKS["wake"].clear()
+        pytime.sleep(PERMALINK_BATCH_WINDOW)  # let publishes that finish close together share one read
+        for user, batch in _permalink_batches(pytime.time()):
+            try:
+                _resolve_permalink_batch(batch, user)
+            except Exception:
+                with _PERMALINKS["lock"]:
+                    _PERMALINKS["pending"].update(batch)
+
+def _permalink_reload():
+    """Re-queue ids left pending by a previous process (with the page's current token)."""
+    rows = _db().execute("SELECT object_id, page_id, attempts FROM permalinks WHERE status='pending'").fetchall()
+    tokens = {pid: _background_page_token(pid) for pid in {r["page_id"] for r in rows}}
+    with _PERMALINKS["lock"]:
+        for r in rows:
+            _PERMALINKS["pending"].setdefault(r["object_id"], {
+                "page_id": r["page_id"], "page_token": tokens.get(r["page_id"]), "attempts": int(r["attempts"]),
+                "not_before": 0.0, "single": False})
+
+def _ensure_permalink_resolver():
+    if not JOB_WORKERS_ENABLED or _PERMALINKS["pid"] == os.getpid():
+        return
+    with _JOB_STATE["lock"]:
+        if _PERMALINKS["pid"] == os.getpid():
+            return
+        _PERMALINKS["pending"], _PERMALINKS["lock"], _PERMALINKS["wake"] = {}, threading.Lock(), threading.Event()
+        _PERMALINKS["pid"] = os.getpid()
+        try: _permalink_reload()
+        except Exception: pass
+        threading.Thread(target=_permalink_resolver_loop, name="permalinks", daemon=True).start()
+        _PERMALINKS["wake"].set()
+
+# ----------------------------
+# Publish ledger: one durable row per publish job (page, kind, content hash, post id, permalink, campaign)
+# ----------------------------
+LEDGER_DUPLICATE_WINDOW_SEC = int(os.environ.get("LEDGER_DUPLICATE_WINDOW_SEC", str(7 * 86400)))
+LEDGER_PAGE_LIMIT = 500
+
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS publish_ledger (
+        job_id TEXT PRIMARY KEY,
+        page_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        campaign_id TEXT,
+        status TEXT NOT NULL,
+        post_id TEXT,
+        permalink_url TEXT,
+        error TEXT,
+        created REAL NOT NULL,
+        published_at REAL,
+        updated REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS ledger_page ON publish_ledger(page_id, created)",
+    "CREATE INDEX IF NOT EXISTS ledger_hash ON publish_ledger(content_hash, page_id, kind, created)",
+    "CREATE INDEX IF NOT EXISTS ledger_time ON publish_ledger(created)",
+    "CREATE INDEX IF NOT EXISTS ledger_campaign ON publish_ledger(campaign_id, page_id, status)",
+    "CREATE INDEX IF NOT EXISTS ledger_post ON publish_ledger(post_id)",
+]
+
+def _publish_text(p: Dict[str, Any]) -> str:
+    return p.get("message") or p.get("caption") or p.get("description") or ""
+
+def _ledger_hash(text: str, digest: Optional[str] = None) -> str:
+    """Content hash of a post: the text alone, or the text plus the sha256 of the attached file."""
+    return _hash_content(f"{(text or '').strip()}\n{digest}") if digest else _hash_content(text)
+
+def _publish_hash(p: Dict[str, Any]) -> str:
+    return _ledger_hash(_publish_text(p), (p.get("file") or {}).get("sha256"))
+
+def ledger_claim(page_id: str, kind: str, text: str, campaign_id: Optional[str] = None,
+                 check_duplicate: bool = True, digest: Optional[str] = None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Reserve a ledger row for a publish job about to be queued: returns (job_id, None), or (None, previous row)
+    when the same non-empty content (text, plus the file `digest` for media) is already queued/published on this
+    page within LEDGER_DUPLICATE_WINDOW_SEC.
+    """
+    now, h = pytime.time(), _ledger_hash(text, digest)
+    job_id = os.urandom(8).hex()
+    insert = ("INSERT INTO publish_ledger(job_id, page_id, kind, content_hash, campaign_id, status, created, updated) "
+              "VALUES (?,?,?,?,?,'queued',?,?)", (job_id, page_id, kind, h, campaign_id, now, now))
+    conn = _db()
+    if not check_duplicate or not ((text or "").strip() or digest):
+        conn.execute(*insert)  # no transaction of its own: the scheduler calls this inside one
+        return job_id, None
+    conn.execute("BEGIN IMMEDIATE")  # check + insert as one step, so two quick submits cannot both pass
+    try:
+        prev = conn.execute(
+            "SELECT job_id, status, post_id, permalink_url, campaign_id, created, published_at FROM publish_ledger "
+            "WHERE content_hash=? AND page_id=? AND kind=? AND created > ? AND status NOT IN ('failed','cancelled') "
+            "ORDER BY created DESC LIMIT 1",
+            (h, page_id, kind, now - LEDGER_DUPLICATE_WINDOW_SEC)).fetchone()
+        if prev:
+            conn.execute("ROLLBACK")
+            return None, dict(prev)
+        conn.execute(*insert)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job_id, None
+
+def _ledger_published(p: Dict[str, Any], kind: str, post_id: str):
+    now = pytime.time()
+    # upsert: jobs queued before the ledger existed (or by other callers) still get their row
+    _db().execute(
+        "INSERT INTO publish_ledger(job_id, page_id, kind, content_hash, campaign_id, status, post_id, created, published_at, updated) "
+        "VALUES (?,?,?,?,?,'published',?,?,?,?) ON CONFLICT(job_id) DO UPDATE SET "
+        "status='published', post_id=excluded.post_id, published_at=excluded.published_at, error=NULL, updated=excluded.updated",
+        (p.get("_job_id") or os.urandom(8).hex(), p["page_id"], kind, _publish_hash(p), p.get("campaign_id"),
+         post_id, now, now, now))
+
+def _ledger_failed(job_id: str, error: Optional[str]):
+    # an unknown outcome may be live on the page: it still counts for duplicate checks and campaign resume
+    status = "unknown" if error == "UNKNOWN_OUTCOME" else "failed"
+    _db().execute("UPDATE publish_ledger SET status=?, error=?, updated=? WHERE job_id=? AND status='queued'",
+                  (status, (error or "")[:300], pytime.time(), job_id))
+
+def _ledger_cancel(job_id: str):
+    """Release the claim of a job that was cancelled or never got queued, so the content can be posted again."""
+    _db().execute("UPDATE publish_ledger SET status='cancelled', updated=? WHERE job_id=? AND status='queued'",
+                  (pytime.time(), job_id))
+
+def _enqueue_publish(job_type: str, kind: str, payload: Dict[str, Any], dup_error: Optional[str] = None):
+    """
+    Claim the ledger row for `payload` (duplicate-checked when `dup_error` is given) and queue the job under the
+    claimed id; a duplicate drops the staged file, and a failed enqueue cancels the claim before re-raising.
+    """
+    job_id, dup = ledger_claim(payload["page_id"], kind, _publish_text(payload), payload.get("campaign_id"),
+                               check_duplicate=dup_error is not None, digest=(payload.get("file") or {}).get("sha256"))
+    if dup:
+        _discard_staged(payload)
+        return _duplicate_response(dup_error, dup)
+    try:
+        return _job_accepted(enqueue_job(job_type, payload, job_id=job_id))
+    except Exception:
+        _ledger_cancel(job_id)
+        _discard_staged(payload)
+        raise
+
+@app.route("/api/ledger")
+def api_ledger():
+    """
+    Audit query over published content: ?page_id= &campaign_id= &status= &kind= &hash= (or &content= [&digest= of
+    the file] to hash it here)
+    &since= &until= (unix ts, on created) &limit= &before= &before_id= (created and job_id of the last row, for the
+    next page; rows sharing a created value are ordered by job_id).
+    """
+    where, args = ["1=1"], []
+    for col in ("page_id", "campaign_id", "status", "kind", "post_id"):
+        if request.args.get(col):
+            where.append(f"{col}=?"); args.append(request.args[col])
+    h = request.args.get("hash") or (_ledger_hash(request.args["content"], request.args.get("digest"))
+                                     if request.args.get("content") else None)
+    if h:
+        where.append("content_hash=?"); args.append(h)
+    try:
+        for arg, cond in (("since", "created >= ?"), ("until", "created < ?")):
+            if request.args.get(arg):
+                where.append(cond); args.append(float(request.args[arg]))
+        if request.args.get("before"):
+            before = float(request.args["before"])
+            if request.args.get("before_id"):
+                where.append("(created < ? OR (created = ? AND job_id < ?))"); args += [before, before, request.args["before_id"]]
+            else:
+                where.append("created < ?"); args.append(before)
+        limit = max(1, min(LEDGER_PAGE_LIMIT, int(request.args.get("limit", 100))))
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    rows = [dict(r) for r in _db().execute(
+        f"SELECT * FROM publish_ledger WHERE {' AND '.join(where)} ORDER BY created DESC, job_id DESC LIMIT ?", (*args, limit))]
+    more = len(rows) == limit
+    return _json_response({"data": rows, "before": rows[-1]["created"] if more else None,
+                           "before_id": rows[-1]["job_id"] if more else None})
+
+@app.route("/api/ledger/campaigns/<campaign_id>")
+def api_ledger_campaign(campaign_id):
+    """Per-page state of one campaign; with ?page_ids=a,b,c also the pages that still need publishing (resume)."""
+    rows = _db().execute("SELECT page_id, status, job_id, post_id, permalink_url, error, created, published_at FROM publish_ledger "
+                         "WHERE campaign_id=? ORDER BY created", (campaign_id,)).fetchall()
+    pages: Dict[str, Dict[str, Any]] = {}
+    rank = {"cancelled": 0, "failed": 0, "unknown": 1, "queued": 2, "published": 3}
+    for r in rows:
+        cur = pages.get(r["page_id"])
+        if cur is None or rank.get(r["status"], 0) >= rank.get(cur["status"], 0):
+            pages[r["page_id"]] = dict(r)
+    counts: Dict[str, int] = {}
+    for v in pages.values():
+        counts[v["status"]] = counts.get(v["status"], 0) + 1
+    out: Dict[str, Any] = {"campaign_id": campaign_id, "counts": counts, "pages": pages}
+    wanted = [x.strip() for x in (request.args.get("page_ids") or "").split(",") if x.strip()]
+    if wanted:
+        out["remaining"] = [pid for pid in wanted if (pages.get(pid) or {}).get("status") not in ("queued", "published", "unknown")]
+    return _json_response(out)
+
+# ----------------------------
+# Webhook event log: append-only segment files (read through mmap) + SQLite offset index by page and time
+# ----------------------------
+try:
+    import fcntl
+except ImportError:  # no cross-process append lock; single worker only
+    fcntl = None
+
+EVENT_LOG_DIR = os.path.join(DATA_DIR, "events")
+EVENT_SEGMENT_BYTES = int(os.environ.get("EVENT_SEGMENT_BYTES", str(64 << 20)))
+EVENT_RETENTION_BYTES = int(os.environ.get("EVENT_RETENTION_BYTES", str(1 << 30)))
+EVENT_RETENTION_DAYS = float(os.environ.get("EVENT_RETENTION_DAYS", "14"))
+EVENT_LOG_FSYNC = os.environ.get("EVENT_LOG_FSYNC", "0") == "1"
+EVENT_CONSUMER_BATCH = 200
+EVENT_CONSUMER_LEASE_SEC = 60
+
+# record = header + JSON {"page_id", "data"}; offsets are byte positions in the concatenated log, and a
+# segment is named after the offset of its first byte, so offset -> segment is a bisect over file names
+_EVENT_HDR = struct.Struct(">IdI")  # payload length, unix ts, crc32(payload)
+_DB_SCHEMA += [
+    "CREATE TABLE IF NOT EXISTS event_index (offset INTEGER PRIMARY KEY, page_id TEXT, ts REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS event_index_page ON event_index(page_id, offset)",
+    "CREATE INDEX IF NOT EXISTS event_index_ts ON event_index(ts)",
+    """CREATE TABLE IF NOT EXISTS event_cursors (
+        name TEXT PRIMARY KEY, offset INTEGER NOT NULL DEFAULT 0, locked_by TEXT, locked_at REAL, updated REAL)""",
+]
+_EVENT_LOG: Dict[str, Any] = {"lock": threading.Lock(), "maps_lock": threading.Lock(), "maps": {},
+                              "retention_ts": 0.0, "pid": None, "wake": threading.Event()}
+EVENT_CONSUMERS: Dict[str, Any] = {}
+
+def _segment_path(base: int) -> str:
+    return os.path.join(EVENT_LOG_DIR, f"{base:020d}.log")
+
+def _segments() -> List[int]:
+    try:
+        names = os.listdir(EVENT_LOG_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(int(n[:-4]) for n in names if n.endswith(".log") and n[:-4].isdigit())
+
+def event_log_head() -> int:
+    """Offset the next record will get."""
+    segs = _segments()
+    if not segs:
+        return 0
+    try: return segs[-1] + os.path.getsize(_segment_path(segs[-1]))
+    except OSError: return segs[-1]
+
+@contextmanager
+def _event_log_locked():
+    # appends from every thread and (through flock) every worker process are serialized
+    with _EVENT_LOG["lock"]:
+        os.makedirs(EVENT_LOG_DIR, exist_ok=True)
+        fd = os.open(os.path.join(EVENT_LOG_DIR, ".lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            if fcntl is not None: fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+def event_log_append(records: List[Tuple[Optional[str], Any]]) -> List[int]:
+    """Append (page_id, payload) records in one write; returns their offsets."""
+    if not records:
+        return []
+    now, rows, buf = pytime.time(), [], bytearray()
+    with _event_log_locked():
+        segs = _segments()
+        base = segs[-1] if segs else 0
+        size = os.path.getsize(_segment_path(base)) if segs else 0
+        if size >= EVENT_SEGMENT_BYTES:
+            base, size = base + size, 0
+        for page_id, payload in records:
+            body = json.dumps({"page_id": page_id, "data": payload}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            rows.append((base + size + len(buf), page_id, now))
+            buf += _EVENT_HDR.pack(len(body), now, zlib.crc32(body)) + body
+        fd = os.open(_segment_path(base), os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, bytes(buf))
+            if EVENT_LOG_FSYNC: os.fsync(fd)
+        finally:
+            os.close(fd)
+        _db().executemany("INSERT OR REPLACE INTO event_index(offset,page_id,ts) VALUES (?,?,?)", rows)
+    if now - _EVENT_LOG["retention_ts"] > 3600 or size == 0:
+        _event_log_retention()
+    _EVENT_LOG["wake"].set()
+    return [r[0] for r in rows]
+
+def _segment_map(base: int, need: int) -> Optional[mmap.mmap]:
+    """Read-only map of a segment, remapped when the active segment has grown past what is mapped."""
+    m = _EVENT_LOG["maps"].get(base)
+    if m is not None and len(m) >= need:
+        return m
+    try:
+        with open(_segment_path(base), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            fresh = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if m is not None: m.close()
+    _EVENT_LOG["maps"][base] = fresh
+    return fresh
+
+def _event_read_at(offset: int, segs: List[int]) -> Optional[Tuple[Dict[str, Any], int]]:
+    i = bisect_right(segs, offset) - 1
+    if i < 0:
+        return None
+    base, pos, hs = segs[i], offset - segs[i], _EVENT_HDR.size
+    with _EVENT_LOG["maps_lock"]:
+        m = _segment_map(base, pos + hs)
+        if m is None or len(m) < pos + hs:
+            return None
+        length, ts, crc = _EVENT_HDR.unpack_from(m, pos)
+        m = _segment_map(base, pos + hs + length)
+        if m is None or len(m) < pos + hs + length:
+            return None  # record still being written
+        body = m[pos + hs:pos + hs + length]
+    if zlib.crc32(body) != crc:
+        return None
+    rec = json.loads(body)
+    return {"offset": offset, "ts": ts, "page_id": rec.get("page_id"), "data": rec.get("data")}, offset + hs + length
+
+def event_log_read(offset: int = 0, limit: int = 100, page_id: Optional[str] = None,
+                   since: Optional[float] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """Records at or after `offset` (optionally one page's / newer than `since`) and the offset to continue from."""
+    segs = _segments()
+    if not segs:
+        return [], offset
+    offset = max(offset, segs[0])  # older segments are gone to retention
+    out: List[Dict[str, Any]] = []
+    if page_id is None and since is None:
+        while len(out) < limit:
+            got = _event_read_at(offset, segs)
+            if got is None:
+                nxt = [b for b in segs if b > offset]
+                if not nxt:
+                    break  # end of the log (or a record still being written)
+                offset = nxt[0]  # torn tail of a sealed segment: resume in the next one
+                continue
+            out.append(got[0]); offset = got[1]
+        return out, offset
+    q, args = "SELECT offset FROM event_index WHERE offset >= ?", [offset]
+    if page_id is not None: q += " AND page_id=?"; args.append(str(page_id))
+    if since is not None: q += " AND ts >= ?"; args.append(float(since))
+    for row in _db().execute(q + " ORDER BY offset LIMIT ?", (*args, int(limit))).fetchall():
+        got = _event_read_at(int(row["offset"]), segs)
+        if got is None: break
+        out.append(got[0]); offset = got[1]
+    return out, offset
+
+def event_log_tail(n: int = 20) -> List[Dict[str, Any]]:
+    segs = _segments()
+    rows = _db().execute("SELECT offset FROM event_index ORDER BY offset DESC LIMIT ?", (int(n),)).fetchall()
+    return [got[0] for got in (_event_read_at(int(r["offset"]), segs) for r in reversed(rows)) if got]
+
+def _event_log_retention():
+    """Drop whole sealed segments, oldest first, while over EVENT_RETENTION_BYTES or older than EVENT_RETENTION_DAYS."""
+    _EVENT_LOG["retention_ts"] = pytime.time()
+    with _event_log_locked():
+        segs = _segments()
+        if len(segs) < 2:
+            return
+        sizes = {b: os.path.getsize(_segment_path(b)) for b in segs}
+        total, cutoff, drop = sum(sizes.values()), pytime.time() - EVENT_RETENTION_DAYS * 86400, []
+        for b in segs[:-1]:
+            if total <= EVENT_RETENTION_BYTES and os.path.getmtime(_segment_path(b)) >= cutoff:
+                break
+            drop.append(b); total -= sizes[b]
+        if not drop:
+            return
+        with _EVENT_LOG["maps_lock"]:
+            for b in drop:
+                m = _EVENT_LOG["maps"].pop(b, None)
+                if m is not None: m.close()
+                try: os.remove(_segment_path(b))
+                except OSError: pass
+        _db().execute("DELETE FROM event_index WHERE offset < ?", (segs[len(drop)],))
+
+def event_consumer(name: str):
+    """Register fn(records) fed every logged event in order; its position is kept in event_cursors and survives restarts."""
+    def deco(fn):
+        EVENT_CONSUMERS[name] = fn
+        return fn
+    return deco
+
+def _drive_consumer(name: str, fn) -> bool:
+    """Feed one batch to `name` if this process holds its lease; True when it made progress."""
+    me, now, conn = f"{os.getpid()}", pytime.time(), _db()
+    # a new consumer starts at the head; use the replay endpoint to feed it history
+    conn.execute("INSERT OR IGNORE INTO event_cursors(name, offset, updated) VALUES (?,?,?)", (name, event_log_head(), now))
+    got = conn.execute(
+        "UPDATE event_cursors SET locked_by=?, locked_at=? WHERE name=? AND (locked_by IS NULL OR locked_by=? OR locked_at < ?)",
+        (me, now, name, me, now - EVENT_CONSUMER_LEASE_SEC)).rowcount
+    if not got:
+        return False
+    row = conn.execute("SELECT offset FROM event_cursors WHERE name=?", (name,)).fetchone()
+    recs, nxt = event_log_read(int(row["offset"]), EVENT_CONSUMER_BATCH)
+    if recs:
+        with graph_lane("background"):
+            fn(recs)
+    conn.execute("UPDATE event_cursors SET offset=?, updated=? WHERE name=? AND locked_by=?", (nxt, pytime.time(), name, me))
+    return bool(recs)
+
+def _event_consumer_loop():
+    while True:
+        _EVENT_LOG["wake"].wait(5)
+        _EVENT_LOG["wake"].clear()
+        for name, fn in list(EVENT_CONSUMERS.items()):
+            try:
+                while _drive_consumer(name, fn):
+                    pass
+            except Exception:
+                pass  # the cursor did not move; the batch is retried on the next pass
+
+def _ensure_event_consumers():
+    if not JOB_WORKERS_ENABLED or not EVENT_CONSUMERS or _EVENT_LOG["pid"] == os.getpid():
+        return
+    with _JOB_STATE["lock"]:
+        if _EVENT_LOG["pid"] == os.getpid():
+            return
+        _EVENT_LOG.update(pid=os.getpid(), wake=threading.Event())
+        threading.Thread(target=_event_consumer_loop, name="event-consumers", daemon=True).start()
+        _EVENT_LOG["wake"].set()
+
+def _start_background():
+    """Job workers, scheduler, permalink resolver and event consumers; each starts once per process."""
+    _ensure_job_workers()
+    _ensure_scheduler()
+    _ensure_permalink_resolver()
+    _ensure_event_consumers()
+
+@app.before_request
+def _start_job_workers():
+    _start_background()
+
+# ----------------------------
+# UI
+# ----------------------------
+INDEX_HTML = r"""<!DOCTYPE html>
+<html lang="vi">
+<head>
+  <meta charset="utf-8"/>
+  <meta name="viewport" content="width=device-width,initial-scale=1"/>
+  <title>Thang 5 chi (Completed)</title>
+  <style>
+
+    :root{
+      --bg:#f6f7f9;
+      --card-bg:#ffffff;
+      --text:#222;
+      --muted:#6b7280;
+      --border:#e6e8eb;
+      --primary:#1976d2;
+      --radius:12px;
+      --shadow:0 6px 18px rgba(10,10,10,.06);
+    }
+    *{box-sizing:border-box}
+    html,body{height:100%}
+    body{
+      font-family:system-ui,Segoe UI,Arial,sans-serif;
+      margin:0;
+      background:var(--bg);
+      color:var(--text);
+    }
+    .container{
+      max-width:1100px;
+      margin:18px auto;
+      padding:0 16px;
+    }
+    h1{margin:0 0 12px;font-size:22px}
+    h3{margin:0 0 8px;font-size:16px}
+    .tabs{
+      position:sticky; top:0; z-index:10;
+      display:flex; gap:8px; padding:8px 0; background:var(--bg);
+      border-bottom:1px solid var(--border);
+    }
+    .tabs button{
+      padding:8px 12px; border:1px solid var(--border);
+      border-radius:999px; background:#fff; cursor:pointer;
+      font-size:13px; line-height:1;
+    }
+    .tabs button.active{background:var(--primary);color:#fff;border-color:var(--primary)}
+    .panel{display:none}
+    .panel.active{display:block}
+    .row{display:flex;gap:12px;flex-wrap:wrap}
+    .col{flex:1 1 420px;min-width:320px}
+    textarea,input,select{
+      width:100%; padding:9px 10px; border:1px solid var(--border);
+      border-radius:10px; background:var(--card-bg);
+      font-size:14px; outline:none;
+    }
+    textarea{resize:vertical}
+    input[type="file"]{padding:6px}
+    .card{
+      border:1px solid var(--border);
+      background:var(--card-bg);
+      border-radius:var(--radius);
+      padding:12px;
+      box-shadow:var(--shadow);
+    }
+    .list{
+      padding:4px; max-height:320px; overflow:auto; background:#fafafa;
+      border-radius:10px; border:1px dashed var(--border);
+      overscroll-behavior:contain;
+    }
+    /* chat bubbles */
+    .msg{display:flex;margin:6px 0}
+    .msg.me{justify-content:flex-end}
+    .bubble{max-width:78%;padding:9px 11px;border-radius:16px;line-height:1.4;word-break:break-word;white-space:pre-wrap}
+    .me .bubble{background:#e7f3ff;border:1px solid #cfe7ff}
+    .other .bubble{background:#f5f5f5;border:1px solid #ebebeb}
+    .meta{font-size:12px;color:#666;margin-top:4px}
+    .conv-item{padding:8px 10px;display:flex;align-items:center;gap:8px}
+    .conv-item + .conv-item{border-top:1px dashed var(--border)}
+    .conv-title{flex:1 1 auto;overflow:hidden;text-overflow:ellipsis;white-space:nowrap}
+    .dot{min-width:10px;width:10px;height:10px;border-radius:50%}
+    .dot.red{background:#e53935}
+    .dot.green{background:#43a047}
+    .status{margin-top:6px;font-size:12px;color:var(--muted);word-break:break-word}
+    .item{padding:6px 8px;border-bottom:1px dashed var(--border); background:transparent}
+    .item:last-child{border-bottom:none}
+    .muted{color:var(--muted)}
+    .btn{
+      padding:8px 12px;border:1px solid var(--border);border-radius:10px;background:#fff;cursor:pointer;
+      font-size:13px;
+    }
+    .btn.primary{background:var(--primary);color:#fff;border-color:var(--primary)}
+    .grid{display:grid;gap:8px;grid-template-columns:repeat(2,minmax(220px,1fr))}
+    .toolbar{display:flex;gap:8px;flex-wrap:wrap}
+    a{color:var(--primary);text-decoration:none}
+    a:hover{text-decoration:underline}
+    .pin-overlay{position:fixed;inset:0;background:rgba(250,250,252,.96);display:none;align-items:center;justify-content:center;z-index:9999}
+    .pin-box{border:1px solid var(--border);border-radius:16px;padding:18px;min-width:300px;background:#fff;box-shadow:var(--shadow)}
+    @media (max-width: 768px){
+      .col{min-width:100%}
+      .grid{grid-template-columns:1fr}
+      .list{max-height:260px}
+      h1{font-size:18px}
+    }
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+/* ===== Fanpage list: 1 dòng, checkbox sát mép phải ===== */
+.list .item {
+  display: flex;
+  align-items: center;
+  justify-content: space-between;
+  padding: 6px 10px;
+  border-bottom: 1px solid #eee;
+  white-space: nowrap;          /* không xuống dòng */
+  overflow: hidden;
+}
+
+.list .item label {
+  display: flex;
+  align-items: center;
+  justify-content: space-between;
+  width: 100%;
+}
+
+.list .item .page-name{
+  flex: 1 1 auto;
+  min-width: 0;                /* allow text to shrink instead of pushing */
+  color: inherit;
+  text-align: left;
+  overflow: hidden;
+  text-overflow: ellipsis;
+  white-space: nowrap;
+}
+
+.list .item input[type="checkbox"]{
+  flex-shrink: 0 !important;
   width: 18px !important;
   height: 18px !important;
   display: inline-block !important;
@@ -491,873 +2328,2923 @@ INDEX_HTML = r"""<!DOCTYPE html>
   margin-right: 4px;
   align-self: center;
 }
-</style>
-</head>
-<body>
-  <div class="container">
-  <h1>Bản quyền AKUTA (2025)</h1>
-  <div class="tabs">
-    <button id="tab-posts" class="active">Đăng bài</button>
-    <button id="tab-inbox">Tin nhắn</button>
-        <button id="tab-page-info">Page info</button>
+</style>
+</head>
+<body>
+  <div class="container">
+  <h1>Bản quyền AKUTA (2025)</h1>
+  <div class="tabs">
+    <button id="tab-posts" class="active">Đăng bài</button>
+    <button id="tab-inbox">Tin nhắn</button>
+        <button id="tab-page-info">Page info</button>
+  </div>
+
+  <div id="panel-posts" class="panel active">
+    <div class="row">
+      <div class="col">
+        <div class="card">
+          <h3>Fanpage</h3>
+          <div class="list" id="pages"></div>
+          <div class="status" id="pages_status" ></div>
+        </div>
+        <div class="card" style="margin-top:12px">
+          <h3>AI soạn nội dung</h3>
+          <textarea id="ai_prompt" rows="4" placeholder="Gợi ý chủ đề, ưu đãi, CTA..."></textarea>
+          <div class="grid">
+            <input id="ai_keyword" placeholder="Từ khoá chính (VD: MB66)"/>
+            <input id="ai_link" placeholder="Link chính thức (VD: https://...)"/>
+          </div>
+          <div class="grid">
+            <select id="ai_tone">
+              <option value="thân thiện">Giọng: Thân thiện</option>
+              <option value="chuyên nghiệp">Chuyên nghiệp</option>
+              <option value="hài hước">Hài hước</option>
+            </select>
+            <select id="ai_length">
+              <option value="ngắn">Ngắn</option>
+              <option value="vừa">Vừa</option>
+              <option value="dài">Dài</option>
+            </select>
+          </div>
+          <div class="toolbar" style="margin-top:8px">
+            <button class="btn" id="btn_ai">Tạo nội dung</button>
+            <span class="muted">Cần OPENAI_API_KEY</span>
+          </div>
+          <div class="status" id="ai_status"></div>
+        </div>
+      </div>
+      <div class="col">
+        <div class="card">
+          <h3>Đăng nội dung</h3>
+          <textarea id="post_text" rows="6" placeholder="Nội dung bài viết..."></textarea>
+          <div class="grid" style="margin-top:8px">
+            <div>
+              <label>Loại đăng</label>
+              <select id="post_type">
+                <option value="feed">Feed</option>
+                <option value="reels">Reels</option>
+              </select>
+            </div>
+            <div>
+              <label>Video</label>
+              <input type="file" id="video_input" accept="video/*"/>
+            </div>
+          </div>
+          <div class="grid" style="margin-top:8px">
+            <input type="file" id="photo_input" accept="image/*"/>
+            <input type="text" id="media_caption" placeholder="Caption (tuỳ chọn)"/>
+          </div>
+          <div class="toolbar" style="margin-top:8px">
+            <button class="btn primary" id="btn_publish">Đăng</button>
+            <input type="datetime-local" id="post_at" style="width:auto" title="Hẹn giờ đăng (để trống = đăng ngay)"/>
+          </div>
+          <div class="status" id="post_status"></div>
+        </div>
+      </div>
+    </div>
+  </div>
+
+  <div id="panel-inbox" class="panel">
+    <div class="row">
+      <div class="col">
+        <h3>Chọn Page</h3>
+        <select id="inbox_page"></select>
+        <button class="btn" id="btn_load_conv" style="margin-top:8px">Tải hội thoại</button>
+        <button class="btn" id="btn_load_all_conv" style="margin-top:8px">Tất cả page</button>
+        <div class="list" id="conv_list" style="margin-top:8px"></div>
+        <button class="btn" id="btn_more_conv" style="margin-top:8px;display:none">Xem thêm</button>
+      </div>
+      <div class="col">
+        <h3>Hội thoại</h3>
+        <div class="list" id="msg_list" style="min-height:280px"></div>
+        <div class="toolbar" style="margin-top:8px">
+          <input id="msg_text" placeholder="Nhập tin nhắn..."/>
+          <button class="btn primary" id="btn_send">Gửi</button>
+        </div>
+        <div class="status" id="inbox_status"></div>
+      </div>
+    </div>
+  </div>
+          <div class="grid" style="margin-top:8px">
+            <input id="cfg_short_token" placeholder="User short-lived token"/>
+          </div>
+          <div class="toolbar" style="margin-top:8px">
+            <button class="btn" id="btn_save_cfg">Lưu cấu hình</button>
+            <button class="btn primary" id="btn_exchange">Đổi token dài & lưu</button>
+          </div>
+          <div class="status" id="cfg_status"></div>
+        </div>
+      </div>
+      <div class="col">
+        <div class="card">
+          <h3>Diagnostics</h3>
+          <button class="btn" id="btn_diag">Chạy kiểm tra</button>
+          <pre id="diag_out" class="list" style="white-space:pre-wrap"></pre>
+        </div>
+      </div>
+    </div>
+  </div>
+
+  <div id="panel-page-info" class="panel">
+    <div class="row">
+      <div class="col">
+        <div class="card">
+          <h3>Chọn Page</h3>
+          <select id="info_page"></select>
+          <button class="btn" id="btn_load_info" style="margin-top:8px">Tải thông tin</button>
+        </div>
+        <div class="card" style="margin-top:12px">
+          <h3>Kiểm tra tất cả Page</h3>
+          <button class="btn" id="btn_snapshot">Chụp snapshot & so sánh</button>
+          <div class="status" id="snapshot_status"></div>
+        </div>
+        <div class="card" style="margin-top:12px">
+          <h3>Thông tin cơ bản</h3>
+          <div class="grid">
+            <input id="pg_name" placeholder="Tên Page"/>
+            <input id="pg_phone" placeholder="Số điện thoại"/>
+            <input id="pg_website" placeholder="Website"/>
+            <input id="pg_desc" placeholder="Mô tả (description)"/>
+          </div>
+          <div class="grid" style="margin-top:8px">
+            <input id="addr_street" placeholder="Địa chỉ (street)"/>
+            <input id="addr_city" placeholder="Thành phố"/>
+            <input id="addr_zip" placeholder="Mã bưu chính"/>
+            <input id="addr_country" placeholder="Quốc gia (VN, US...)"/>
+          </div>
+          <label style="display:flex;gap:6px;align-items:center;margin-top:8px">
+            <input type="checkbox" id="always_open"/> Luôn mở cửa
+          </label>
+          <div class="toolbar" style="margin-top:8px">
+            <button class="btn primary" id="btn_save_info">Lưu thay đổi</button>
+          </div>
+          <div class="status" id="info_status"></div>
+        </div>
+      </div>
+      <div class="col">
+        <div class="card">
+          <h3>Ảnh đại diện & Ảnh bìa</h3>
+          <div class="grid">
+            <div>
+              <label>Ảnh đại diện</label>
+              <input type="file" id="pic_avatar" accept="image/*"/>
+              <button class="btn" id="btn_set_avatar" style="margin-top:6px">Đổi avatar</button>
+            </div>
+            <div>
+              <label>Ảnh bìa</label>
+              <input type="file" id="pic_cover" accept="image/*"/>
+              <button class="btn" id="btn_set_cover" style="margin-top:6px">Đổi cover</button>
+            </div>
+          </div>
+          <div class="status" id="pic_status"></div>
+        </div>
+      </div>
+    </div>
+  </div>
+
+  <div class="pin-overlay" id="pin_overlay">
+    <div class="pin-box">
+      <h3>Nhập mã PIN để truy cập</h3>
+      <input id="pin_input" placeholder="Nhập PIN" type="password" style="margin-top:8px"/>
+      <div class="toolbar" style="margin-top:8px">
+        <button class="btn primary" id="btn_pin_ok">Xác nhận</button>
+      </div>
+      <div class="status" id="pin_status"></div>
+    </div>
+  </div>
+
+<script>
+const $ = sel => document.querySelector(sel);
+const sleep = (ms) => new Promise(res => setTimeout(res, ms));
+
+// Long operations are queued server-side (202 + job_id); poll until the job settles
+async function waitJob(d, onTick){
+  if(!d || !d.job_id) return d;
+  for(let i=0;;i++){
+    await sleep(i < 10 ? 1000 : 3000);
+    try{
+      const r = await fetch('/api/jobs/'+d.job_id);
+      const j = await r.json();
+      if(j.status === 'done') return j.result || {};
+      if(j.status === 'failed' || j.status === 'cancelled') return Object.assign({error: j.error || j.status}, j.result || {});
+      if(onTick) onTick(j);
+    }catch(e){}
+  }
+}
+
+async function ensurePin(){
+  try{
+    const r = await fetch('/api/pin/status');
+    const d = await r.json();
+    if(d.need_pin && !d.ok){
+      $('#pin_overlay').style.display = 'flex';
+    }
+  }catch(e){}
+}
+$('#btn_pin_ok').onclick = async () => {
+  const pin = ($('#pin_input').value||'').trim();
+  const st = $('#pin_status');
+  if(!pin){ st.textContent='Nhập PIN trước'; return; }
+  const r = await fetch('/api/pin/login', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({pin})});
+  const d = await r.json();
+  if(d.ok){ $('#pin_overlay').style.display='none'; location.reload(); }
+  else{ st.textContent='PIN sai'; }
+};
+
+function showTab(name){
+  ['posts','inbox','settings','page-info'].forEach(n=>{
+    const id = n==='page-info' ? 'page-info' : n;
+    $('#tab-'+id).classList.toggle('active', id===name);
+    $('#panel-'+id).classList.toggle('active', id===name);
+  });
+}
+$('#tab-posts').onclick = ()=>showTab('posts');
+$('#tab-inbox').onclick = ()=>{ showTab('inbox'); loadPagesToSelect('inbox_page'); };
+$('#tab-page-info').onclick = ()=>{ showTab('page-info'); loadPagesToSelect('info_page'); };
+
+const pagesBox = $('#pages');
+const pagesStatus = $('#pages_status');
+
+async function loadPages(){
+  pagesBox.innerHTML = '<div class="muted">Đang tải...</div>';
+  try{
+    const r = await fetch('/api/pages');
+    const d = await r.json();
+    if(d.error){ pagesStatus.textContent = JSON.stringify(d); return; }
+        
+    const arr = d.data || [];
+// Sort pages by name (vi locale)
+    arr.sort((a,b)=> (a.name||'').localeCompare(b.name||'', 'vi', {sensitivity:'base'}));
+    pagesBox.innerHTML = arr.map(p => (
+      '<div class="item">'
+      + '<label>'
+      + '<span class="page-name">'+(p.name||'')+'</span>'
+      + '<input type="checkbox" class="pg" value="'+p.id+'" data-name="'+(p.name||'')+'">'
+      + '</label>'
+      + '</div>'
+    )).join('');
+    pagesStatus.textContent = 'Tải ' + arr.length + ' page.';
+  }catch(e){ pagesStatus.textContent = 'Lỗi tải danh sách page: ' + (e && (e.message||e.toString()) || ''); }
+}
+loadPages(); loadPagesToSelect('inbox_page'); ensurePin(); pollNewEvents();
+
+function selectedPageIds(){
+  return Array.from(document.querySelectorAll('.pg:checked')).map(i=>i.value);
+}
+
+async function loadPagesToSelect(selectId){
+  const sel = $('#'+selectId);
+  try{
+    const r = await fetch('/api/pages');
+    const d = await r.json();
+    if(d && d.error){
+      sel.innerHTML = '<option value="">(Lỗi: ' + String(d.error) + ')</option>';
+      const st = $('#inbox_status'); if(st){ st.textContent = 'Không tải được danh sách Page: ' + String(d.error); }
+      return;
+    }
+    const arr = (d && d.data) || [];
+    sel.innerHTML = '<option value="">--Chọn page--</option>' + arr.map(p=>'<option value="'+p.id+'">'+(p.name||p.id)+'</option>').join('');
+    const st = $('#inbox_status'); if(st){ st.textContent = 'Đã nạp ' + arr.length + ' page.'; }
+  }catch(e){
+    sel.innerHTML = '<option value="">(Không tải được)</option>';
+    const st = $('#inbox_status'); if(st){ st.textContent = 'Lỗi tải danh sách Page: ' + (e && (e.message||String(e)) || ''); }
+  }
+}
+
+// AI writer
+$('#btn_ai').onclick = async () => {
+  const prompt = ($('#ai_prompt').value||'').trim();
+  const tone = $('#ai_tone').value;
+  const length = $('#ai_length').value;
+  const keyword = ($('#ai_keyword').value||'MB66').trim();
+  const link = ($('#ai_link').value||'').trim();
+  const st = $('#ai_status');
+  if(!keyword){ st.textContent='Nhập từ khoá chính (VD: MB66)'; return; }
+  st.textContent = 'Đang tạo nội dung...';
+  try{
+    const r = await fetch('/api/ai/generate', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({prompt, tone, length, keyword, link})});
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    $('#post_text').value = d.text || '';
+    st.textContent = 'Đã chèn nội dung vào khung soạn.';
+  }catch(e){ st.textContent = 'Lỗi gọi AI'; }
+};
+
+// Permalinks are resolved in batches after publishing; fill them in as they arrive
+async function fillPermalinks(box){
+  for(let i=0; i<20; i++){
+    const rows = Array.from(box.querySelectorAll('[data-permalink]')).filter(el => el.dataset.permalink);
+    if(!rows.length) return;
+    await sleep(i < 5 ? 2000 : 6000);
+    try{
+      const r = await fetch('/api/permalinks?ids=' + encodeURIComponent(rows.map(el => el.dataset.permalink).join(',')));
+      const d = await r.json();
+      rows.forEach(el => {
+        const x = d[el.dataset.permalink];
+        if(!x || x.status === 'pending') return;
+        if(x.permalink_url) el.insertAdjacentHTML('beforeend', ' · <a target="_blank" href="'+x.permalink_url+'">Mở bài</a>');
+        el.dataset.permalink = '';
+      });
+    }catch(e){}
+  }
+}
+
+// Publish
+$('#btn_publish').onclick = async () => {
+  const pages = selectedPageIds();
+  const text = ($('#post_text').value||'').trim();
+  const type = $('#post_type').value;
+  const photo = $('#photo_input').files[0] || null;
+  const video = $('#video_input').files[0] || null;
+  const caption = ($('#media_caption').value||'');
+  const st = $('#post_status');
+
+  if(!pages.length){ st.textContent='Chọn ít nhất một page'; return; }
+  if(type === 'feed' && !text && !photo && !video){ st.textContent='Cần nội dung hoặc tệp'; return; }
+  if(type === 'reels' && !video){ st.textContent='Cần chọn video cho Reels'; return; }
+
+  // same content + type as the last click => same campaign, so a re-click only fills in the pages still missing
+  const sig = [type, text, caption, photo ? photo.name+photo.size : '', video ? video.name+video.size : ''].join('|');
+  let last = {};
+  try{ last = JSON.parse(localStorage.getItem('last_campaign')||'{}'); }catch(e){}
+  const campaign = last.sig === sig ? last.id : 'c' + Date.now().toString(36) + Math.random().toString(36).slice(2, 6);
+  localStorage.setItem('last_campaign', JSON.stringify({sig, id: campaign}));
+  const at = ($('#post_at').value||'').trim();
+  if(at){
+    const ts = Math.floor(new Date(at).getTime()/1000);
+    if(!ts){ st.textContent='Thời gian hẹn không hợp lệ'; return; }
+    const kind = type === 'reels' ? 'reel' : (video ? 'video' : (photo ? 'photo' : 'feed'));
+    let r;
+    if(kind === 'feed'){
+      r = await fetch('/api/schedule', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({type: kind, page_ids: pages, at: ts, message: text, campaign_id: campaign})});
+    }else{
+      const fd = new FormData();
+      fd.append('type', kind); fd.append('page_ids', pages.join(',')); fd.append('at', String(ts)); fd.append('campaign_id', campaign);
+      fd.append('file', kind === 'photo' ? photo : video);
+      fd.append(kind === 'photo' ? 'caption' : 'description', caption || text || '');
+      r = await fetch('/api/schedule', {method:'POST', body: fd});
+    }
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.innerHTML = (d.data||[]).map(x => '🕒 ' + x.page_id + ' · ' + new Date(x.fire_at*1000).toLocaleString()).join('<br/>')
+      + (d.errors||[]).map(x => '<br/>❌ ' + x.page_id + ': ' + x.error).join('');
+    return;
+  }
+
+  st.textContent='Đang đăng (có giãn cách an toàn)...';
+  try{
+    let todo = pages, skipped = [];
+    if(last.sig === sig){
+      const c = await (await fetch('/api/ledger/campaigns/'+encodeURIComponent(campaign)+'?page_ids='+pages.join(','))).json();
+      todo = c.remaining || pages;
+      skipped = pages.filter(p => !todo.includes(p)).map(p => {
+        const x = (c.pages||{})[p] || {};
+        const link = x.permalink_url ? ' · <a target="_blank" href="'+x.permalink_url+'">Mở bài</a>' : '';
+        return '<div>⏭ ' + p + ' (đã ' + (x.status === 'published' ? 'đăng' : 'xếp hàng') + ')' + link + '</div>';
+      });
+    }
+    // spintax / {{slot}} templates: one distinct variant per page, expanded server-side in one call.
+    // The template is the field that gets posted: the text for a plain feed post, else the caption (text as fallback).
+    const tpl = (type === 'feed' && !photo && !video) ? text : (caption || text);
+    let variants = null;
+    if(/\{\{[\w.-]+\}\}|\{[^{}]*\|[^{}]*\}/.test(tpl) && todo.length){
+      const v = await (await fetch('/api/templates/expand', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({template: tpl, page_ids: todo})})).json();
+      if(v.error){ st.textContent = v.error === 'UNBOUND_SLOTS' ? 'Thiếu giá trị cho: ' + (v.missing||[]).join(', ') : 'Lỗi: '+JSON.stringify(v); return; }
+      variants = v.variants || {};
+      (v.exhausted||[]).forEach(p => skipped.push('<div>❌ ' + p + ': hết biến thể chưa dùng</div>'));
+      todo = todo.filter(p => variants[p] !== undefined);
+    }
+    const queued = [];
+    for(const pid of todo){
+      const body_text = variants ? variants[pid] : (caption || text || '');
+      const msg_text = variants ? variants[pid] : text;
+      let d;
+      if(type === 'feed'){
+        if(video){
+          const fd = new FormData();
+          fd.append('video', video);
+          fd.append('description', body_text);
+          fd.append('campaign_id', campaign);
+          const r = await fetch('/api/pages/'+pid+'/video', {method:'POST', body: fd});
+          d = await r.json();
+        }else if(photo){
+          const fd = new FormData();
+          fd.append('photo', photo);
+          fd.append('caption', body_text);
+          fd.append('campaign_id', campaign);
+          const r = await fetch('/api/pages/'+pid+'/photo', {method:'POST', body: fd});
+          d = await r.json();
+        }else{
+          const r = await fetch('/api/pages/'+pid+'/post', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({message: msg_text, campaign_id: campaign})});
+          d = await r.json();
+        }
+      }else{
+        const fd = new FormData();
+        fd.append('video', video);
+        fd.append('description', body_text);
+        fd.append('campaign_id', campaign);
+        const r = await fetch('/api/pages/'+pid+'/reel', {method:'POST', body: fd});
+        d = await r.json();
+      }
+      queued.push({pid, d});
+    }
+    // the server spaces the actual Graph calls; here we only wait for every queued job
+    st.textContent = 'Đã xếp hàng ' + queued.length + ' page, đang xử lý...';
+    const results = await Promise.all(queued.map(async ({pid, d}) => {
+      if(!d.error) d = await waitJob(d);
+      if(d.error) return '<div>❌ ' + pid + ': ' + JSON.stringify(d) + '</div>';
+      const link = d.permalink_url ? ' · <a target="_blank" href="'+d.permalink_url+'">Mở bài</a>' : '';
+      return '<div data-permalink="'+(d.permalink_pending||'')+'">✅ ' + pid + link + '</div>';
+    }));
+    st.innerHTML = skipped.join('') + results.join('');
+    fillPermalinks(st);
+  }catch(e){ st.textContent='Lỗi đăng'; }
+};
+
+// Settings: save + exchange
+$('#btn_save_cfg').onclick = async () => {
+  const app_id = $('#cfg_app_id').value.trim();
+  const app_secret = $('#cfg_app_secret').value.trim();
+  const st = $('#cfg_status');
+  if(!app_id || !app_secret){ st.textContent='Nhập App ID & Secret'; return; }
+  try{
+    const r = await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.textContent='Đã lưu cấu hình.';
+  }catch(e){ st.textContent='Lỗi lưu cấu hình'; }
+};
+
+$('#btn_exchange').onclick = async () => {
+  const app_id = $('#cfg_app_id').value.trim();
+  const app_secret = $('#cfg_app_secret').value.trim();
+  const short = $('#cfg_short_token').value.trim();
+  const st = $('#cfg_status');
+  if(!app_id || !app_secret || !short){ st.textContent='Nhập App ID, Secret & short token'; return; }
+  try{
+    await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
+    const r = await fetch('/api/token/exchange', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({short_token: short})});
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.textContent='Đã đổi token dài và lưu vào tokens.json';
+  }catch(e){ st.textContent='Lỗi đổi token'; }
+};
+
+// Page info: load existing (best-effort)
+$('#btn_load_info').onclick = async () => {
+  const pid = $('#info_page').value;
+  const st = $('#info_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  st.textContent='Đang tải...';
+  try{
+    const r = await fetch('/api/pages/'+pid+'/info');
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    $('#pg_name').value = d.name || '';
+    $('#pg_phone').value = d.phone || d.phone_number || '';
+    $('#pg_website').value = d.website || '';
+    $('#pg_desc').value = d.description || d.about || '';
+    const loc = d.location || {};
+    $('#addr_street').value = loc.street || '';
+    $('#addr_city').value = loc.city || '';
+    $('#addr_zip').value = loc.zip || '';
+    $('#addr_country').value = loc.country || '';
+    st.textContent='Đã tải xong.';
+  }catch(e){ st.textContent='Lỗi tải thông tin'; }
+};
+
+// Snapshot every page's info and show what changed since the previous snapshot
+$('#btn_snapshot').onclick = async () => {
+  const st = $('#snapshot_status');
+  st.textContent = 'Đang đọc thông tin tất cả page...';
+  try{
+    const r = await fetch('/api/pages/snapshots', {method:'POST', headers:{'Content-Type':'application/json'}, body: '{}'});
+    const d = await waitJob(await r.json());
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    const diff = d.diff || {};
+    const rows = Object.entries(diff.changed||{}).map(([pid, f]) =>
+      '<div>✏️ ' + pid + ': ' + Object.entries(f).map(([k, v]) => k + ' ' + JSON.stringify(v.from) + ' → ' + JSON.stringify(v.to)).join('; ') + '</div>');
+    st.innerHTML = 'Snapshot #' + d.snapshot_id + ': ' + d.pages + ' page, ' + d.graph_calls + ' lượt gọi, ' + (d.errors||[]).length + ' lỗi'
+      + (diff.from ? ' · so với #' + diff.from + ': ' + rows.length + ' page thay đổi' : '')
+      + (diff.added||[]).map(p => '<div>➕ ' + p + '</div>').join('') + (diff.removed||[]).map(p => '<div>➖ ' + p + '</div>').join('')
+      + rows.join('') + (d.errors||[]).map(x => '<div>❌ ' + x.page_id + ': ' + x.error + '</div>').join('');
+  }catch(e){ st.textContent='Lỗi chụp snapshot'; }
+};
+
+$('#btn_save_info').onclick = async () => {
+  const pid = $('#info_page').value;
+  const st = $('#info_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  const payload = {
+    name: ($('#pg_name').value||'').trim(),
+    phone: ($('#pg_phone').value||'').trim(),
+    website: ($('#pg_website').value||'').trim(),
+    description: ($('#pg_desc').value||'').trim(),
+    address: {
+      street: ($('#addr_street').value||'').trim(),
+      city: ($('#addr_city').value||'').trim(),
+      zip: ($('#addr_zip').value||'').trim(),
+      country: ($('#addr_country').value||'').trim()
+    }
+    
+    
+    ,
+    always_open: $('#always_open').checked
+  };
+  st.textContent='Đang lưu...';
+  try{
+    const r = await fetch('/api/pages/'+pid+'/info', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload)});
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.textContent='Đã lưu xong.';
+  }catch(e){ st.textContent='Lỗi lưu thông tin'; }
+};
+
+$('#btn_set_avatar').onclick = async () => {
+  const pid = $('#info_page').value;
+  const file = $('#pic_avatar').files[0];
+  const st = $('#pic_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  if(!file){ st.textContent='Chưa chọn ảnh đại diện'; return; }
+  st.textContent='Đang cập nhật avatar...';
+  try{
+    const fd = new FormData();
+    fd.append('avatar', file);
+    const r = await fetch('/api/pages/'+pid+'/avatar', {method:'POST', body: fd});
+    const d = await waitJob(await r.json());
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.textContent='Đã đổi avatar.';
+  }catch(e){ st.textContent='Lỗi đổi avatar'; }
+};
+
+$('#btn_set_cover').onclick = async () => {
+  const pid = $('#info_page').value;
+  const file = $('#pic_cover').files[0];
+  const st = $('#pic_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  if(!file){ st.textContent='Chưa chọn ảnh bìa'; return; }
+  st.textContent='Đang cập nhật cover...';
+  try{
+    const fd = new FormData();
+    fd.append('cover', file);
+    const r = await fetch('/api/pages/'+pid+'/cover', {method:'POST', body: fd});
+    const d = await waitJob(await r.json());
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    st.textContent='Đã đổi cover.';
+  }catch(e){ st.textContent='Lỗi đổi cover'; }
+};
+
+// INBOX: load conversations and messages, send message
+let currentThread = null;
+let currentRecipient = null;
+
+$('#btn_load_conv').onclick = async () => {
+  const pid = $('#inbox_page').value;
+  const st = $('#inbox_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  st.textContent='Đang tải hội thoại...';
+  try{
+    const r = await fetch('/api/pages/'+pid+'/conversations');
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    const arr = d.data || [];
+    $('#conv_list').innerHTML = arr.map(cv => {
+      const unread = (cv.unread_count||0) > 0;
+      const dot = '<span class="dot '+(unread?'red':'green')+'"></span>';
+      let display = cv.id;
+      try{
+        const parts = (cv.participants && cv.participants.data) ? cv.participants.data : [];
+        const pageId = $('#inbox_page').value;
+        const other = parts.find(p => p.id !== pageId);
+        if(other && other.name) display = other.name;
+      }catch(_){}
+      return '<div class="conv-item">'+dot+'<a href="#" data-id="'+cv.id+'" class="open-thread conv-title">'+display+'</a><span class="muted"> — '+(cv.updated_time||'')+'</span></div>';
+    }).join('');
+    $('#conv_list').querySelectorAll('.open-thread').forEach(a => {
+      a.addEventListener('click', async (e) => {
+        e.preventDefault();
+        const tid = a.getAttribute('data-id');
+        await openThread(pid, tid);
+      });
+    });
+    st.textContent='Đã tải ' + arr.length + ' hội thoại.';
+  }catch(e){ st.textContent='Lỗi tải hội thoại'; }
+};
+
+// Unified inbox: every page merged by last activity, paged with a cursor
+let inboxCursor = null;
+async function loadUnifiedInbox(more){
+  const st = $('#inbox_status');
+  st.textContent='Đang tải hội thoại tất cả page...';
+  try{
+    const r = await fetch('/api/inbox?limit=30' + (more && inboxCursor ? '&cursor='+encodeURIComponent(inboxCursor) : ''));
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    const arr = d.data || [];
+    const html = arr.map(cv => {
+      const unread = (cv.unread_count||0) > 0;
+      const dot = '<span class="dot '+(unread?'red':'green')+'"></span>';
+      let display = cv.id;
+      try{
+        const parts = (cv.participants && cv.participants.data) ? cv.participants.data : [];
+        const other = parts.find(p => p.id !== cv.page_id);
+        if(other && other.name) display = other.name;
+      }catch(_){}
+      return '<div class="conv-item">'+dot+'<a href="#" data-id="'+cv.id+'" data-page="'+cv.page_id+'" class="open-thread conv-title">'+display+'</a><span class="muted"> — '+(cv.page_id||'')+' · '+(cv.updated_time||'')+'</span></div>';
+    }).join('');
+    if(more){ $('#conv_list').insertAdjacentHTML('beforeend', html); } else { $('#conv_list').innerHTML = html; }
+    $('#conv_list').querySelectorAll('.open-thread:not([data-bound])').forEach(a => {
+      a.setAttribute('data-bound', '1');
+      a.addEventListener('click', async (e) => {
+        e.preventDefault();
+        const pid = a.getAttribute('data-page');
+        if(pid){ $('#inbox_page').value = pid; }
+        await openThread(pid || $('#inbox_page').value, a.getAttribute('data-id'));
+      });
+    });
+    inboxCursor = (d.paging||{}).next_cursor || null;
+    $('#btn_more_conv').style.display = inboxCursor ? '' : 'none';
+    const u = d.unread || {};
+    st.textContent='Đã tải ' + $('#conv_list').querySelectorAll('.open-thread').length + ' hội thoại · chưa đọc: ' + (u.total||0) + (Object.keys((d.pages||{}).errors||{}).length ? ' · lỗi ' + Object.keys(d.pages.errors).length + ' page' : '');
+  }catch(e){ st.textContent='Lỗi tải hội thoại'; }
+}
+$('#btn_load_all_conv').onclick = () => loadUnifiedInbox(false);
+$('#btn_more_conv').onclick = () => loadUnifiedInbox(true);
+
+async function openThread(pageId, threadId){
+  const st = $('#inbox_status');
+  st.textContent='Đang tải tin nhắn...';
+  try{
+    const r = await fetch('/api/pages/'+pageId+'/conversations/'+threadId);
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    const msgs = (d.messages && d.messages.data) ? d.messages.data : [];
+    currentThread = threadId;
+    // Xác định người nhận (không phải page) từ from/to của các message
+    let rec = null;
+    for(const m of msgs){
+      const tos = (m.to && m.to.data) ? m.to.data : [];
+      const fr = m.from || {};
+      for(const t of tos){
+        if(t.id !== pageId){ rec = t.id; break; }
+      }
+      if(!rec && fr.id !== pageId){ rec = fr.id; }
+      if(rec) break;
+    }
+    currentRecipient = rec;
+    const fmt = (iso) => { try{ return new Date(iso).toLocaleString(); }catch(_){ return iso||''; } };
+    const pageIdLocal = pageId || $('#inbox_page').value;
+    $('#msg_list').innerHTML = msgs.map(m => {
+      const fromId = (m.from && m.from.id) ? m.from.id : '';
+      const fromName = (m.from && (m.from.name||m.from.id)) ? (m.from.name||m.from.id) : 'Unknown';
+      const cls = (fromId === pageId) ? 'msg me' : 'msg other';
+      const media = (m.media||[]).map(x => x.kind === 'image'
+        ? '<a target="_blank" href="'+x.url+'"><img loading="lazy" style="max-width:220px;border-radius:8px" src="'+x.thumb+'"/></a>'
+        : x.kind === 'video' ? '<video controls preload="metadata" style="max-width:260px" src="'+x.url+'"></video>'
+        : '<a target="_blank" href="'+x.url+'">📎 '+(x.name||'tệp')+'</a>').join('<br/>');
+      const text = (m.message || (media ? '' : '[attachment]'));
+      const time = fmt(m.created_time||'');
+      return '<div class="'+cls+'"><div class="bubble"><div><b>'+fromName+'</b></div><div>'+text+'</div>'+(media ? '<div>'+media+'</div>' : '')+'<div class="meta">'+time+'</div></div></div>';
+    }).join('');
+    st.textContent='Đã tải ' + msgs.length + ' tin nhắn.' + (currentRecipient ? '' : ' (Không xác định được người nhận — cần nhắn từ thread trước)');
+  }catch(e){ st.textContent='Lỗi tải tin nhắn'; }
+}
+
+$('#btn_send').onclick = async () => {
+  const pid = $('#inbox_page').value;
+  const text = ($('#msg_text').value||'').trim();
+  const st = $('#inbox_status');
+  if(!pid){ st.textContent='Chưa chọn page'; return; }
+  if(!text){ st.textContent='Nhập nội dung trước'; return; }
+  if(!currentRecipient){ st.textContent='Chưa xác định người nhận từ hội thoại — hãy mở một thread trước.'; return; }
+  st.textContent='Đang gửi...';
+  try{
+    const r = await fetch('/api/pages/'+pid+'/messages', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({recipient_id: currentRecipient, text})});
+    const d = await r.json();
+    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
+    if(d.deferred){ st.textContent='Đang giới hạn tốc độ — tin nhắn đã xếp hàng, sẽ gửi sau.'; waitJob(d, ()=>{}).then(j=>{ st.textContent = j.error ? 'Lỗi: '+(j.error.message||j.error) : 'Đã gửi.'; }); $('#msg_text').value=''; return; }
+    st.textContent='Đã gửi.';
+    if(currentThread){ await openThread(pid, currentThread); }
+    $('#msg_text').value='';
+  }catch(e){ st.textContent='Lỗi gửi tin nhắn'; }
+};
+async function pollNewEvents(){
+  const audio = document.getElementById('newMsg');
+  let lastTs = 0;
+  while(true){
+    try{
+      const r = await fetch('/webhook/events');
+      const d = await r.json();
+      const latest = d.length ? (d[d.length-1].ts||0) : 0;
+      // if there is a newer event and it looks like a message, play
+      if(latest && latest > lastTs){
+        lastTs = latest;
+        try{ await audio.play(); }catch(_){ /* require user interaction first */ }
+      }
+    }catch(e){}
+    await sleep(5000);
+  }
+} 
+</script>
   </div>
+<audio id="newMsg" src="/static/new-message.mp3" preload="auto"></audio>
+
+<script id="HIDE_PHONE_FIELD_SNIPPET">
+(()=>{try{
+  const t=(el)=> (el.textContent||'').toLowerCase().includes('số điện thoại');
+  document.querySelectorAll('label,span,div').forEach(el=>{
+    if(t(el)){ el.style.display='none'; const n=el.nextElementSibling;
+      if(n && (n.tagName==='INPUT' || (n.name||'').toLowerCase().includes('phone'))) n.style.display='none';
+    }
+  });
+  document.querySelectorAll('input,textarea,select').forEach(inp=>{
+    const nm=(inp.name||'').toLowerCase(), id=(inp.id||'').toLowerCase(), ph=(inp.placeholder||'').toLowerCase();
+    if(nm.includes('phone')||id.includes('phone')||ph.includes('số điện thoại')) inp.style.display='none';
+  });
+}catch(_){}})();
+
+// --- Hide Settings & Page Info, keep only Posts and Inbox ---
+(function(){
+  function hideById(id){
+    const el = document.getElementById(id);
+    if(!el) return;
+    el.style.display = 'none';
+    const card = el.closest('.card');
+    if(card) card.style.display = 'none';
+    const panel = el.closest('.panel');
+    if(panel) panel.style.display = 'none';
+  }
+  // Hide tab button & panel
+  hideById('tab-page-info');
+  hideById('panel-page-info');
+
+  // Hide settings & diagnostics blocks
+  ['cfg_app_id','cfg_app_secret','cfg_short_token','btn_save_cfg','btn_exchange','cfg_status','btn_diag','diag_out']
+    .forEach(hideById);
+})();
+</script>
+</body>
+</html>"""
+
+# ----------------------------
+# UI delivery: INDEX_HTML is split into hashed CSS/JS assets and precompressed once at import
+# ----------------------------
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+UI_ASSETS: Dict[str, Dict[str, Any]] = {}
+
+def _precompress(body: bytes) -> Dict[str, bytes]:
+    import gzip
+    out = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        out["br"] = brotli.compress(body, quality=11)
+    return out
+
+def _add_ui_asset(name: str, body: bytes, ctype: str, immutable: bool) -> str:
+    import hashlib
+    digest = hashlib.sha256(body).hexdigest()
+    path = f"/assets/{name}.{digest[:12]}.{ctype.split('/')[1].split(';')[0].replace('javascript', 'js')}" if immutable else name
+    UI_ASSETS[path] = {"body": body, "encoded": _precompress(body), "etag": digest[:32], "ctype": ctype, "immutable": immutable}
+    return path
+
+def _build_ui_assets():
+    import re
+    html = INDEX_HTML
+    def _css(m):
+        return '<link rel="stylesheet" href="%s"/>' % _add_ui_asset("app", m.group(1).encode("utf-8"), "text/css; charset=utf-8", True)
+    html = re.sub(r"<style>(.*?)</style>", _css, html, count=1, flags=re.S)
+    n = {"i": 0}
+    def _js(m):
+        n["i"] += 1
+        src = _add_ui_asset(f"app{n['i']}", m.group(2).encode("utf-8"), "application/javascript; charset=utf-8", True)
+        return '<script%s src="%s"></script>' % (m.group(1), src)
+    html = re.sub(r"<script((?:\s+id=\"[^\"]*\")?)>(.*?)</script>", _js, html, flags=re.S)
+    _add_ui_asset("/", html.encode("utf-8"), "text/html; charset=utf-8", False)
+
+def _negotiated_encoding(available) -> Optional[str]:
+    accept = (request.headers.get("Accept-Encoding") or "").lower()
+    offered = {p.split(";")[0].strip(): ("q=0" not in p.replace(" ", "")) for p in accept.split(",") if p.strip()}
+    for enc in ("br", "gzip"):
+        if enc in available and offered.get(enc):
+            return enc
+    return None
+
+def _serve_ui_asset(path: str):
+    a = UI_ASSETS.get(path)
+    if not a:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    enc = _negotiated_encoding(a["encoded"])
+    etag = f'"{a["etag"]}-{enc}"' if enc else f'"{a["etag"]}"'
+    cache = "public, max-age=31536000, immutable" if a["immutable"] else "no-cache"
+    inm = request.headers.get("If-None-Match") or ""
+    if etag in [x.strip() for x in inm.split(",")] or inm.strip() == "*":
+        resp = Response(status=304)
+    else:
+        resp = Response(a["encoded"][enc] if enc else a["body"], status=200, content_type=a["ctype"])
+        if enc: resp.headers["Content-Encoding"] = enc
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = cache
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+_build_ui_assets()
+
+# ----------------------------
+# JSON responses: fast encoder on hot endpoints, ETag/304 and gzip/br above a size threshold
+# ----------------------------
+try:
+    import orjson
+except ImportError:  # stdlib json via jsonify
+    orjson = None
+
+JSON_COMPRESS_MIN = int(os.environ.get("JSON_COMPRESS_MIN", "1024"))
+
+def _json_response(data: Any, status: int = 200, etag: Optional[str] = None):
+    if orjson is not None:
+        resp = Response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), status=status, mimetype="application/json")
+    else:
+        resp = jsonify(data)
+        resp.status_code = status
+    if etag:
+        resp.set_etag(etag)
+    return resp
+
+def _etag_variant(etag: str, enc: Optional[str]) -> str:
+    return f"{etag}-{enc}" if enc else etag
+
+def _etag_matches(etag: str) -> bool:
+    # compressed variants carry a "-gzip"/"-br" suffix; they validate the same payload
+    tags = {t.rsplit("-", 1)[0] if t.endswith(("-gzip", "-br")) else t for t in request.if_none_match.as_set()}
+    return etag in tags or request.if_none_match.star_tag
+
+def _not_modified(etag: str, enc: Optional[str] = None):
+    """304 with the ETag the 200 would carry; without `enc`, that of the compressed variant the client holds."""
+    if enc is None:
+        enc = next((e for e in ("br", "gzip") if request.if_none_match.contains(_etag_variant(etag, e))), None)
+    resp = Response(status=304)
+    resp.set_etag(_etag_variant(etag, enc))
+    if enc: resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+@app.after_request
+def _json_conditional_and_compress(resp):
+    if (resp.mimetype != "application/json" or resp.direct_passthrough or resp.is_streamed
+            or resp.headers.get("Content-Encoding") or request.method not in ("GET", "HEAD")):
+        return resp
+    body = resp.get_data()
+    enc = _negotiated_encoding(("br", "gzip") if brotli is not None else ("gzip",)) if len(body) >= JSON_COMPRESS_MIN else None
+    if resp.status_code == 200:
+        etag, weak = resp.get_etag()
+        if not etag:
+            import hashlib
+            etag, weak = hashlib.blake2b(body, digest_size=16).hexdigest(), False
+            resp.set_etag(etag)
+        resp.headers["Cache-Control"] = resp.headers.get("Cache-Control") or "private, no-cache"
+        if _etag_matches(etag):
+            nm = _not_modified(etag, enc or "")  # exactly the variant this 200 would have been
+            nm.headers["Cache-Control"] = resp.headers["Cache-Control"]
+            return nm
+    if not enc:
+        return resp
+    if enc == "br":
+        payload = brotli.compress(body, quality=5)
+    else:
+        import gzip
+        payload = gzip.compress(body, compresslevel=6)
+    resp.set_data(payload)
+    resp.headers["Content-Encoding"] = enc
+    resp.headers["Vary"] = "Accept-Encoding"
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag(_etag_variant(etag, enc), weak=weak)
+    return resp
+
+@app.route("/")
+def index():
+    return _serve_ui_asset("/")
+
+@app.route("/assets/<name>")
+def ui_asset(name):
+    return _serve_ui_asset(f"/assets/{name}")
+
+# ----------------------------
+# APIs: pages & posting & reels (reusing patterns)
+# ----------------------------
+def reels_start(page_id: str, page_token: str):
+    return graph_post(f"{page_id}/video_reels", {"upload_phase": "start"}, page_token, ctx_key=_ctx_key_for_page(page_id))
+
+def reels_finish(page_id: str, page_token: str, video_id: str, description: str):
+    return graph_post(f"{page_id}/video_reels", {"upload_phase": "finish", "video_id": video_id, "description": description}, page_token, ctx_key=_ctx_key_for_page(page_id), idempotent=True)
+
+@app.route("/api/pages")
+def api_list_pages():
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if token:
+        data, status = graph_get("me/accounts", {"limit": 200}, token, ttl=0)
+        return _json_response(data, status)
+
+    # Fallback: nếu có PAGE_TOKENS trong ENV thì trả về luôn danh sách page từ ENV
+    try:
+        env_pages = _env_pages_list()
+        if env_pages:
+            return _json_response({"data": env_pages}, 200)
+    except Exception:
+        pass
+
+    return jsonify({"error": "NOT_LOGGED_IN"}), 401
+
+@app.route("/api/pages/<page_id>/info")
+def api_page_info(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    fields = "name,about,description,website,location{street,city,zip,country}"
+    data, st = graph_get(page_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    return jsonify(data), st
+
+# ------- Page info (POST update) -------
+@app.route("/api/pages/<page_id>/info", methods=["POST"])
+def api_page_update_info(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    body = request.get_json(force=True)
+    payload = _page_info_payload(body)
+    if not payload:
+        return jsonify({"error":"EMPTY_UPDATE"}), 400
+
+    res, st = update_page_info(page_id, page_token, payload)
+    return jsonify(res), st
+
+def _page_info_payload(body: dict) -> Dict[str, Any]:
+    payload = {}
+    # Simple fields
+    if body.get("name"): payload["name"] = body.get("name")
+    if body.get("description"): payload["description"] = body.get("description")
+    if body.get("website"): payload["website"] = body.get("website")
+    if body.get("phone"): payload["phone"] = body.get("phone")
+    # Location fields (best-effort)
+    addr = body.get("address") or {}
+    for k in ["street","city","zip","country"]:
+        if addr.get(k):
+            payload[f"location[{k}]"] = addr.get(k)
+
+    # Opening hours - best-effort 'always open' by setting 00:00-23:59 for all days
+    if body.get("always_open"):
+        for day in ["mon","tue","wed","thu","fri","sat","sun"]:
+            payload[f"hours[{day}_1_open]"] = "00:00"
+            payload[f"hours[{day}_1_close]"] = "23:59"
+    return payload
+
+# ------- Learned per-page capabilities (which field variant a page accepts) -------
+CAPABILITY_TTL_SEC = int(os.environ.get("CAPABILITY_TTL_SEC", str(7 * 86400)))
+INFO_FIELD_VARIANTS = {"description": ["description", "about"]}
+
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS page_capabilities (
+        page_id TEXT NOT NULL,
+        op TEXT NOT NULL,
+        variant TEXT NOT NULL,
+        ok INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 1,
+        updated REAL NOT NULL,
+        PRIMARY KEY (page_id, op, variant))""",
+]
+
+def _cap_known(page_id: str, op: str) -> Dict[str, bool]:
+    rows = _db().execute("SELECT variant, ok FROM page_capabilities WHERE page_id=? AND op=? AND updated > ?",
+                         (str(page_id), op, pytime.time() - CAPABILITY_TTL_SEC)).fetchall()
+    return {r["variant"]: bool(r["ok"]) for r in rows}
+
+def _cap_order(page_id: str, op: str, variants) -> list:
+    """Known-good variants first, then untried ones, known-bad last (still tried if nothing else is left)."""
+    known = _cap_known(page_id, op)
+    rank = lambda v: 0 if known.get(v) is True else (2 if known.get(v) is False else 1)
+    return sorted(variants, key=rank)
+
+def _cap_record(page_id: str, op: str, variant: str, ok: bool):
+    _db().execute(
+        "INSERT INTO page_capabilities(page_id,op,variant,ok,hits,updated) VALUES (?,?,?,?,1,?) "
+        "ON CONFLICT(page_id,op,variant) DO UPDATE SET ok=excluded.ok, hits=CASE WHEN ok=excluded.ok THEN hits+1 ELSE 1 END, updated=excluded.updated",
+        (str(page_id), op, variant, 1 if ok else 0, pytime.time()))
+
+def _graph_rejected(st: int) -> bool:
+    # only a definitive 4xx says anything about the field; throttling and outages do not
+    return 400 <= st < 500 and st != 429
+
+# wording Graph uses when a field cannot be set on this page at all (as opposed to a bad value for it)
+_FIELD_UNSUPPORTED_HINTS = ("nonexisting field", "unknown field", "not a valid field", "not supported", "cannot be updated",
+                            "can't be updated", "not allowed", "deprecated")
+
+def _rejected_field(res, sent) -> Optional[str]:
+    """The sent field a capability error names; None for value errors, which say nothing about the page."""
+    import re
+    err = (res.get("error") if isinstance(res, dict) else None) or {}
+    msg = (err.get("message") if isinstance(err, dict) else str(err)) or ""
+    try: code = int(err.get("code") or 0) if isinstance(err, dict) else 0
+    except (TypeError, ValueError): code = 0
+    if not (code == 10 or 200 <= code <= 299 or any(h in msg.lower() for h in _FIELD_UNSUPPORTED_HINTS)):
+        return None
+    for name in sent:
+        if re.search(r"\b%s\b" % re.escape(name), msg, flags=re.I):
+            return name
+    return None
+
+def update_page_info(page_id: str, page_token: str, payload: Dict[str, Any]):
+    """POST a page info update, leaving out fields this page rejected before and falling back between field variants."""
+    groups: Dict[str, Dict[str, Any]] = {}
+    for k, v in payload.items():
+        groups.setdefault(k.split("[", 1)[0], {})[k] = v
+    skipped = []
+    for _ in range(len(groups) + 1):
+        known = _cap_known(page_id, "info_field")
+        body, sent = {}, {}
+        for root, kv in groups.items():
+            options = INFO_FIELD_VARIANTS.get(root, [root])
+            usable = [v for v in _cap_order(page_id, "info_field", options) if known.get(v) is not False]
+            if not usable:
+                if root not in skipped: skipped.append(root)
+                continue
+            var = usable[0]
+            sent[var] = root
+            for k, v in kv.items():
+                body[var + k[len(root):]] = v
+        if not body:
+            return {"error": "NO_SUPPORTED_FIELDS", "skipped_fields": skipped}, 400
+        res, st = graph_post(page_id, body, page_token, ctx_key=_ctx_key_for_page(page_id), idempotent=True)
+        if st == 202:
+            return res, st  # deferred until the cooldown lifts; nothing learned yet
+        if st < 400:
+            for var in sent: _cap_record(page_id, "info_field", var, True)
+            if skipped and isinstance(res, dict): res["skipped_fields"] = skipped
+            return res, st
+        bad = _rejected_field(res, sent) if _graph_rejected(st) else None
+        if not bad:
+            return res, st
+        _cap_record(page_id, "info_field", bad, False)
+    return res, st
+
+def set_page_cover(page_id: str, page_token: str, photo_id: str):
+    """Try the cover field variant known to work for this page first; learn from the outcome."""
+    res, st = None, 500
+    for var in _cap_order(page_id, "cover", ["cover", "cover_photo"]):
+        res, st = graph_post(page_id, {var: photo_id}, page_token, ctx_key=_ctx_key_for_page(page_id), idempotent=True)
+        if st < 400:
+            _cap_record(page_id, "cover", var, True)
+            return res, st
+        if not _graph_rejected(st):
+            return res, st
+        _cap_record(page_id, "cover", var, False)
+    return res, st
+
+@app.route("/api/pages/<page_id>/capabilities")
+def api_page_capabilities(page_id):
+    rows = _db().execute("SELECT op, variant, ok, hits, updated FROM page_capabilities WHERE page_id=? ORDER BY op, variant",
+                         (str(page_id),)).fetchall()
+    now = pytime.time()
+    return jsonify({"data": [dict(r, ok=bool(r["ok"]), expired=(now - r["updated"]) > CAPABILITY_TTL_SEC) for r in rows]}), 200
+
+@app.route("/api/pages/<page_id>/capabilities", methods=["DELETE"])
+def api_page_capabilities_reset(page_id):
+    _db().execute("DELETE FROM page_capabilities WHERE page_id=?", (str(page_id),))
+    return jsonify({"ok": True}), 200
+
+# ------- Job handlers: profile pictures & publishing (run on background workers) -------
+def _job_step_key(p: dict, step: str) -> Optional[str]:
+    """Idempotency key for one Graph write of a job: a retried job replays it instead of posting twice."""
+    return f"{p['_job_id']}:{p.get('page_id', '')}:{step}" if p.get("_job_id") else None
+
+def _job_accepted(job_id: str):
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}), 202
+
+@job_handler("page_avatar", pool="profile")
+def _job_page_avatar(p: dict):
+    page_id, f = p["page_id"], prepare_image(p["file"], "avatar")
+    with open(f["path"], "rb") as fh:
+        files = {"source": (f["filename"], fh, f["mimetype"])}
+        return graph_post_multipart(f"{page_id}/picture", files, {}, p["page_token"], ctx_key=_ctx_key_for_page(page_id), idempotent=True)
+
+@job_handler("page_cover", pool="profile")
+def _job_page_cover(p: dict):
+    page_id, page_token, f = p["page_id"], p["page_token"], prepare_image(p["file"], "cover")
+    # 1) upload photo
+    with open(f["path"], "rb") as fh:
+        files = {"source": (f["filename"], fh, f["mimetype"])}
+        up, st = graph_post_multipart(f"{page_id}/photos", files, {"published":"false"}, page_token, ctx_key=_ctx_key_for_page(page_id),
+                                      idempotency_key=_job_step_key(p, "cover_upload"))
+    if st != 200 or not isinstance(up, dict) or not up.get("id"):
+        return {"error":"UPLOAD_FAILED", "detail": up}, st
+    # 2) set as cover (field name varies by page; the learned variant goes first)
+    return set_page_cover(page_id, page_token, str(up.get("id")))
+
+# ------- Bulk profile updates: one payload / one staged image, many pages -------
+BULK_PROFILE_CONCURRENCY = int(os.environ.get("BULK_PROFILE_CONCURRENCY", "4"))
+
+def _apply_page_info(p: dict):
+    return update_page_info(p["page_id"], p["page_token"], p["info"])
+
+_BULK_PROFILE_OPS = {"info": _apply_page_info, "avatar": _job_page_avatar, "cover": _job_page_cover}
+
+@job_handler("bulk_profile", pool="profile")
+def _job_bulk_profile(p: dict):
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    fn = _BULK_PROFILE_OPS[p["op"]]
+    pages = p["pages"]
+    if p.get("file"):
+        prepare_image(p["file"], p["op"])  # warm the cache once; each page then hits it
+    results: Dict[str, Any] = dict(p.get("skipped") or {})
+    lane = _current_lane()
+    def one(pg):
+        with graph_lane(lane):  # pool threads start with a fresh context
+            try:
+                return pg["page_id"], fn(dict(pg, file=p.get("file"), info=p.get("info")))
+            except Exception as e:
+                return pg["page_id"], ({"error": str(e)}, 500)
+    def summary():
+        ok = sum(1 for r in results.values() if r["status"] < 400)
+        return {"op": p["op"], "total": len(pages) + len(p.get("skipped") or {}), "completed": len(results), "ok": ok,
+                "failed": len(results) - ok, "results": results}
+    # every page reads the same staged file; graph_* still applies the global and per-page throttle
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_PROFILE_CONCURRENCY, len(pages)))) as ex:
+        for fut in as_completed([ex.submit(one, pg) for pg in pages]):
+            pid, (data, st) = fut.result()
+            results[pid] = {"status": st, "data": data}
+            if p.get("_job_id"):
+                _db().execute("UPDATE jobs SET result=?, updated=? WHERE id=?",
+                              (json.dumps(summary(), ensure_ascii=False), pytime.time(), p["_job_id"]))
+    return summary(), 200
+
+def _bulk_profile_enqueue(op: str, page_ids, extra: Dict[str, Any], file=None):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_ids = list(dict.fromkeys(str(x).strip() for x in page_ids if str(x).strip()))
+    if not page_ids: return jsonify({"error":"NO_PAGES"}), 400
+    pages, skipped = [], {}
+    for pid in page_ids:
+        pt = get_page_access_token(pid, token)
+        if pt: pages.append({"page_id": pid, "page_token": pt})
+        else: skipped[pid] = {"status": 403, "data": {"error": "NO_PAGE_TOKEN"}}
+    if not pages: return jsonify({"error":"NO_PAGE_TOKEN", "results": skipped}), 403
+    payload = dict(extra, op=op, pages=pages, skipped=skipped)
+    if file is not None:
+        payload["file"] = _stage_upload(file)
+    return _job_accepted(enqueue_job("bulk_profile", payload, max_attempts=1))
 
-  <div id="panel-posts" class="panel active">
-    <div class="row">
-      <div class="col">
-        <div class="card">
-          <h3>Fanpage</h3>
-          <div class="list" id="pages"></div>
-          <div class="status" id="pages_status" ></div>
-        </div>
-        <div class="card" style="margin-top:12px">
-          <h3>AI soạn nội dung</h3>
-          <textarea id="ai_prompt" rows="4" placeholder="Gợi ý chủ đề, ưu đãi, CTA..."></textarea>
-          <div class="grid">
-            <input id="ai_keyword" placeholder="Từ khoá chính (VD: MB66)"/>
-            <input id="ai_link" placeholder="Link chính thức (VD: https://...)"/>
-          </div>
-          <div class="grid">
-            <select id="ai_tone">
-              <option value="thân thiện">Giọng: Thân thiện</option>
-              <option value="chuyên nghiệp">Chuyên nghiệp</option>
-              <option value="hài hước">Hài hước</option>
-            </select>
-            <select id="ai_length">
-              <option value="ngắn">Ngắn</option>
-              <option value="vừa">Vừa</option>
-              <option value="dài">Dài</option>
-            </select>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn" id="btn_ai">Tạo nội dung</button>
-            <span class="muted">Cần OPENAI_API_KEY</span>
-          </div>
-          <div class="status" id="ai_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Đăng nội dung</h3>
-          <textarea id="post_text" rows="6" placeholder="Nội dung bài viết..."></textarea>
-          <div class="grid" style="margin-top:8px">
-            <div>
-              <label>Loại đăng</label>
-              <select id="post_type">
-                <option value="feed">Feed</option>
-                <option value="reels">Reels</option>
-              </select>
-            </div>
-            <div>
-              <label>Video</label>
-              <input type="file" id="video_input" accept="video/*"/>
-            </div>
-          </div>
-          <div class="grid" style="margin-top:8px">
-            <input type="file" id="photo_input" accept="image/*"/>
-            <input type="text" id="media_caption" placeholder="Caption (tuỳ chọn)"/>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn primary" id="btn_publish">Đăng</button>
-          </div>
-          <div class="status" id="post_status"></div>
-        </div>
-      </div>
-    </div>
-  </div>
+def _bulk_page_ids():
+    if request.is_json:
+        return (request.get_json(force=True) or {}).get("page_ids") or []
+    return (request.form.get("page_ids") or "").split(",")
 
-  <div id="panel-inbox" class="panel">
-    <div class="row">
-      <div class="col">
-        <h3>Chọn Page</h3>
-        <select id="inbox_page"></select>
-        <button class="btn" id="btn_load_conv" style="margin-top:8px">Tải hội thoại</button>
-        <div class="list" id="conv_list" style="margin-top:8px"></div>
-      </div>
-      <div class="col">
-        <h3>Hội thoại</h3>
-        <div class="list" id="msg_list" style="min-height:280px"></div>
-        <div class="toolbar" style="margin-top:8px">
-          <input id="msg_text" placeholder="Nhập tin nhắn..."/>
-          <button class="btn primary" id="btn_send">Gửi</button>
-        </div>
-        <div class="status" id="inbox_status"></div>
-      </div>
-    </div>
-  </div>
-          <div class="grid" style="margin-top:8px">
-            <input id="cfg_short_token" placeholder="User short-lived token"/>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn" id="btn_save_cfg">Lưu cấu hình</button>
-            <button class="btn primary" id="btn_exchange">Đổi token dài & lưu</button>
-          </div>
-          <div class="status" id="cfg_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Diagnostics</h3>
-          <button class="btn" id="btn_diag">Chạy kiểm tra</button>
-          <pre id="diag_out" class="list" style="white-space:pre-wrap"></pre>
-        </div>
-      </div>
-    </div>
-  </div>
+@app.route("/api/pages/bulk/info", methods=["POST"])
+def api_bulk_page_info():
+    body = request.get_json(force=True) or {}
+    info = _page_info_payload(body)
+    if not info: return jsonify({"error":"EMPTY_UPDATE"}), 400
+    return _bulk_profile_enqueue("info", body.get("page_ids") or [], {"info": info})
+
+@app.route("/api/pages/bulk/avatar", methods=["POST"])
+def api_bulk_page_avatar():
+    if "avatar" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
+    if not _validate_image(request.files["avatar"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+    return _bulk_profile_enqueue("avatar", _bulk_page_ids(), {}, file=request.files["avatar"])
+
+@app.route("/api/pages/bulk/cover", methods=["POST"])
+def api_bulk_page_cover():
+    if "cover" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
+    if not _validate_image(request.files["cover"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+    return _bulk_profile_enqueue("cover", _bulk_page_ids(), {}, file=request.files["cover"])
+
+def _record_published(p: dict, kind: str, obj_id: Any):
+    """Bookkeeping for a successful publish; failures here never fail the publish itself."""
+    if not obj_id:
+        return
+    try:
+        _ledger_published(p, kind, str(obj_id))
+        _insights_track(p["page_id"], str(obj_id), kind, p.get("campaign_id"))
+    except Exception:
+        pass
+
+@job_handler("publish_feed", pool="publish")
+def _job_publish_feed(p: dict):
+    page_id, page_token = p["page_id"], p["page_token"]
+    data, status = graph_post(f"{page_id}/feed", {"message": p["message"]}, page_token, ctx_key=_ctx_key_for_page(page_id),
+                              idempotency_key=_job_step_key(p, "feed"))
+    if status == 200 and isinstance(data, dict):
+        queue_permalink(data, data.get("id"), page_id, page_token, p.get("_job_id"))
+        _record_published(p, "feed", data.get("id"))
+    return data, status
+
+@job_handler("publish_photo", pool="publish")
+def _job_publish_photo(p: dict):
+    page_id, page_token, f = p["page_id"], p["page_token"], prepare_image(p["file"], "photo")
+    with open(f["path"], "rb") as fh:
+        files = {"source": (f["filename"], fh, f["mimetype"])}
+        data, status = graph_post_multipart(f"{page_id}/photos", files, {"caption": p.get("caption", ""), "published": "true"}, page_token, ctx_key=_ctx_key_for_page(page_id),
+                                              idempotency_key=_job_step_key(p, "photo"))
+    if status == 200 and isinstance(data, dict):
+        queue_permalink(data, data.get("id") or data.get("post_id"), page_id, page_token, p.get("_job_id"))
+        _record_published(p, "photo", data.get("post_id") or data.get("id"))
+    return data, status
+
+@job_handler("publish_video", pool="upload")
+def _job_publish_video(p: dict):
+    page_id, page_token, f = p["page_id"], p["page_token"], p["file"]
+    with open(f["path"], "rb") as fh:
+        files = {"source": (f["filename"], fh, f["mimetype"])}
+        data, status = graph_post_multipart(f"{page_id}/videos", files, {"description": p.get("description", "")}, page_token, ctx_key=_ctx_key_for_page(page_id),
+                                              idempotency_key=_job_step_key(p, "video"))
+    if status == 200 and isinstance(data, dict):
+        queue_permalink(data, data.get("id") or data.get("video_id"), page_id, page_token, p.get("_job_id"))
+        _record_published(p, "video", data.get("id") or data.get("video_id"))
+    return data, status
+
+@job_handler("publish_reel", pool="upload")
+def _job_publish_reel(p: dict):
+    page_id, page_token, f = p["page_id"], p["page_token"], p["file"]
+    start_res, st1 = reels_start(page_id, page_token)
+    if st1 != 200 or not isinstance(start_res, dict) or "video_id" not in start_res:
+        return {"error":"REELS_START_FAILED", "detail": start_res}, st1
+    video_id = start_res.get("video_id")
+    headers = {"Authorization": f"OAuth {page_token}", "offset": "0", "Content-Type": "application/octet-stream"}
+    try:
+        _wait_throttle("global")
+        with open(f["path"], "rb") as fh, _trace_span("rupload", video_id=str(video_id), bytes=os.path.getsize(f["path"])) as sp:
+            ru = _http().post(f"{RUPLOAD_BASE}/{video_id}", headers=headers, data=fh, timeout=600)
+            if sp is not None: sp["attrs"]["status"] = ru.status_code
+        if ru.status_code >= 400:
+            try: return {"error":"REELS_RUPLOAD_FAILED", "detail": ru.json()}, ru.status_code
+            except Exception: return {"error":"REELS_RUPLOAD_FAILED", "detail": ru.text}, ru.status_code
+    except Exception as e:
+        return {"error":"REELS_RUPLOAD_EXCEPTION", "detail": str(e)}, 500
+    fin_res, st3 = reels_finish(page_id, page_token, video_id, p.get("description", ""))
+    if st3 != 200:
+        # a rerun would start a new upload session and post a second reel
+        out = {"error":"REELS_FINISH_FAILED", "detail": fin_res}
+        return (_outcome_unknown(out) if _is_retryable(fin_res, st3) else out), st3
+    queue_permalink(fin_res, fin_res.get("video_id") or video_id, page_id, page_token, p.get("_job_id"))
+    _record_published(p, "reel", fin_res.get("video_id") or video_id)
+    return fin_res, 200
+
+# ------- Avatar (profile picture) -------
+@app.route("/api/pages/<page_id>/avatar", methods=["POST"])
+def api_page_avatar(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    if "avatar" not in request.files:
+        return jsonify({"error":"MISSING_FILE"}), 400
+    if not _validate_image(request.files["avatar"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+    staged = _stage_upload(request.files["avatar"])
+    return _job_accepted(enqueue_job("page_avatar", {"page_id": page_id, "page_token": page_token, "file": staged}))
+
+# ------- Cover: upload then set as cover -------
+@app.route("/api/pages/<page_id>/cover", methods=["POST"])
+def api_page_cover(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    if "cover" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
+    if not _validate_image(request.files["cover"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+    staged = _stage_upload(request.files["cover"])
+    return _job_accepted(enqueue_job("page_cover", {"page_id": page_id, "page_token": page_token, "file": staged}))
+
+# ------- Posting & Reels -------
+def _campaign_id(body) -> Optional[str]:
+    """Optional client-chosen id grouping the posts of one multi-page publish."""
+    return (str(body.get("campaign_id") or "").strip()[:64] or None) if body else None
+
+def _duplicate_response(code: str, prev: Dict[str, Any]):
+    return jsonify({"error": code, "previous": prev,
+                    "note": f"Nội dung này đã được đăng lên page trong {LEDGER_DUPLICATE_WINDOW_SEC // 3600} giờ qua."}), 429
+
+@app.route("/api/pages/<page_id>/post", methods=["POST"])
+def api_post_to_page(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error": "NOT_LOGGED_IN"}), 401
+    body = request.get_json(force=True)
+    message = (body.get("message") or "").trim() if hasattr(str, "trim") else (body.get("message") or "").strip()
+    if not message: return jsonify({"error": "EMPTY_MESSAGE"}), 400
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error": "NO_PAGE_TOKEN"}), 403
+    return _enqueue_publish("publish_feed", "feed", {"page_id": page_id, "page_token": page_token, "message": message,
+                                                     "campaign_id": _campaign_id(body)}, "DUPLICATE_MESSAGE")
+
+@app.route("/api/pages/<page_id>/photo", methods=["POST"])
+def api_post_photo(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    if "photo" not in request.files: return jsonify({"error":"MISSING_PHOTO"}), 400
+    if not _validate_image(request.files["photo"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+    staged = _stage_upload(request.files["photo"])
+    return _enqueue_publish("publish_photo", "photo", {"page_id": page_id, "page_token": page_token, "file": staged,
+                                                       "caption": request.form.get("caption",""),
+                                                       "campaign_id": _campaign_id(request.form)}, "DUPLICATE_CAPTION")
+
+@app.route("/api/pages/<page_id>/video", methods=["POST"])
+def api_post_video(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
+    staged = _stage_upload(request.files["video"])
+    return _enqueue_publish("publish_video", "video", {"page_id": page_id, "page_token": page_token, "file": staged,
+                                                       "description": request.form.get("description",""),
+                                                       "campaign_id": _campaign_id(request.form)}, "DUPLICATE_DESCRIPTION")
+
+@app.route("/api/pages/<page_id>/reel", methods=["POST"])
+def api_post_reel(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
+    staged = _stage_upload(request.files["video"])
+    return _enqueue_publish("publish_reel", "reel", {"page_id": page_id, "page_token": page_token, "file": staged,
+                                                     "description": request.form.get("description",""),
+                                                     "campaign_id": _campaign_id(request.form)})
+
+@app.route("/api/permalinks")
+def api_permalinks():
+    ids = [x.strip() for x in (request.args.get("ids") or "").split(",") if x.strip()][:200]
+    if not ids: return jsonify({"error":"NO_IDS"}), 400
+    marks = ",".join("?" * len(ids))
+    rows = _db().execute(f"SELECT object_id, status, permalink_url FROM permalinks WHERE object_id IN ({marks})", ids).fetchall()
+    return jsonify({r["object_id"]: {"status": r["status"], "permalink_url": r["permalink_url"]} for r in rows}), 200
+
+# ----------------------------
+# Scheduling APIs
+# ----------------------------
+def _parse_due_at(v) -> Optional[float]:
+    if v is None or v == "":
+        return None
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        pass
+    try:
+        from datetime import datetime, timezone
+        dt = datetime.fromisoformat(str(v).replace("Z", "+00:00"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        return None
+
+def _schedule_row(r) -> Dict[str, Any]:
+    p = json.loads(r["payload"])
+    preview = (p.get("message") or p.get("caption") or p.get("description") or "")[:120]
+    return {"id": r["id"], "kind": r["kind"], "page_id": r["page_id"], "due_at": r["due_at"], "fire_at": r["fire_at"],
+            "status": r["status"], "job_id": r["job_id"], "preview": preview}
+
+@app.route("/api/schedule", methods=["POST"])
+def api_schedule_create():
+    """
+    JSON (feed) or multipart (photo/video/reel): page_ids, type, at (unix ts or ISO-8601, UTC if naive),
+    message / caption / description, file field 'file'.
+    """
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    if request.files:
+        body = request.form.to_dict()
+        page_ids = [x.strip() for x in (body.get("page_ids") or "").split(",") if x.strip()]
+    else:
+        body = request.get_json(force=True) or {}
+        page_ids = [str(x).strip() for x in (body.get("page_ids") or []) if str(x).strip()]
+    kind = (body.get("type") or "feed").strip()
+    if kind not in SCHEDULE_JOB_TYPES: return jsonify({"error":"BAD_TYPE", "allowed": sorted(SCHEDULE_JOB_TYPES)}), 400
+    if not page_ids: return jsonify({"error":"NO_PAGES"}), 400
+    due_at = _parse_due_at(body.get("at"))
+    if due_at is None: return jsonify({"error":"BAD_TIME"}), 400
+    if due_at < pytime.time() - 60: return jsonify({"error":"TIME_IN_PAST"}), 400
+    base: Dict[str, Any] = {"campaign_id": _campaign_id(body)}
+    staged = None
+    if kind == "feed":
+        base["message"] = (body.get("message") or "").strip()
+        if not base["message"]: return jsonify({"error":"EMPTY_MESSAGE"}), 400
+    else:
+        if "file" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
+        if kind == "photo":
+            if not _validate_image(request.files["file"]): return jsonify({"error":"INVALID_IMAGE"}), 400
+            base["caption"] = body.get("caption", "")
+        else: base["description"] = body.get("description", "")
+    text_key = "message" if kind == "feed" else ("caption" if kind == "photo" else "description")
+    slots = body.get("slots") if isinstance(body.get("slots"), dict) else None
+    missing = template_unbound_slots(base[text_key], slots)
+    if missing: return jsonify({"error":"UNBOUND_SLOTS", "missing": missing}), 400
+    tokens, errors = {}, []
+    for pid in page_ids:
+        pt = get_page_access_token(pid, token)
+        if pt: tokens[pid] = pt
+        else: errors.append({"page_id": pid, "error": "NO_PAGE_TOKEN"})
+    variants: Dict[str, str] = {}
+    if tokens and kind != "feed":
+        staged = _stage_upload(request.files["file"])
+    if tokens and is_template(base[text_key]):
+        variants, short = template_for_pages(base[text_key], list(tokens), slots, digest=(staged or {}).get("sha256"))
+        errors += [{"page_id": pid, "error": "TEMPLATE_EXHAUSTED"} for pid in short]
+        tokens = {pid: pt for pid, pt in tokens.items() if pid in variants}
+    if staged and not tokens:
+        _discard_staged({"file": staged})
+    items = []
+    for i, (pid, pt) in enumerate(tokens.items()):
+        payload = dict(base, page_id=pid, page_token=pt)
+        if pid in variants:
+            payload[text_key] = variants[pid]
+        if staged:
+            payload["file"] = staged if i == 0 else _stage_link(staged)
+        items.append(schedule_post(kind, pid, payload, due_at))
+    return jsonify({"data": items, "errors": errors}), (200 if items else 403)
+
+@app.route("/api/schedule")
+def api_schedule_list():
+    q, args = "SELECT * FROM scheduled_posts WHERE 1=1", []
+    if request.args.get("status"):
+        q += " AND status=?"; args.append(request.args["status"])
+    if request.args.get("page_id"):
+        q += " AND page_id=?"; args.append(request.args["page_id"])
+    try: limit = max(1, min(int(request.args.get("limit", "200")), 1000))
+    except Exception: limit = 200
+    rows = _db().execute(q + " ORDER BY fire_at LIMIT ?", (*args, limit)).fetchall()
+    return jsonify({"data": [_schedule_row(r) for r in rows]}), 200
+
+@app.route("/api/schedule/<sid>", methods=["DELETE"])
+def api_schedule_cancel(sid):
+    cur = _db().execute("UPDATE scheduled_posts SET status='cancelled', updated=? WHERE id=? AND status='pending'", (pytime.time(), sid))
+    if not cur.rowcount:
+        return jsonify({"error":"NOT_CANCELLABLE"}), 409
+    row = _db().execute("SELECT payload FROM scheduled_posts WHERE id=?", (sid,)).fetchone()
+    _discard_staged(json.loads(row["payload"]))
+    return jsonify({"ok": True}), 200
+
+# ----------------------------
+# Job status APIs
+# ----------------------------
+@app.route("/api/jobs")
+def api_list_jobs():
+    q, args = "SELECT * FROM jobs WHERE 1=1", []
+    if request.args.get("status"):
+        q += " AND status=?"; args.append(request.args["status"])
+    if request.args.get("type"):
+        q += " AND type=?"; args.append(request.args["type"])
+    try: limit = max(1, min(int(request.args.get("limit", "50")), 500))
+    except Exception: limit = 50
+    rows = _db().execute(q + " ORDER BY created DESC LIMIT ?", (*args, limit)).fetchall()
+    counts = {r["status"]: r["n"] for r in _db().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+    return jsonify({"data": [_job_row(r) for r in rows], "counts": counts, "concurrency": JOB_CONCURRENCY}), 200
+
+@app.route("/api/jobs/<job_id>")
+def api_get_job(job_id):
+    job = get_job(job_id)
+    if not job: return jsonify({"error":"JOB_NOT_FOUND"}), 404
+    return jsonify(job), 200
+
+@app.route("/api/jobs/<job_id>/cancel", methods=["POST"])
+def api_cancel_job(job_id):
+    cur = _db().execute("UPDATE jobs SET status='cancelled', updated=? WHERE id=? AND status='queued'", (pytime.time(), job_id))
+    if not cur.rowcount:
+        return jsonify({"error":"NOT_CANCELLABLE"}), 409
+    row = _db().execute("SELECT payload FROM jobs WHERE id=?", (job_id,)).fetchone()
+    _discard_staged(json.loads(row["payload"]))
+    _ledger_cancel(job_id)
+    return jsonify({"ok": True}), 200
+
+@app.route("/api/jobs/<job_id>/retry", methods=["POST"])
+def api_retry_job(job_id):
+    row = _db().execute("SELECT payload FROM jobs WHERE id=? AND status='failed'", (job_id,)).fetchone()
+    if not row:
+        return jsonify({"error":"NOT_RETRYABLE"}), 409
+    if not all(os.path.exists(p) for p in _staged_paths(json.loads(row["payload"]))):
+        return jsonify({"error":"STAGED_FILE_GONE"}), 409
+    _db().execute("UPDATE jobs SET status='queued', attempts=0, error=NULL, run_after=?, updated=? WHERE id=?",
+                  (pytime.time(), pytime.time(), job_id))
+    _JOB_STATE["wake"].set()
+    return jsonify({"ok": True}), 200
+
+# ----------------------------
+# INBOX APIs (new)
+# ----------------------------
+# shared by the sync views below and their async twins (ASGI), so the two cannot drift apart
+CONVERSATION_LIST_PARAMS = {"fields": "id,link,updated_time,unread_count,participants,senders", "limit": 20}
+CONVERSATION_PARAMS = {"fields": "id,link,messages.limit(50){id,created_time,from,to,message,attachments,shares,permalink_url},participants"}
+
+def _conversation_names(data: Any):
+    """Map participant IDs to names on messages whose sender has none, to render on client nicely."""
+    try:
+        id2name = {}
+        for pcp in (data.get("participants", {}) or {}).get("data", []) if isinstance(data, dict) else []:
+            pid = pcp.get("id"); nm = pcp.get("name")
+            if pid and nm: id2name[str(pid)] = nm
+        for m in (data.get("messages", {}) or {}).get("data", []) if isinstance(data, dict) else []:
+            fr = m.get("from") or {}
+            if fr.get("id") and not fr.get("name") and str(fr["id"]) in id2name:
+                fr["name"] = id2name[str(fr["id"])]
+                m["from"] = fr
+    except Exception:
+        pass
+
+def _send_message_form(body: Any) -> Tuple[Optional[Dict[str, str]], Any]:
+    """(Graph form for {recipient_id, text}, None), or (None, error response)."""
+    body = body if isinstance(body, dict) else {}
+    recipient_id = (body.get("recipient_id") or "").strip()
+    text = (body.get("text") or "").strip()
+    if not recipient_id or not text:
+        return None, (jsonify({"error":"MISSING_RECIPIENT_OR_TEXT"}), 400)
+    # For pages_messaging, recipient/message must be JSON strings in x-www-form-urlencoded
+    return {
+        "recipient": json.dumps({"id": recipient_id}),
+        "message": json.dumps({"text": text}),
+        "messaging_type": "RESPONSE"
+    }, None
+
+@app.route("/api/pages/<page_id>/conversations")
+def api_list_conversations(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    data, st = graph_get(f"{page_id}/conversations", dict(CONVERSATION_LIST_PARAMS), page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    return _json_response(data, st)
+
+@app.route("/api/pages/<page_id>/conversations/<thread_id>")
+def api_get_conversation(page_id, thread_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    data, st = graph_get(thread_id, dict(CONVERSATION_PARAMS), page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    _conversation_names(data)
+    if st == 200:
+        _media_register(_media_attach(page_id, data))
+    return _json_response(data, st)
+
+# ------- Unified inbox: per-page conversation lists synced into SQLite, k-way merged by updated_time -------
+INBOX_SYNC_TTL_SEC = int(os.environ.get("INBOX_SYNC_TTL_SEC", "60"))
+INBOX_SYNC_LIMIT = int(os.environ.get("INBOX_SYNC_LIMIT", "25"))
+INBOX_FETCH_CONCURRENCY = int(os.environ.get("INBOX_FETCH_CONCURRENCY", "8"))
+INBOX_FIELDS = "id,link,updated_time,unread_count,participants,senders"
+
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS inbox_threads (
+        page_id TEXT NOT NULL, thread_id TEXT NOT NULL, updated_time TEXT NOT NULL,
+        unread_count INTEGER NOT NULL DEFAULT 0, data TEXT NOT NULL, PRIMARY KEY (page_id, thread_id))""",
+    "CREATE INDEX IF NOT EXISTS inbox_threads_page_time ON inbox_threads(page_id, updated_time DESC, thread_id DESC)",
+    "CREATE TABLE IF NOT EXISTS inbox_pages (page_id TEXT PRIMARY KEY, synced_at REAL NOT NULL, error TEXT)",
+]
+
+def _known_page_ids(user_token: Optional[str]) -> List[str]:
+    """Every page we hold a token for (ENV, tokens.json, app pool); falls back to listing the user's pages."""
+    ids = [*_env_get_tokens()[0], *_ENV_PAGES["loose"], *(load_tokens().get("pages") or {})]
+    for a in _APPS.values():
+        ids.extend(a["page_tokens"])
+    if not ids and user_token:
+        data, st = graph_get("me/accounts", {"fields": "id", "limit": 200}, user_token, ttl=0)
+        if st == 200 and isinstance(data, dict):
+            ids = [str(p["id"]) for p in data.get("data", []) if p.get("id")]
+    return list(dict.fromkeys(str(x) for x in ids))
+
+def _inbox_stale(page_ids: List[str]) -> List[str]:
+    """Pages whose stored list is older than INBOX_SYNC_TTL_SEC or predates their latest webhook event."""
+    conn, now = _db(), pytime.time()
+    synced = {r["page_id"]: r["synced_at"] for r in conn.execute(
+        f"SELECT page_id, synced_at FROM inbox_pages WHERE page_id IN ({','.join('?' * len(page_ids))})", page_ids)}
+    stale = []
+    for pid in page_ids:
+        at = synced.get(pid)
+        if at is None or now - at > INBOX_SYNC_TTL_SEC:
+            stale.append(pid)
+            continue
+        ev = conn.execute("SELECT ts FROM event_index WHERE page_id=? ORDER BY offset DESC LIMIT 1", (pid,)).fetchone()
+        if ev and ev["ts"] > at:
+            stale.append(pid)
+    return stale
+
+def _inbox_sync_page(page_id: str, page_token: str) -> Tuple[Any, int]:
+    started = pytime.time()  # an event arriving mid-fetch must still mark the page stale
+    data, st = graph_get(f"{page_id}/conversations", {"fields": INBOX_FIELDS, "limit": INBOX_SYNC_LIMIT}, page_token,
+                         ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    conn = _db()
+    if st != 200 or not isinstance(data, dict):
+        # keep the last good list and retry after the TTL rather than on every listing
+        conn.execute("INSERT OR REPLACE INTO inbox_pages(page_id, synced_at, error) VALUES (?,?,?)",
+                     (page_id, started, json.dumps(data, ensure_ascii=False)[:500]))
+        return data, st
+    rows = [(page_id, str(t["id"]), t.get("updated_time") or "", int(t.get("unread_count") or 0), json.dumps(t, ensure_ascii=False))
+            for t in data.get("data", []) if t.get("id")]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM inbox_threads WHERE page_id=?", (page_id,))
+        conn.executemany("INSERT OR REPLACE INTO inbox_threads(page_id,thread_id,updated_time,unread_count,data) VALUES (?,?,?,?,?)", rows)
+        conn.execute("INSERT OR REPLACE INTO inbox_pages(page_id, synced_at, error) VALUES (?,?,NULL)", (page_id, started))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return {"threads": len(rows)}, 200
+
+def _inbox_sync(pages: Dict[str, str]) -> Dict[str, Any]:
+    """Refresh the given {page_id: page_token} concurrently; the Graph gate still spaces the calls."""
+    from concurrent.futures import ThreadPoolExecutor
+    lane, errors = _current_lane(), {}
+    def one(pid):
+        with graph_lane(lane):
+            try: return pid, _inbox_sync_page(pid, pages[pid])
+            except Exception as e: return pid, ({"error": str(e)}, 500)
+    if pages:
+        with ThreadPoolExecutor(max_workers=max(1, min(INBOX_FETCH_CONCURRENCY, len(pages)))) as ex:
+            for pid, (data, st) in ex.map(one, list(pages)):
+                if st != 200: errors[pid] = {"status": st, "data": data}
+    return errors
+
+def _inbox_cursor_encode(key: Tuple[str, str, str]) -> str:
+    import base64
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+def _inbox_cursor_decode(cursor: str) -> Optional[Tuple[str, str, str]]:
+    import base64
+    try:
+        ut, pid, tid = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(ut), str(pid), str(tid)
+    except Exception:
+        return None
+
+def _inbox_page_stream(page_id: str, after: Optional[Tuple[str, str, str]]):
+    """One page's threads, newest first, strictly after the cursor in (updated_time, page_id, thread_id) order."""
+    q, args = "SELECT page_id, thread_id, updated_time, data FROM inbox_threads WHERE page_id=?", [page_id]
+    if after:
+        q += " AND (updated_time, page_id, thread_id) < (?, ?, ?)"
+        args.extend(after)
+    for r in _db().execute(q + " ORDER BY updated_time DESC, thread_id DESC", args):
+        yield (r["updated_time"], r["page_id"], r["thread_id"]), r["data"]
+
+@app.route("/api/inbox")
+def api_unified_inbox():
+    """All pages' conversations merged newest first: ?limit=&cursor=&page_ids=a,b&refresh=1."""
+    from itertools import islice
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    wanted = [x.strip() for x in (request.args.get("page_ids") or "").split(",") if x.strip()]
+    page_ids = wanted or _known_page_ids(token)
+    if not page_ids:
+        return jsonify({"error": "NOT_LOGGED_IN" if not token else "NO_PAGES"}), 401 if not token else 404
+    try: limit = max(1, min(int(request.args.get("limit", "30")), 200))
+    except ValueError: limit = 30
+    after = _inbox_cursor_decode(request.args["cursor"]) if request.args.get("cursor") else None
+    errors: Dict[str, Any] = {}
+    if not after:  # later pages of the same listing read the store as synced for the first page
+        stale = page_ids if request.args.get("refresh") == "1" else _inbox_stale(page_ids)
+        tokens = {}
+        for pid in stale:
+            pt = get_page_access_token(pid, token)
+            if pt: tokens[pid] = pt
+            else: errors[pid] = {"status": 403, "data": {"error": "NO_PAGE_TOKEN"}}
+        errors.update(_inbox_sync(tokens))
+    merged = heapq.merge(*(_inbox_page_stream(pid, after) for pid in page_ids), key=lambda x: x[0], reverse=True)
+    batch = list(islice(merged, limit + 1))
+    out = []
+    for (ut, pid, tid), raw in batch[:limit]:
+        t = json.loads(raw)
+        t["page_id"] = pid
+        out.append(t)
+    marks = ",".join("?" * len(page_ids))
+    by_page = {r["page_id"]: {"unread": int(r["unread"] or 0), "threads": r["n"]} for r in _db().execute(
+        f"SELECT page_id, SUM(unread_count) AS unread, COUNT(*) AS n FROM inbox_threads WHERE page_id IN ({marks}) GROUP BY page_id", page_ids)}
+    return _json_response({
+        "data": out,
+        "paging": {"next_cursor": _inbox_cursor_encode(batch[limit - 1][0]) if len(batch) > limit else None},
+        "unread": {"total": sum(v["unread"] for v in by_page.values()),
+                   "threads_with_unread": _db().execute(f"SELECT COUNT(*) FROM inbox_threads WHERE unread_count > 0 AND page_id IN ({marks})", page_ids).fetchone()[0],
+                   "by_page": by_page},
+        "pages": {"count": len(page_ids), "errors": errors or {r["page_id"]: {"data": r["error"]} for r in _db().execute(
+            f"SELECT page_id, error FROM inbox_pages WHERE error IS NOT NULL AND page_id IN ({marks})", page_ids)}},
+    })
+
+@app.route("/api/pages/<page_id>/messages", methods=["POST"])
+def api_send_message(page_id):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    data, err = _send_message_form(request.get_json(force=True))
+    if err: return err
+    res, st = graph_post(f"{page_id}/messages", data, page_token, ctx_key=_ctx_key_for_page(page_id))
+    return jsonify(res), st
 
-  <div id="panel-page-info" class="panel">
-    <div class="row">
-      <div class="col">
-        <div class="card">
-          <h3>Chọn Page</h3>
-          <select id="info_page"></select>
-          <button class="btn" id="btn_load_info" style="margin-top:8px">Tải thông tin</button>
-        </div>
-        <div class="card" style="margin-top:12px">
-          <h3>Thông tin cơ bản</h3>
-          <div class="grid">
-            <input id="pg_name" placeholder="Tên Page"/>
-            <input id="pg_phone" placeholder="Số điện thoại"/>
-            <input id="pg_website" placeholder="Website"/>
-            <input id="pg_desc" placeholder="Mô tả (description)"/>
-          </div>
-          <div class="grid" style="margin-top:8px">
-            <input id="addr_street" placeholder="Địa chỉ (street)"/>
-            <input id="addr_city" placeholder="Thành phố"/>
-            <input id="addr_zip" placeholder="Mã bưu chính"/>
-            <input id="addr_country" placeholder="Quốc gia (VN, US...)"/>
-          </div>
-          <label style="display:flex;gap:6px;align-items:center;margin-top:8px">
-            <input type="checkbox" id="always_open"/> Luôn mở cửa
-          </label>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn primary" id="btn_save_info">Lưu thay đổi</button>
-          </div>
-          <div class="status" id="info_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Ảnh đại diện & Ảnh bìa</h3>
-          <div class="grid">
-            <div>
-              <label>Ảnh đại diện</label>
-              <input type="file" id="pic_avatar" accept="image/*"/>
-              <button class="btn" id="btn_set_avatar" style="margin-top:6px">Đổi avatar</button>
-            </div>
-            <div>
-              <label>Ảnh bìa</label>
-              <input type="file" id="pic_cover" accept="image/*"/>
-              <button class="btn" id="btn_set_cover" style="margin-top:6px">Đổi cover</button>
-            </div>
-          </div>
-          <div class="status" id="pic_status"></div>
-        </div>
-      </div>
-    </div>
-  </div>
+# ----------------------------
+# Comments: feed webhook ingestion, incremental per-post backfill, bulk moderation through Graph batch requests
+# ----------------------------
+COMMENT_BACKFILL_PAGE_SIZE = 100
+COMMENT_BACKFILL_MAX_PAGES = int(os.environ.get("COMMENT_BACKFILL_MAX_PAGES", "20"))
+COMMENT_BACKFILL_RECENT_POSTS = int(os.environ.get("COMMENT_BACKFILL_RECENT_POSTS", "50"))
+GRAPH_BATCH_MAX = 50
+COMMENT_FIELDS = "id,message,from{id,name},created_time,parent{id},is_hidden"
 
-  <div class="pin-overlay" id="pin_overlay">
-    <div class="pin-box">
-      <h3>Nhập mã PIN để truy cập</h3>
-      <input id="pin_input" placeholder="Nhập PIN" type="password" style="margin-top:8px"/>
-      <div class="toolbar" style="margin-top:8px">
-        <button class="btn primary" id="btn_pin_ok">Xác nhận</button>
-      </div>
-      <div class="status" id="pin_status"></div>
-    </div>
-  </div>
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS comments (
+        comment_id TEXT PRIMARY KEY,
+        page_id TEXT NOT NULL,
+        post_id TEXT,
+        parent_id TEXT,
+        from_id TEXT,
+        from_name TEXT,
+        message TEXT,
+        created_time REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'visible',
+        updated REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS comments_page_time ON comments(page_id, created_time DESC)",
+    "CREATE INDEX IF NOT EXISTS comments_post_time ON comments(post_id, created_time DESC)",
+    "CREATE INDEX IF NOT EXISTS comments_from ON comments(from_id)",
+    "CREATE TABLE IF NOT EXISTS comment_sync (post_id TEXT PRIMARY KEY, page_id TEXT NOT NULL, synced_until REAL NOT NULL, synced_at REAL NOT NULL)",
+    # a backfill that hit COMMENT_BACKFILL_MAX_PAGES: where to resume, and the newest comment time of that walk
+    "CREATE TABLE IF NOT EXISTS comment_sync_gap (post_id TEXT PRIMARY KEY, after TEXT NOT NULL, newest REAL NOT NULL, updated REAL NOT NULL)",
+]
+_COMMENT_VERB_STATUS = {"add": "visible", "edited": "visible", "unhide": "visible", "hide": "hidden", "remove": "deleted"}
 
-<script>
-const $ = sel => document.querySelector(sel);
-const sleep = (ms) => new Promise(res => setTimeout(res, ms));
+def _graph_time(v: Any) -> float:
+    """Unix seconds from a webhook int or a Graph ISO time (2024-01-31T10:00:00+0000)."""
+    if isinstance(v, (int, float)):
+        return float(v)
+    from datetime import datetime
+    try:
+        return datetime.strptime(str(v), "%Y-%m-%dT%H:%M:%S%z").timestamp()
+    except (TypeError, ValueError):
+        return pytime.time()
 
-async function ensurePin(){
-  try{
-    const r = await fetch('/api/pin/status');
-    const d = await r.json();
-    if(d.need_pin && !d.ok){
-      $('#pin_overlay').style.display = 'flex';
-    }
-  }catch(e){}
-}
-$('#btn_pin_ok').onclick = async () => {
-  const pin = ($('#pin_input').value||'').trim();
-  const st = $('#pin_status');
-  if(!pin){ st.textContent='Nhập PIN trước'; return; }
-  const r = await fetch('/api/pin/login', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({pin})});
-  const d = await r.json();
-  if(d.ok){ $('#pin_overlay').style.display='none'; location.reload(); }
-  else{ st.textContent='PIN sai'; }
-};
+def _comment_upsert(rows: List[Tuple]):
+    """rows: (comment_id, page_id, post_id, parent_id, from_id, from_name, message, created_time, status)."""
+    now = pytime.time()
+    _db().executemany(
+        """INSERT INTO comments(comment_id,page_id,post_id,parent_id,from_id,from_name,message,created_time,status,updated)
+           VALUES (?,?,?,?,?,?,?,?,?,?)
+           ON CONFLICT(comment_id) DO UPDATE SET
+             message=COALESCE(excluded.message, comments.message), status=excluded.status, updated=excluded.updated,
+             from_name=COALESCE(excluded.from_name, comments.from_name)""",
+        [(*r, now) for r in rows])
 
-function showTab(name){
-  ['posts','inbox','settings','page-info'].forEach(n=>{
-    const id = n==='page-info' ? 'page-info' : n;
-    $('#tab-'+id).classList.toggle('active', id===name);
-    $('#panel-'+id).classList.toggle('active', id===name);
-  });
-}
-$('#tab-posts').onclick = ()=>showTab('posts');
-$('#tab-inbox').onclick = ()=>{ showTab('inbox'); loadPagesToSelect('inbox_page'); };
-$('#tab-page-info').onclick = ()=>{ showTab('page-info'); loadPagesToSelect('info_page'); };
+@event_consumer("comments")
+def _ingest_comment_events(records: List[Dict[str, Any]]):
+    rows = []
+    for rec in records:
+        en = rec.get("data") or {}
+        if not isinstance(en, dict): continue
+        for chg in en.get("changes", []) or []:
+            val = chg.get("value") or {}
+            if chg.get("field") != "feed" or val.get("item") not in ("comment", "reply") or not val.get("comment_id"):
+                continue
+            frm = val.get("from") or {}
+            rows.append((str(val["comment_id"]), str(en.get("id") or rec.get("page_id") or ""), val.get("post_id"),
+                         val.get("parent_id") if val.get("parent_id") != val.get("post_id") else None,
+                         frm.get("id"), frm.get("name"), val.get("message"),
+                         _graph_time(val.get("created_time") or en.get("time") or rec.get("ts")),
+                         _COMMENT_VERB_STATUS.get(val.get("verb"), "visible")))
+    if rows:
+        _comment_upsert(rows)
 
-const pagesBox = $('#pages');
-const pagesStatus = $('#pages_status');
+@job_handler("comment_backfill", pool="sync", lane="background")
+def _job_comment_backfill(p: dict):
+    """
+    Pull comments newer than each post's watermark, newest first, stopping at the first one already covered.
+    A walk cut short by the page cap resumes from its cursor on the next run; the watermark only moves once it closes.
+    """
+    page_id, page_token, done = p["page_id"], p["page_token"], {}
+    for post_id in p["post_ids"]:
+        row = _db().execute("SELECT synced_until FROM comment_sync WHERE post_id=?", (post_id,)).fetchone()
+        gap = _db().execute("SELECT after, newest FROM comment_sync_gap WHERE post_id=?", (post_id,)).fetchone()
+        until, fetched = (row["synced_until"] if row else 0.0), 0
+        newest, params = (gap["newest"], {"after": gap["after"]}) if gap else (0.0, {})
+        for _ in range(COMMENT_BACKFILL_MAX_PAGES):
+            data, st = graph_get(f"{post_id}/comments", dict(params, fields=COMMENT_FIELDS, filter="stream",
+                                 order="reverse_chronological", limit=COMMENT_BACKFILL_PAGE_SIZE),
+                                 page_token, ctx_key=_ctx_key_for_page(page_id))
+            if st != 200 or not isinstance(data, dict):
+                if gap and st == 400 and params.get("after") == gap["after"]:
+                    _db().execute("DELETE FROM comment_sync_gap WHERE post_id=?", (post_id,))  # cursor expired: start over
+                done[post_id] = {"status": st, "data": data}
+                break
+            rows, reached = [], False
+            for c in data.get("data", []):
+                ct = _graph_time(c.get("created_time"))
+                if ct <= until:
+                    reached = True
+                    break
+                frm = c.get("from") or {}
+                rows.append((str(c["id"]), page_id, post_id, (c.get("parent") or {}).get("id"), frm.get("id"), frm.get("name"),
+                             c.get("message"), ct, "hidden" if c.get("is_hidden") else "visible"))
+                newest = max(newest, ct)
+            _comment_upsert(rows)
+            fetched += len(rows)
+            after = ((data.get("paging") or {}).get("cursors") or {}).get("after")
+            if reached or not after or not (data.get("paging") or {}).get("next"):
+                break
+            params = {"after": after}
+        else:
+            # hit the page cap: the old watermark stays, and the next run carries on below the last page read
+            _db().execute("INSERT OR REPLACE INTO comment_sync_gap(post_id,after,newest,updated) VALUES (?,?,?,?)",
+                          (post_id, params["after"], newest, pytime.time()))
+            done[post_id] = {"status": 200, "data": {"fetched": fetched, "resume": True}}
+            continue
+        if post_id not in done:
+            _db().execute("INSERT OR REPLACE INTO comment_sync(post_id,page_id,synced_until,synced_at) VALUES (?,?,?,?)",
+                          (post_id, page_id, max(until, newest), pytime.time()))
+            _db().execute("DELETE FROM comment_sync_gap WHERE post_id=?", (post_id,))
+            done[post_id] = {"status": 200, "data": {"fetched": fetched}}
+    failed = [k for k, v in done.items() if v["status"] != 200]
+    return {"posts": done, "failed": len(failed)}, (200 if not failed or len(failed) < len(done) else done[failed[0]]["status"])
 
-async function loadPages(){
-  pagesBox.innerHTML = '<div class="muted">Đang tải...</div>';
-  try{
-    const r = await fetch('/api/pages');
-    const d = await r.json();
-    if(d.error){ pagesStatus.textContent = JSON.stringify(d); return; }
-        
-    const arr = d.data || [];
-// Sort pages by name (vi locale)
-    arr.sort((a,b)=> (a.name||'').localeCompare(b.name||'', 'vi', {sensitivity:'base'}));
-    pagesBox.innerHTML = arr.map(p => (
-      '<div class="item">'
-      + '<label>'
-      + '<span class="page-name">'+(p.name||'')+'</span>'
-      + '<input type="checkbox" class="pg" value="'+p.id+'" data-name="'+(p.name||'')+'">'
-      + '</label>'
-      + '</div>'
-    )).join('');
-    pagesStatus.textContent = 'Tải ' + arr.length + ' page.';
-  }catch(e){ pagesStatus.textContent = 'Lỗi tải danh sách page: ' + (e && (e.message||e.toString()) || ''); }
-}
-loadPages(); loadPagesToSelect('inbox_page'); ensurePin(); pollNewEvents();
+def _graph_batch(page_id: str, page_token: str, ops: List[Dict[str, Any]], idempotent: bool, key: Optional[str]):
+    """One Graph batch request (up to GRAPH_BATCH_MAX ops); returns per-op (status, body)."""
+    data, st = graph_post("", {"batch": json.dumps(ops), "include_headers": "false"}, page_token,
+                          ctx_key=_ctx_key_for_page(page_id), idempotent=idempotent, idempotency_key=key)
+    if st != 200 or not isinstance(data, list):
+        return [(st, data)] * len(ops)
+    out = []
+    for item in data:
+        if not isinstance(item, dict):
+            out.append((500, {"error": "NO_RESPONSE"}))  # op not run (batch timeout); safe to retry
+            continue
+        try: body = json.loads(item.get("body") or "null")
+        except ValueError: body = item.get("body")
+        out.append((int(item.get("code") or 500), body))
+    return out
 
-function selectedPageIds(){
-  return Array.from(document.querySelectorAll('.pg:checked')).map(i=>i.value);
+_MODERATION_OPS = {
+    "hide": (lambda cid, msg: {"method": "POST", "relative_url": cid, "body": "is_hidden=true"}, "hidden"),
+    "unhide": (lambda cid, msg: {"method": "POST", "relative_url": cid, "body": "is_hidden=false"}, "visible"),
+    "delete": (lambda cid, msg: {"method": "DELETE", "relative_url": cid}, "deleted"),
+    "reply": (lambda cid, msg: {"method": "POST", "relative_url": f"{cid}/comments", "body": urlencode({"message": msg or ""})}, None),
 }
 
-async function loadPagesToSelect(selectId){
-  const sel = $('#'+selectId);
-  try{
-    const r = await fetch('/api/pages');
-    const d = await r.json();
-    if(d && d.error){
-      sel.innerHTML = '<option value="">(Lỗi: ' + String(d.error) + ')</option>';
-      const st = $('#inbox_status'); if(st){ st.textContent = 'Không tải được danh sách Page: ' + String(d.error); }
-      return;
-    }
-    const arr = (d && d.data) || [];
-    sel.innerHTML = '<option value="">--Chọn page--</option>' + arr.map(p=>'<option value="'+p.id+'">'+(p.name||p.id)+'</option>').join('');
-    const st = $('#inbox_status'); if(st){ st.textContent = 'Đã nạp ' + arr.length + ' page.'; }
-  }catch(e){
-    sel.innerHTML = '<option value="">(Không tải được)</option>';
-    const st = $('#inbox_status'); if(st){ st.textContent = 'Lỗi tải danh sách Page: ' + (e && (e.message||String(e)) || ''); }
-  }
+@job_handler("comment_moderation", pool="moderation")
+def _job_comment_moderation(p: dict):
+    build, status_after = _MODERATION_OPS[p["action"]]
+    page_id, page_token, ids = p["page_id"], p["page_token"], p["comment_ids"]
+    results: Dict[str, Any] = dict(p.get("results") or {})
+    todo = [cid for cid in ids if results.get(cid, {}).get("status", 0) not in (200,)]
+    for i in range(0, len(todo), GRAPH_BATCH_MAX):
+        chunk = todo[i:i + GRAPH_BATCH_MAX]
+        key = f"{p['_job_id']}:{page_id}:reply:{_hash_content(','.join(chunk))[:16]}" if p["action"] == "reply" and p.get("_job_id") else None
+        for cid, (st, body) in zip(chunk, _graph_batch(page_id, page_token, [build(cid, p.get("message")) for cid in chunk],
+                                                       p["action"] != "reply", key)):
+            results[cid] = {"status": st, "data": body}
+        ok = [(status_after, pytime.time(), cid) for cid in chunk if results[cid]["status"] == 200]
+        if status_after and ok:
+            _db().executemany("UPDATE comments SET status=?, updated=? WHERE comment_id=?", ok)
+        if p.get("_job_id"):
+            p["results"] = results  # a retried job skips what already succeeded
+            saved = _strip_tokens({k: v for k, v in p.items() if k != "_job_id"})[0]
+            _db().execute("UPDATE jobs SET payload=?, updated=? WHERE id=?",
+                          (json.dumps(saved, ensure_ascii=False), pytime.time(), p["_job_id"]))
+    failed = {cid: r for cid, r in results.items() if r["status"] != 200}
+    summary = {"action": p["action"], "total": len(ids), "ok": len(ids) - len(failed), "failed": len(failed), "results": results}
+    retry = [r for r in failed.values() if _is_retryable(r["data"], r["status"])]
+    return summary, (retry[0]["status"] if retry else 200)
+
+@app.route("/api/comments")
+def api_list_comments():
+    """Stored comments newest first: ?page_id=&post_id=&status=&from_id=&q=&since=&before=<created_time>&limit="""
+    q, args = "SELECT * FROM comments WHERE 1=1", []
+    for col in ("page_id", "post_id", "status", "from_id"):
+        if request.args.get(col):
+            q += f" AND {col}=?"; args.append(request.args[col])
+    if request.args.get("q"):
+        q += " AND message LIKE ?"; args.append(f"%{request.args['q']}%")
+    try:
+        if request.args.get("since"): q += " AND created_time >= ?"; args.append(float(request.args["since"]))
+        if request.args.get("before"): q += " AND created_time < ?"; args.append(float(request.args["before"]))
+        limit = max(1, min(int(request.args.get("limit", "100")), 1000))
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    rows = [dict(r) for r in _db().execute(q + " ORDER BY created_time DESC LIMIT ?", (*args, limit))]
+    return _json_response({"data": rows, "paging": {"before": rows[-1]["created_time"] if len(rows) == limit else None}})
+
+@app.route("/api/pages/<page_id>/comments/backfill", methods=["POST"])
+def api_comment_backfill(page_id):
+    """Backfill the given post_ids, or the page's most recently published posts."""
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    page_token = get_page_access_token(page_id, token)
+    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    body = request.get_json(silent=True) or {}
+    post_ids = [str(x) for x in body.get("post_ids") or [] if str(x).strip()]
+    if not post_ids:
+        post_ids = [r["object_id"] for r in _db().execute(
+            "SELECT object_id FROM permalinks WHERE page_id=? ORDER BY created DESC LIMIT ?", (page_id, COMMENT_BACKFILL_RECENT_POSTS))]
+    if not post_ids: return jsonify({"error":"NO_POSTS"}), 400
+    return _job_accepted(enqueue_job("comment_backfill", {"page_id": page_id, "page_token": page_token, "post_ids": post_ids}))
+
+@app.route("/api/comments/bulk", methods=["POST"])
+def api_comment_bulk():
+    """{"action": hide|unhide|delete|reply, "comment_ids": [...], "message": ".." (reply), "page_id": ".." (for unknown ids)}"""
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    body = request.get_json(force=True) or {}
+    action = body.get("action")
+    if action not in _MODERATION_OPS: return jsonify({"error":"INVALID_ACTION"}), 400
+    if action == "reply" and not (body.get("message") or "").strip(): return jsonify({"error":"MISSING_MESSAGE"}), 400
+    ids = list(dict.fromkeys(str(x).strip() for x in body.get("comment_ids") or [] if str(x).strip()))
+    if not ids: return jsonify({"error":"NO_COMMENTS"}), 400
+    known = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        known.update({r["comment_id"]: r["page_id"] for r in _db().execute(
+            f"SELECT comment_id, page_id FROM comments WHERE comment_id IN ({','.join('?' * len(chunk))})", chunk)})
+    by_page: Dict[str, List[str]] = {}
+    unknown = []
+    for cid in ids:
+        pid = known.get(cid) or body.get("page_id")
+        if pid: by_page.setdefault(str(pid), []).append(cid)
+        else: unknown.append(cid)
+    jobs, errors = {}, {}
+    for pid, cids in by_page.items():
+        pt = get_page_access_token(pid, token)
+        if not pt:
+            errors[pid] = "NO_PAGE_TOKEN"
+            continue
+        jobs[pid] = enqueue_job("comment_moderation", {"action": action, "page_id": pid, "page_token": pt,
+                                                       "comment_ids": cids, "message": body.get("message")})
+    if not jobs: return jsonify({"error":"NO_PAGE_TOKEN", "pages": errors, "unknown": unknown}), 403
+    return jsonify({"jobs": jobs, "status_urls": {pid: f"/api/jobs/{j}" for pid, j in jobs.items()},
+                    "errors": errors, "unknown": unknown}), 202
+
+# ----------------------------
+# Insights: periodic collector (multi-ID reads, paged page insights) into SQLite with covering indexes
+# ----------------------------
+INSIGHTS_INTERVAL_SEC = int(os.environ.get("INSIGHTS_INTERVAL_SEC", "1800"))
+INSIGHTS_MAX_AGE_DAYS = int(os.environ.get("INSIGHTS_MAX_AGE_DAYS", "28"))  # posts older than this are frozen
+INSIGHTS_BATCH_POSTS = int(os.environ.get("INSIGHTS_BATCH_POSTS", "2000"))
+INSIGHTS_PAGE_MAX_PAGES = 10
+INSIGHTS_POST_METRICS = os.environ.get("INSIGHTS_POST_METRICS", "post_impressions,post_impressions_unique,post_clicks")
+INSIGHTS_VIDEO_METRICS = os.environ.get("INSIGHTS_VIDEO_METRICS", "total_video_impressions,total_video_impressions_unique,total_video_views")
+INSIGHTS_PAGE_METRICS = os.environ.get("INSIGHTS_PAGE_METRICS", "page_impressions,page_impressions_unique,page_post_engagements")
+_INSIGHT_COUNTS = "reactions.summary(total_count).limit(0),comments.summary(total_count).limit(0)"
+# stored column <- Graph metric name
+_INSIGHT_COLUMNS = {
+    "impressions": ("post_impressions", "total_video_impressions"),
+    "reach": ("post_impressions_unique", "total_video_impressions_unique"),
+    "clicks": ("post_clicks",),
+    "video_views": ("total_video_views",),
 }
+_INSIGHT_SUMS = ("impressions", "reach", "clicks", "reactions", "comments", "shares", "video_views")
 
-// AI writer
-$('#btn_ai').onclick = async () => {
-  const prompt = ($('#ai_prompt').value||'').trim();
-  const tone = $('#ai_tone').value;
-  const length = $('#ai_length').value;
-  const keyword = ($('#ai_keyword').value||'MB66').trim();
-  const link = ($('#ai_link').value||'').trim();
-  const st = $('#ai_status');
-  if(!keyword){ st.textContent='Nhập từ khoá chính (VD: MB66)'; return; }
-  st.textContent = 'Đang tạo nội dung...';
-  try{
-    const r = await fetch('/api/ai/generate', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({prompt, tone, length, keyword, link})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    $('#post_text').value = d.text || '';
-    st.textContent = 'Đã chèn nội dung vào khung soạn.';
-  }catch(e){ st.textContent = 'Lỗi gọi AI'; }
-};
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS insight_posts (
+        post_id TEXT PRIMARY KEY,
+        page_id TEXT NOT NULL,
+        campaign_id TEXT,
+        kind TEXT NOT NULL,
+        published_at REAL NOT NULL,
+        collected_at REAL NOT NULL DEFAULT 0,
+        impressions INTEGER NOT NULL DEFAULT 0,
+        reach INTEGER NOT NULL DEFAULT 0,
+        clicks INTEGER NOT NULL DEFAULT 0,
+        reactions INTEGER NOT NULL DEFAULT 0,
+        comments INTEGER NOT NULL DEFAULT 0,
+        shares INTEGER NOT NULL DEFAULT 0,
+        video_views INTEGER NOT NULL DEFAULT 0,
+        error TEXT)""",
+    # covering indexes: the aggregate queries below never touch the table rows
+    f"CREATE INDEX IF NOT EXISTS insight_posts_campaign ON insight_posts(campaign_id, published_at, {', '.join(_INSIGHT_SUMS)})",
+    f"CREATE INDEX IF NOT EXISTS insight_posts_page ON insight_posts(page_id, published_at, {', '.join(_INSIGHT_SUMS)})",
+    f"CREATE INDEX IF NOT EXISTS insight_posts_time ON insight_posts(published_at, {', '.join(_INSIGHT_SUMS)})",
+    "CREATE INDEX IF NOT EXISTS insight_posts_due ON insight_posts(collected_at, published_at)",
+    """CREATE TABLE IF NOT EXISTS page_insights (
+        page_id TEXT NOT NULL, metric TEXT NOT NULL, end_time REAL NOT NULL, value INTEGER NOT NULL,
+        PRIMARY KEY (page_id, metric, end_time)) WITHOUT ROWID""",
+]
 
-// Publish
-$('#btn_publish').onclick = async () => {
-  const pages = selectedPageIds();
-  const text = ($('#post_text').value||'').trim();
-  const type = $('#post_type').value;
-  const photo = $('#photo_input').files[0] || null;
-  const video = $('#video_input').files[0] || null;
-  const caption = ($('#media_caption').value||'');
-  const st = $('#post_status');
+def _insights_track(page_id: str, post_id: str, kind: str, campaign_id: Optional[str] = None, published_at: Optional[float] = None):
+    _db().execute("INSERT OR IGNORE INTO insight_posts(post_id, page_id, campaign_id, kind, published_at) VALUES (?,?,?,?,?)",
+                  (post_id, page_id, campaign_id, kind, published_at or pytime.time()))
 
-  if(!pages.length){ st.textContent='Chọn ít nhất một page'; return; }
-  if(type === 'feed' && !text && !photo && !video){ st.textContent='Cần nội dung hoặc tệp'; return; }
-  if(type === 'reels' && !video){ st.textContent='Cần chọn video cho Reels'; return; }
+def _background_page_token(page_id: str) -> Optional[str]:
+    return get_page_access_token(page_id, (load_tokens().get("user_long") or {}).get("access_token"))
 
-  st.textContent='Đang đăng (có giãn cách an toàn)...';
-  try{
-    const results = [];
-    for(const pid of pages){
-      let d;
-      if(type === 'feed'){
-        if(video){
-          const fd = new FormData();
-          fd.append('video', video);
-          fd.append('description', caption || text || '');
-          const r = await fetch('/api/pages/'+pid+'/video', {method:'POST', body: fd});
-          d = await r.json();
-        }else if(photo){
-          const fd = new FormData();
-          fd.append('photo', photo);
-          fd.append('caption', caption || text || '');
-          const r = await fetch('/api/pages/'+pid+'/photo', {method:'POST', body: fd});
-          d = await r.json();
-        }else{
-          const r = await fetch('/api/pages/'+pid+'/post', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({message: text})});
-          d = await r.json();
-        }
-      }else{
-        const fd = new FormData();
-        fd.append('video', video);
-        fd.append('description', caption || text || '');
-        const r = await fetch('/api/pages/'+pid+'/reel', {method:'POST', body: fd});
-        d = await r.json();
-      }
-      if(d.error){ results.push('❌ ' + pid + ': ' + JSON.stringify(d)); }
-      else{
-        const link = d.permalink_url ? ' · <a target="_blank" href="'+d.permalink_url+'">Mở bài</a>' : '';
-        results.push('✅ ' + pid + link);
-      }
-      await sleep(1500 + Math.floor(Math.random()*1500));
-    }
-    st.innerHTML = results.join('<br/>');
-  }catch(e){ st.textContent='Lỗi đăng'; }
-};
+def _insight_values(obj: Dict[str, Any], edge: str) -> Dict[str, int]:
+    out = {}
+    for m in ((obj.get(edge) or {}).get("data") or []):
+        vals = m.get("values") or []
+        v = vals[-1].get("value") if vals else None
+        if isinstance(v, (int, float)): out[m.get("name")] = int(v)
+    return out
 
-// Settings: save + exchange
-$('#btn_save_cfg').onclick = async () => {
-  const app_id = $('#cfg_app_id').value.trim();
-  const app_secret = $('#cfg_app_secret').value.trim();
-  const st = $('#cfg_status');
-  if(!app_id || !app_secret){ st.textContent='Nhập App ID & Secret'; return; }
-  try{
-    const r = await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã lưu cấu hình.';
-  }catch(e){ st.textContent='Lỗi lưu cấu hình'; }
-};
+def _insights_row(obj: Dict[str, Any]) -> Dict[str, int]:
+    metrics = {**_insight_values(obj, "insights"), **_insight_values(obj, "video_insights")}
+    row = {col: next((metrics[n] for n in names if n in metrics), 0) for col, names in _INSIGHT_COLUMNS.items()}
+    row["reactions"] = int(((obj.get("reactions") or {}).get("summary") or {}).get("total_count") or 0)
+    row["comments"] = int(((obj.get("comments") or {}).get("summary") or {}).get("total_count") or 0)
+    row["shares"] = int((obj.get("shares") or {}).get("count") or 0)
+    return row
+
+def _collect_post_insights(page_id: str, page_token: str, kind_group: str, post_ids: List[str]) -> int:
+    """One ?ids= read per GRAPH_MAX_IDS posts; if the metrics are refused, fall back to the public counters."""
+    if kind_group == "video":
+        full = f"video_insights.metric({INSIGHTS_VIDEO_METRICS}){{name,values}},{_INSIGHT_COUNTS}"
+    else:
+        full = f"insights.metric({INSIGHTS_POST_METRICS}){{name,values}},{_INSIGHT_COUNTS},shares"
+    done = 0
+    for i in range(0, len(post_ids), GRAPH_MAX_IDS):
+        chunk, err = post_ids[i:i + GRAPH_MAX_IDS], None
+        data, st = graph_get("", {"ids": ",".join(chunk), "fields": full}, page_token, ctx_key=_ctx_key_for_page(page_id))
+        if st != 200 and not _is_retryable(data, st):
+            err = json.dumps(data, ensure_ascii=False)[:300]
+            data, st = graph_get("", {"ids": ",".join(chunk), "fields": _INSIGHT_COUNTS + ("" if kind_group == "video" else ",shares")},
+                                 page_token, ctx_key=_ctx_key_for_page(page_id))
+        if st != 200 or not isinstance(data, dict):
+            continue  # stays due; picked up again next run
+        now, rows = pytime.time(), []
+        for pid in chunk:
+            obj = data.get(pid)
+            if not isinstance(obj, dict):
+                continue
+            r = _insights_row(obj)
+            rows.append((*(r[c] for c in _INSIGHT_SUMS), now, err, pid))
+        _db().executemany(f"UPDATE insight_posts SET {', '.join(c + '=?' for c in _INSIGHT_SUMS)}, collected_at=?, error=? WHERE post_id=?", rows)
+        done += len(rows)
+    return done
+
+def _collect_page_insights(page_id: str, page_token: str) -> int:
+    """Daily page metrics since the last stored day, following paging.next."""
+    from urllib.parse import urlparse, parse_qs
+    row = _db().execute("SELECT MAX(end_time) AS t FROM page_insights WHERE page_id=?", (page_id,)).fetchone()
+    now = int(pytime.time())
+    since = int(row["t"]) if row and row["t"] else now - INSIGHTS_MAX_AGE_DAYS * 86400
+    params = {"metric": INSIGHTS_PAGE_METRICS, "period": "day", "since": since, "until": now}
+    stored = 0
+    for _ in range(INSIGHTS_PAGE_MAX_PAGES):
+        data, st = graph_get(f"{page_id}/insights", params, page_token, ctx_key=_ctx_key_for_page(page_id))
+        if st != 200 or not isinstance(data, dict):
+            break
+        rows = []
+        for m in data.get("data", []):
+            for v in m.get("values") or []:
+                if isinstance(v.get("value"), (int, float)) and v.get("end_time"):
+                    rows.append((page_id, m.get("name"), _graph_time(v["end_time"]), int(v["value"])))
+        _db().executemany("INSERT OR REPLACE INTO page_insights(page_id, metric, end_time, value) VALUES (?,?,?,?)", rows)
+        stored += len(rows)
+        nxt = (data.get("paging") or {}).get("next")
+        if not rows or not nxt:
+            break
+        q = parse_qs(urlparse(nxt).query)
+        if int((q.get("since") or [now])[0]) >= now:
+            break
+        params = dict(params, since=q["since"][0], until=(q.get("until") or [now])[0])
+    return stored
+
+@recurring_job("insights_collect", INSIGHTS_INTERVAL_SEC, pool="sync")
+def _job_insights_collect(p: dict):
+    now = pytime.time()
+    due = _db().execute(
+        "SELECT post_id, page_id, kind FROM insight_posts WHERE collected_at < ? AND published_at > ? ORDER BY collected_at LIMIT ?",
+        (now - INSIGHTS_INTERVAL_SEC, now - INSIGHTS_MAX_AGE_DAYS * 86400, INSIGHTS_BATCH_POSTS)).fetchall()
+    groups: Dict[Tuple[str, str], List[str]] = {}
+    for r in due:
+        groups.setdefault((r["page_id"], "video" if r["kind"] in ("video", "reel") else "post"), []).append(r["post_id"])
+    tokens: Dict[str, Optional[str]] = {}
+    posts, page_rows, skipped = 0, 0, []
+    for (page_id, kind_group), ids in groups.items():
+        if page_id not in tokens: tokens[page_id] = _background_page_token(page_id)
+        if not tokens[page_id]:
+            skipped.append(page_id); continue
+        posts += _collect_post_insights(page_id, tokens[page_id], kind_group, ids)
+    active = [r["page_id"] for r in _db().execute("SELECT DISTINCT page_id FROM insight_posts WHERE published_at > ?",
+                                                  (now - INSIGHTS_MAX_AGE_DAYS * 86400,))]
+    for page_id in active:
+        if page_id not in tokens: tokens[page_id] = _background_page_token(page_id)
+        if tokens[page_id]:
+            page_rows += _collect_page_insights(page_id, tokens[page_id])
+    return {"posts_due": len(due), "posts_collected": posts, "page_values": page_rows,
+            "skipped_pages": sorted(set(skipped))}, 200
+
+_INSIGHT_BUCKETS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+@app.route("/api/insights/summary")
+def api_insights_summary():
+    """Post metrics summed by ?group=campaign|page|hour|day|week, filtered by page_id / campaign_id / since / until."""
+    group = request.args.get("group", "campaign")
+    if group == "campaign": key = "campaign_id"
+    elif group == "page": key = "page_id"
+    elif group in _INSIGHT_BUCKETS: key = f"CAST(published_at / {_INSIGHT_BUCKETS[group]} AS INTEGER) * {_INSIGHT_BUCKETS[group]}"
+    else: return jsonify({"error": "BAD_GROUP", "allowed": ["campaign", "page", *_INSIGHT_BUCKETS]}), 400
+    where, args = ["1=1"], []
+    for col in ("page_id", "campaign_id"):
+        if request.args.get(col):
+            where.append(f"{col}=?"); args.append(request.args[col])
+    try:
+        if request.args.get("since"): where.append("published_at >= ?"); args.append(float(request.args["since"]))
+        if request.args.get("until"): where.append("published_at < ?"); args.append(float(request.args["until"]))
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    t0 = pytime.perf_counter()
+    sums = ", ".join(f"SUM({c}) AS {c}" for c in _INSIGHT_SUMS)
+    rows = _db().execute(f"SELECT {key} AS k, COUNT(*) AS posts, {sums} FROM insight_posts WHERE {' AND '.join(where)} "
+                         f"GROUP BY k ORDER BY k", args).fetchall()
+    data = [dict(r) for r in rows]
+    for d in data:
+        d[group] = d.pop("k")
+    return _json_response({"group": group, "data": data, "query_ms": round((pytime.perf_counter() - t0) * 1000.0, 2)})
+
+@app.route("/api/insights/pages")
+def api_insights_pages():
+    """Daily page metrics, optionally rolled up by ?bucket=week: ?page_id=&metric=&since=&until=."""
+    where, args = ["1=1"], []
+    for col in ("page_id", "metric"):
+        if request.args.get(col):
+            where.append(f"{col}=?"); args.append(request.args[col])
+    try:
+        if request.args.get("since"): where.append("end_time >= ?"); args.append(float(request.args["since"]))
+        if request.args.get("until"): where.append("end_time < ?"); args.append(float(request.args["until"]))
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    step = _INSIGHT_BUCKETS.get(request.args.get("bucket", "day"), 86400)
+    rows = _db().execute(f"SELECT page_id, metric, CAST(end_time / {step} AS INTEGER) * {step} AS bucket, SUM(value) AS value "
+                         f"FROM page_insights WHERE {' AND '.join(where)} GROUP BY page_id, metric, bucket ORDER BY page_id, metric, bucket", args)
+    return _json_response({"data": [dict(r) for r in rows]})
+
+@app.route("/api/insights/collect", methods=["POST"])
+def api_insights_collect():
+    return _job_accepted(enqueue_job("insights_collect", {}, max_attempts=1))
+
+# ----------------------------
+# Content templates: spintax {a|b|{c|d}} and {{slot}} variants, compiled once and expanded locally
+# ----------------------------
+TEMPLATE_CACHE_MAX = 256
+TEMPLATE_MAX_VARIANTS = int(os.environ.get("TEMPLATE_MAX_VARIANTS", "5000"))
+_TEMPLATES: "OrderedDict[str, Any]" = OrderedDict()  # source -> parsed tree, LRU
+
+def _spin_parse(src: str, i: int = 0, nested: bool = False) -> Tuple[List[Any], int]:
+    """
+    Parse into a sequence of nodes: str | ("slot", name) | ("choice", [sequence, ...]).
+    A brace group without a top-level '|' stays literal text; backslash escapes { } | and itself.
+    """
+    seq: List[Any] = []
+    buf: List[str] = []
+    n = len(src)
+    while i < n:
+        ch = src[i]
+        if ch == "\\" and i + 1 < n:
+            buf.append(src[i + 1]); i += 2; continue
+        if nested and ch in "|}":
+            break
+        if src.startswith("{{", i):
+            end = src.find("}}", i + 2)
+            name = src[i + 2:end].strip() if end > 0 else ""
+            if name and re.fullmatch(r"[\w.-]+", name):
+                if buf: seq.append("".join(buf)); buf = []
+                seq.append(("slot", name))
+                i = end + 2
+                continue
+        if ch == "{":
+            alts, j = [], i + 1
+            while True:
+                alt, j = _spin_parse(src, j, nested=True)
+                alts.append(alt)
+                if j >= n or src[j] == "}":
+                    break
+                j += 1  # past '|'
+            if j < n and len(alts) > 1:
+                if buf: seq.append("".join(buf)); buf = []
+                seq.append(("choice", alts))
+                i = j + 1
+                continue
+            if j < n:  # closed group without '|': literal braces around whatever it holds
+                buf.append("{")
+                for node in alts[0]:
+                    if isinstance(node, str):
+                        buf.append(node)
+                    else:
+                        if buf: seq.append("".join(buf)); buf = []
+                        seq.append(node)
+                buf.append("}"); i = j + 1
+                continue
+            buf.append(ch); i += 1  # unclosed: keep the brace as text
+            continue
+        buf.append(ch); i += 1
+    if buf: seq.append("".join(buf))
+    return seq, i
+
+def _template_tree(src: str) -> List[Any]:
+    tree = _TEMPLATES.get(src)
+    if tree is None:
+        tree = _spin_parse(src)[0]
+        _TEMPLATES[src] = tree
+        if len(_TEMPLATES) > TEMPLATE_CACHE_MAX:
+            _TEMPLATES.popitem(last=False)
+    else:
+        _TEMPLATES.move_to_end(src)
+    return tree
+
+def is_template(src: str) -> bool:
+    return any(not isinstance(n, str) for n in _template_tree(src or ""))
+
+def _template_slot_names(seq: List[Any], out: List[str]) -> List[str]:
+    for node in seq:
+        if isinstance(node, str):
+            continue
+        if node[0] == "slot":
+            if node[1] not in out: out.append(node[1])
+            continue
+        for alt in node[1]:
+            _template_slot_names(alt, out)
+    return out
+
+def template_unbound_slots(src: str, slots: Optional[Dict[str, Any]] = None) -> List[str]:
+    """{{slot}} names used in `src` that `slots` gives no (non-empty) value for, in order of appearance."""
+    return [n for n in _template_slot_names(_template_tree(src or ""), []) if not (slots or {}).get(n)]
+
+def _template_bind(seq: List[Any], slots: Dict[str, List[str]]) -> Tuple[int, List[Any]]:
+    """Resolve slots and precompute variant counts: returns (count, [(count, node)])."""
+    total, out = 1, []
+    for node in seq:
+        if isinstance(node, str):
+            out.append((1, node)); continue
+        if node[0] == "slot":
+            vals = slots.get(node[1]) or ["{{" + node[1] + "}}"]
+            out.append((len(vals), ("slot", vals)))
+            total *= len(vals)
+            continue
+        alts = [_template_bind(a, slots) for a in node[1]]
+        c = sum(a[0] for a in alts)
+        out.append((c, ("choice", alts)))
+        total *= c
+    return total, out
 
-$('#btn_exchange').onclick = async () => {
-  const app_id = $('#cfg_app_id').value.trim();
-  const app_secret = $('#cfg_app_secret').value.trim();
-  const short = $('#cfg_short_token').value.trim();
-  const st = $('#cfg_status');
-  if(!app_id || !app_secret || !short){ st.textContent='Nhập App ID, Secret & short token'; return; }
-  try{
-    await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
-    const r = await fetch('/api/token/exchange', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({short_token: short})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi token dài và lưu vào tokens.json';
-  }catch(e){ st.textContent='Lỗi đổi token'; }
-};
+def _template_render(bound: List[Any], idx: int, parts: List[str]):
+    # mixed-radix decode: each index in [0, count) names exactly one path through the tree
+    for c, node in bound:
+        if c == 1 and isinstance(node, str):
+            parts.append(node); continue
+        idx, r = divmod(idx, c)
+        if node[0] == "slot":
+            parts.append(node[1][r]); continue
+        for ac, aseq in node[1]:
+            if r < ac:
+                _template_render(aseq, r, parts); break
+            r -= ac
 
-// Page info: load existing (best-effort)
-$('#btn_load_info').onclick = async () => {
-  const pid = $('#info_page').value;
-  const st = $('#info_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  st.textContent='Đang tải...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/info');
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    $('#pg_name').value = d.name || '';
-    $('#pg_phone').value = d.phone || d.phone_number || '';
-    $('#pg_website').value = d.website || '';
-    $('#pg_desc').value = d.description || d.about || '';
-    const loc = d.location || {};
-    $('#addr_street').value = loc.street || '';
-    $('#addr_city').value = loc.city || '';
-    $('#addr_zip').value = loc.zip || '';
-    $('#addr_country').value = loc.country || '';
-    st.textContent='Đã tải xong.';
-  }catch(e){ st.textContent='Lỗi tải thông tin'; }
-};
+def compile_template(src: str, slots: Optional[Dict[str, Any]] = None) -> Tuple[int, Any]:
+    """Returns (variant_count, render) where render(i) gives variant i; slot values may be a string or a list of variants."""
+    norm = {str(k): ([str(x) for x in v] if isinstance(v, (list, tuple)) else [str(v)]) for k, v in (slots or {}).items()}
+    total, bound = _template_bind(_template_tree(src), norm)
+    def render(i: int) -> str:
+        parts: List[str] = []
+        _template_render(bound, i, parts)
+        return "".join(parts)
+    return total, render
 
-$('#btn_save_info').onclick = async () => {
-  const pid = $('#info_page').value;
-  const st = $('#info_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  const payload = {
-    name: ($('#pg_name').value||'').trim(),
-    phone: ($('#pg_phone').value||'').trim(),
-    website: ($('#pg_website').value||'').trim(),
-    description: ($('#pg_desc').value||'').trim(),
-    address: {
-      street: ($('#addr_street').value||'').trim(),
-      city: ($('#addr_city').value||'').trim(),
-      zip: ($('#addr_zip').value||'').trim(),
-      country: ($('#addr_country').value||'').trim()
-    }
-    
-    
-    ,
-    always_open: $('#always_open').checked
-  };
-  st.textContent='Đang lưu...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/info', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload)});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã lưu xong.';
-  }catch(e){ st.textContent='Lỗi lưu thông tin'; }
-};
+def _template_candidates(src: str, slots: Optional[Dict[str, Any]], exclude: Optional[set] = None, seed: Optional[int] = None):
+    """
+    Yields (text, hash) with pairwise-distinct content hashes, none in `exclude`. Indices are drawn without
+    replacement, so different paths that render the same text are just skipped.
+    """
+    total, render = compile_template(src, slots)
+    rng = random.Random(seed)
+    seen = set(exclude or ())
+    if total <= 4 * TEMPLATE_MAX_VARIANTS:
+        order = list(range(total)); rng.shuffle(order)
+        indices = iter(order)
+    else:
+        tried: set = set()
+        def draws():
+            while True:
+                i = rng.randrange(total)
+                if i not in tried:
+                    tried.add(i); yield i
+        indices = draws()
+    misses = 0
+    for i in indices:
+        text = render(i)
+        h = _hash_content(text)
+        if h in seen:
+            misses += 1
+            if misses > 20 * TEMPLATE_MAX_VARIANTS:
+                return  # mostly colliding paths: stop with what we have
+            continue
+        seen.add(h)
+        yield text, h
 
-$('#btn_set_avatar').onclick = async () => {
-  const pid = $('#info_page').value;
-  const file = $('#pic_avatar').files[0];
-  const st = $('#pic_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!file){ st.textContent='Chưa chọn ảnh đại diện'; return; }
-  st.textContent='Đang cập nhật avatar...';
-  try{
-    const fd = new FormData();
-    fd.append('avatar', file);
-    const r = await fetch('/api/pages/'+pid+'/avatar', {method:'POST', body: fd});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi avatar.';
-  }catch(e){ st.textContent='Lỗi đổi avatar'; }
-};
+def expand_template(src: str, count: int, slots: Optional[Dict[str, Any]] = None, seed: Optional[int] = None) -> List[str]:
+    """Up to `count` variants with pairwise-distinct content hashes."""
+    out: List[str] = []
+    for text, _ in _template_candidates(src, slots, seed=seed):
+        out.append(text)
+        if len(out) >= count:
+            break
+    return out
 
-$('#btn_set_cover').onclick = async () => {
-  const pid = $('#info_page').value;
-  const file = $('#pic_cover').files[0];
-  const st = $('#pic_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!file){ st.textContent='Chưa chọn ảnh bìa'; return; }
-  st.textContent='Đang cập nhật cover...';
-  try{
-    const fd = new FormData();
-    fd.append('cover', file);
-    const r = await fetch('/api/pages/'+pid+'/cover', {method:'POST', body: fd});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi cover.';
-  }catch(e){ st.textContent='Lỗi đổi cover'; }
-};
+def _ledger_recent_hashes(page_ids: List[str]) -> Dict[str, set]:
+    out: Dict[str, set] = {pid: set() for pid in page_ids}
+    if not page_ids:
+        return out
+    marks = ",".join("?" * len(page_ids))
+    for r in _db().execute(f"SELECT page_id, content_hash FROM publish_ledger WHERE page_id IN ({marks}) AND created > ? "
+                           f"AND status NOT IN ('failed','cancelled')", (*page_ids, pytime.time() - LEDGER_DUPLICATE_WINDOW_SEC)):
+        out[r["page_id"]].add(r["content_hash"])
+    return out
 
-// INBOX: load conversations and messages, send message
-let currentThread = null;
-let currentRecipient = null;
+def template_for_pages(src: str, page_ids: List[str], slots: Optional[Dict[str, Any]] = None,
+                       digest: Optional[str] = None) -> Tuple[Dict[str, str], List[str]]:
+    """
+    One variant per page, all distinct from each other and from what that page got within the ledger window.
+    Returns ({page_id: text}, [page ids left without a fresh variant]). `digest` is the sha256 of the attached
+    file, so the ledger check uses the same hash the post will be recorded under.
+    """
+    recent = _ledger_recent_hashes(page_ids)
+    gen = ((text, _ledger_hash(text, digest) if digest else h) for text, h in _template_candidates(src, slots))
+    spare: List[Tuple[str, str]] = []  # drawn but already used on the page that drew them
+    out: Dict[str, str] = {}
+    for pid in page_ids:
+        pick = next((k for k, (_, h) in enumerate(spare) if h not in recent[pid]), None)
+        if pick is not None:
+            out[pid] = spare.pop(pick)[0]
+            continue
+        for text, h in gen:
+            if h not in recent[pid]:
+                out[pid] = text
+                break
+            spare.append((text, h))
+    return out, [pid for pid in page_ids if pid not in out]
 
-$('#btn_load_conv').onclick = async () => {
-  const pid = $('#inbox_page').value;
-  const st = $('#inbox_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  st.textContent='Đang tải hội thoại...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/conversations');
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    const arr = d.data || [];
-    $('#conv_list').innerHTML = arr.map(cv => {
-      const unread = (cv.unread_count||0) > 0;
-      const dot = '<span class="dot '+(unread?'red':'green')+'"></span>';
-      let display = cv.id;
-      try{
-        const parts = (cv.participants && cv.participants.data) ? cv.participants.data : [];
-        const pageId = $('#inbox_page').value;
-        const other = parts.find(p => p.id !== pageId);
-        if(other && other.name) display = other.name;
-      }catch(_){}
-      return '<div class="conv-item">'+dot+'<a href="#" data-id="'+cv.id+'" class="open-thread conv-title">'+display+'</a><span class="muted"> — '+(cv.updated_time||'')+'</span></div>';
-    }).join('');
-    $('#conv_list').querySelectorAll('.open-thread').forEach(a => {
-      a.addEventListener('click', async (e) => {
-        e.preventDefault();
-        const tid = a.getAttribute('data-id');
-        await openThread(pid, tid);
-      });
-    });
-    st.textContent='Đã tải ' + arr.length + ' hội thoại.';
-  }catch(e){ st.textContent='Lỗi tải hội thoại'; }
-};
+@app.route("/api/templates/expand", methods=["POST"])
+def api_templates_expand():
+    """
+    JSON {template, slots?: {name: str | [str]}, page_ids?: [...], count?: n}.
+    With page_ids: one distinct variant per page that has not been used there recently; else `count` distinct variants.
+    """
+    body = request.get_json(force=True) or {}
+    src = body.get("template") or ""
+    if not src.strip(): return jsonify({"error": "EMPTY_TEMPLATE"}), 400
+    slots = body.get("slots") if isinstance(body.get("slots"), dict) else {}
+    missing = template_unbound_slots(src, slots)
+    if missing: return jsonify({"error": "UNBOUND_SLOTS", "missing": missing}), 400
+    t0 = pytime.perf_counter()
+    total, _ = compile_template(src, slots)
+    page_ids = [str(x).strip() for x in (body.get("page_ids") or []) if str(x).strip()]
+    if page_ids:
+        variants, short = template_for_pages(src, page_ids[:TEMPLATE_MAX_VARIANTS], slots)
+        out = {"variants": variants, "exhausted": short}
+    else:
+        try: count = max(1, min(TEMPLATE_MAX_VARIANTS, int(body.get("count", 10))))
+        except (TypeError, ValueError): return jsonify({"error": "INVALID_ARGS"}), 400
+        out = {"variants": expand_template(src, count, slots)}
+    out.update(total=total, elapsed_ms=round((pytime.perf_counter() - t0) * 1000.0, 2))
+    return _json_response(out)
 
-async function openThread(pageId, threadId){
-  const st = $('#inbox_status');
-  st.textContent='Đang tải tin nhắn...';
-  try{
-    const r = await fetch('/api/pages/'+pageId+'/conversations/'+threadId);
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    const msgs = (d.messages && d.messages.data) ? d.messages.data : [];
-    currentThread = threadId;
-    // Xác định người nhận (không phải page) từ from/to của các message
-    let rec = null;
-    for(const m of msgs){
-      const tos = (m.to && m.to.data) ? m.to.data : [];
-      const fr = m.from || {};
-      for(const t of tos){
-        if(t.id !== pageId){ rec = t.id; break; }
-      }
-      if(!rec && fr.id !== pageId){ rec = fr.id; }
-      if(rec) break;
-    }
-    currentRecipient = rec;
-    const fmt = (iso) => { try{ return new Date(iso).toLocaleString(); }catch(_){ return iso||''; } };
-    const pageIdLocal = pageId || $('#inbox_page').value;
-    $('#msg_list').innerHTML = msgs.map(m => {
-      const fromId = (m.from && m.from.id) ? m.from.id : '';
-      const fromName = (m.from && (m.from.name||m.from.id)) ? (m.from.name||m.from.id) : 'Unknown';
-      const cls = (fromId === pageId) ? 'msg me' : 'msg other';
-      const text = (m.message || '[attachment]');
-      const time = fmt(m.created_time||'');
-      return '<div class="'+cls+'"><div class="bubble"><div><b>'+fromName+'</b></div><div>'+text+'</div><div class="meta">'+time+'</div></div></div>';
-    }).join('');
-    st.textContent='Đã tải ' + msgs.length + ' tin nhắn.' + (currentRecipient ? '' : ' (Không xác định được người nhận — cần nhắn từ thread trước)');
-  }catch(e){ st.textContent='Lỗi tải tin nhắn'; }
-}
+# ----------------------------
+# Token health: scheduled debug_token checks (Graph batch, per app) with the verdicts cached in SQLite
+# ----------------------------
+TOKEN_HEALTH_INTERVAL_SEC = int(os.environ.get("TOKEN_HEALTH_INTERVAL_SEC", str(6 * 3600)))
+TOKEN_REFRESH_AHEAD_SEC = int(os.environ.get("TOKEN_REFRESH_AHEAD_SEC", str(3 * 86400)))
+TOKEN_HEALTH_RELOAD_SEC = 30  # how stale another process's verdicts may be here
+GRAPH_TOKEN_ERROR_CODES = {102, 190}
 
-$('#btn_send').onclick = async () => {
-  const pid = $('#inbox_page').value;
-  const text = ($('#msg_text').value||'').trim();
-  const st = $('#inbox_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!text){ st.textContent='Nhập nội dung trước'; return; }
-  if(!currentRecipient){ st.textContent='Chưa xác định người nhận từ hội thoại — hãy mở một thread trước.'; return; }
-  st.textContent='Đang gửi...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/messages', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({recipient_id: currentRecipient, text})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã gửi.';
-    if(currentThread){ await openThread(pid, currentThread); }
-    $('#msg_text').value='';
-  }catch(e){ st.textContent='Lỗi gửi tin nhắn'; }
-};
-async function pollNewEvents(){
-  const audio = document.getElementById('newMsg');
-  let lastTs = 0;
-  while(true){
-    try{
-      const r = await fetch('/webhook/events');
-      const d = await r.json();
-      const latest = d.length ? (d[d.length-1].ts||0) : 0;
-      // if there is a newer event and it looks like a message, play
-      if(latest && latest > lastTs){
-        lastTs = latest;
-        try{ await audio.play(); }catch(_){ /* require user interaction first */ }
-      }
-    }catch(e){}
-    await sleep(5000);
-  }
-} 
-</script>
-  </div>
-<audio id="newMsg" src="/static/new-message.mp3" preload="auto"></audio>
+_DB_SCHEMA += [
+    """CREATE TABLE IF NOT EXISTS token_health (
+        token_hash TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        app TEXT NOT NULL,
+        page_id TEXT,
+        source TEXT,
+        is_valid INTEGER NOT NULL,
+        expires_at REAL NOT NULL DEFAULT 0,
+        data_access_expires_at REAL NOT NULL DEFAULT 0,
+        scopes TEXT,
+        error TEXT,
+        checked_at REAL NOT NULL)""",
+]
 
-<script id="HIDE_PHONE_FIELD_SNIPPET">
-(()=>{try{
-  const t=(el)=> (el.textContent||'').toLowerCase().includes('số điện thoại');
-  document.querySelectorAll('label,span,div').forEach(el=>{
-    if(t(el)){ el.style.display='none'; const n=el.nextElementSibling;
-      if(n && (n.tagName==='INPUT' || (n.name||'').toLowerCase().includes('phone'))) n.style.display='none';
-    }
-  });
-  document.querySelectorAll('input,textarea,select').forEach(inp=>{
-    const nm=(inp.name||'').toLowerCase(), id=(inp.id||'').toLowerCase(), ph=(inp.placeholder||'').toLowerCase();
-    if(nm.includes('phone')||id.includes('phone')||ph.includes('số điện thoại')) inp.style.display='none';
-  });
-}catch(_){}})();
+_TOKEN_HEALTH: Dict[str, Any] = {"ts": 0.0, "dead": {}, "lock": threading.Lock()}
 
-// --- Hide Settings & Page Info, keep only Posts and Inbox ---
-(function(){
-  function hideById(id){
-    const el = document.getElementById(id);
-    if(!el) return;
-    el.style.display = 'none';
-    const card = el.closest('.card');
-    if(card) card.style.display = 'none';
-    const panel = el.closest('.panel');
-    if(panel) panel.style.display = 'none';
-  }
-  // Hide tab button & panel
-  hideById('tab-page-info');
-  hideById('panel-page-info');
+def _token_key(token: str) -> str:
+    return _hash_content(token)[:32]  # tokens themselves never go into the table
 
-  // Hide settings & diagnostics blocks
-  ['cfg_app_id','cfg_app_secret','cfg_short_token','btn_save_cfg','btn_exchange','cfg_status','btn_diag','diag_out']
-    .forEach(hideById);
-})();
-</script>
-</body>
-</html>"""
+def _is_token_error(data: Any) -> bool:
+    err = data.get("error") if isinstance(data, dict) else None
+    try: return isinstance(err, dict) and int(err.get("code") or 0) in GRAPH_TOKEN_ERROR_CODES
+    except (TypeError, ValueError): return False
+
+def _token_dead_set() -> Dict[str, str]:
+    now = pytime.time()
+    if now - _TOKEN_HEALTH["ts"] > TOKEN_HEALTH_RELOAD_SEC:
+        with _TOKEN_HEALTH["lock"]:
+            if now - _TOKEN_HEALTH["ts"] > TOKEN_HEALTH_RELOAD_SEC:
+                try:
+                    rows = _db().execute("SELECT token_hash, error FROM token_health WHERE is_valid=0 "
+                                         "OR (expires_at > 0 AND expires_at < ?)", (now,)).fetchall()
+                    _TOKEN_HEALTH["dead"] = {r["token_hash"]: r["error"] or "EXPIRED" for r in rows}
+                except sqlite3.Error:
+                    pass
+                _TOKEN_HEALTH["ts"] = now
+    return _TOKEN_HEALTH["dead"]
+
+def token_usable(token: Optional[str]) -> bool:
+    """False only for tokens a health check or a Graph OAuth error has shown to be invalid or expired."""
+    return bool(token) and _token_key(token) not in _token_dead_set()
+
+def _token_health_put(token: str, kind: str, app_name: str, page_id: Optional[str], source: str, info: Dict[str, Any]):
+    _db().execute(
+        "INSERT OR REPLACE INTO token_health(token_hash, kind, app, page_id, source, is_valid, expires_at, data_access_expires_at, "
+        "scopes, error, checked_at) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+        (_token_key(token), kind, app_name, page_id, source, 1 if info.get("is_valid") else 0, float(info.get("expires_at") or 0),
+         float(info.get("data_access_expires_at") or 0), json.dumps(info.get("scopes") or []),
+         ((info.get("error") or {}).get("message") if isinstance(info.get("error"), dict) else info.get("error")), pytime.time()))
+
+def token_mark_invalid(token: Optional[str], data: Any):
+    """Record an OAuth error seen on a live call, so the token is skipped from now on instead of retried."""
+    if not token:
+        return
+    key = _token_key(token)
+    msg = str(((data or {}).get("error") or {}).get("message") or "OAuthException")[:300]
+    _TOKEN_HEALTH["dead"][key] = msg
+    _db().execute("UPDATE token_health SET is_valid=0, error=?, checked_at=? WHERE token_hash=?", (msg, pytime.time(), key))
+    _db().execute("INSERT OR IGNORE INTO token_health(token_hash, kind, app, is_valid, error, checked_at) VALUES (?,?,?,0,?,?)",
+                  (key, "unknown", _app_for_token(token), msg, pytime.time()))
+
+def _stored_tokens() -> Dict[str, Dict[str, Any]]:
+    """token -> {kind, app, page_id, source} for every token the app could use."""
+    out: Dict[str, Dict[str, Any]] = {}
+    store = load_tokens()
+    user = (store.get("user_long") or {}).get("access_token")
+    if user: out[user] = {"kind": "user", "app": DEFAULT_APP, "page_id": None, "source": "store"}
+    for pid, tok in (store.get("pages") or {}).items():
+        out.setdefault(tok, {"kind": "page", "app": DEFAULT_APP, "page_id": str(pid), "source": "store"})
+    mp, _ = _env_get_tokens()
+    for pid, tok in {**_ENV_PAGES["loose"], **mp}.items():
+        out.setdefault(tok, {"kind": "page", "app": DEFAULT_APP, "page_id": str(pid), "source": "env"})
+    for name, a in list(_APPS.items()):
+        if a["user_token"]: out.setdefault(a["user_token"], {"kind": "user", "app": name, "page_id": None, "source": "pool"})
+        for pid, tok in list(a["page_tokens"].items()):
+            out.setdefault(tok, {"kind": "page", "app": name, "page_id": pid, "source": "pool"})
+    return out
+
+def _debug_tokens(app_name: str, tokens: List[str]) -> Dict[str, Dict[str, Any]]:
+    """debug_token for up to GRAPH_BATCH_MAX tokens per Graph batch, with that app's app token."""
+    if app_name == DEFAULT_APP: app_id, secret = app_cfg()
+    else: app_id, secret = _APPS[app_name]["app_id"], _APPS[app_name]["app_secret"]
+    if not app_id or not secret:
+        return {}
+    out: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, len(tokens), GRAPH_BATCH_MAX):
+        chunk = tokens[i:i + GRAPH_BATCH_MAX]
+        ops = [{"method": "GET", "relative_url": "debug_token?" + urlencode({"input_token": t})} for t in chunk]
+        data, st = graph_post("", {"batch": json.dumps(ops), "include_headers": "false"}, f"{app_id}|{secret}", idempotent=True)
+        if st != 200 or not isinstance(data, list):
+            continue  # no verdict this round; tokens keep their previous state
+        for tok, item in zip(chunk, data):
+            try: body = json.loads((item or {}).get("body") or "null")
+            except ValueError: body = None
+            if isinstance(body, dict) and isinstance(body.get("data"), dict) and int((item or {}).get("code") or 0) == 200:
+                out[tok] = body["data"]
+    return out
 
-@app.route("/")
-def index():
-    return render_template_string(INDEX_HTML)
+def _token_heal(invalid: Dict[str, Dict[str, Any]], expiring: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Drop invalid page tokens from tokens.json / the app pool and re-read page tokens where a user token is live.
+    Soon-expiring tokens still work: they are only replaced when that re-read returns a new token for the page.
+    """
+    healed: Dict[str, Any] = {"evicted": 0, "refreshed_pages": 0, "replaced": 0}
+    store = load_tokens()
+    pages = store.get("pages") or {}
+    stale = {m["page_id"] for t, m in invalid.items() if m["source"] == "store" and m["kind"] == "page" and pages.get(m["page_id"]) == t}
+    ageing = {m["page_id"]: t for t, m in expiring.items() if m["source"] == "store" and m["kind"] == "page" and pages.get(m["page_id"]) == t}
+    if stale:
+        store["pages"] = {k: v for k, v in pages.items() if k not in stale}
+        save_tokens(store)
+        healed["evicted"] += len(stale)
+    user = (store.get("user_long") or {}).get("access_token")
+    if (stale or ageing or not store.get("pages")) and user and token_usable(user):
+        found = _refresh_store_pages(user)  # merged into tokens.json, so a new token replaces the ageing one
+        healed["refreshed_pages"] += len(found)
+        healed["replaced"] += sum(1 for pid, t in ageing.items() if found.get(pid) not in (None, t))
+    for tok, m in invalid.items():
+        a = _APPS.get(m["app"])
+        if m["source"] != "pool" or not a or m["kind"] != "page":
+            continue
+        with _APPS_LOCK:
+            if a["page_tokens"].get(m["page_id"]) == tok:
+                del a["page_tokens"][m["page_id"]]
+                _TOKEN_APP.pop(tok, None)
+                a["discovered"] = False  # re-list the app's pages on next use
+                healed["evicted"] += 1
+    for name in {m["app"] for m in expiring.values() if m["source"] == "pool" and m["kind"] == "page"}:
+        a = _APPS.get(name)
+        if not a or not a["user_token"] or not token_usable(a["user_token"]):
+            continue
+        found = _app_discover_pages(name)
+        healed["replaced"] += sum(1 for t, m in expiring.items()
+                                  if m["app"] == name and found.get(m["page_id"]) not in (None, t))
+    return healed
 
-# ----------------------------
-# APIs: pages & posting & reels (reusing patterns)
-# ----------------------------
-def reels_start(page_id: str, page_token: str):
-    return graph_post(f"{page_id}/video_reels", {"upload_phase": "start"}, page_token, ctx_key=_ctx_key_for_page(page_id))
+@recurring_job("token_health", TOKEN_HEALTH_INTERVAL_SEC, pool="sync")
+def _job_token_health(p: dict):
+    tokens = _stored_tokens()
+    by_app: Dict[str, List[str]] = {}
+    for tok, m in tokens.items():
+        by_app.setdefault(m["app"], []).append(tok)
+    now, checked, invalid, expiring, unchecked = pytime.time(), 0, {}, {}, []
+    for app_name, toks in by_app.items():
+        infos = _debug_tokens(app_name, toks)
+        if not infos:
+            unchecked.append(app_name); continue
+        for tok, info in infos.items():
+            m = tokens[tok]
+            _token_health_put(tok, m["kind"], app_name, m["page_id"], m["source"], info)
+            checked += 1
+            exp = float(info.get("expires_at") or 0)
+            if not info.get("is_valid") or (exp and exp <= now):
+                invalid[tok] = m
+            elif exp and exp - now < TOKEN_REFRESH_AHEAD_SEC:
+                expiring[tok] = m
+    _TOKEN_HEALTH["ts"] = 0.0
+    healed = _token_heal(invalid, expiring)
+    return {"tokens": len(tokens), "checked": checked, "unhealthy": len(invalid), "expiring": len(expiring),
+            "unchecked_apps": unchecked, **healed}, 200
 
-def reels_finish(page_id: str, page_token: str, video_id: str, description: str):
-    return graph_post(f"{page_id}/video_reels", {"upload_phase": "finish", "video_id": video_id, "description": description}, page_token, ctx_key=_ctx_key_for_page(page_id))
+@app.route("/api/tokens/health")
+def api_tokens_health():
+    rows = _db().execute("SELECT * FROM token_health ORDER BY is_valid, expires_at").fetchall()
+    now = pytime.time()
+    data = []
+    for r in rows:
+        d = dict(r)
+        d["scopes"] = json.loads(d["scopes"] or "[]")
+        d["expires_in"] = int(d["expires_at"] - now) if d["expires_at"] else None
+        d["usable"] = bool(d["is_valid"]) and not (d["expires_at"] and d["expires_at"] < now)
+        data.append(d)
+    return _json_response({"data": data, "interval_sec": TOKEN_HEALTH_INTERVAL_SEC})
 
-@app.route("/api/pages")
-def api_list_pages():
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if token:
-        data, status = graph_get("me/accounts", {"limit": 200}, token, ttl=0)
-        return jsonify(data), status
+@app.route("/api/tokens/health/check", methods=["POST"])
+def api_tokens_health_check():
+    return _job_accepted(enqueue_job("token_health", {}, max_attempts=1))
 
-    # Fallback: nếu có PAGE_TOKENS trong ENV thì trả về luôn danh sách page từ ENV
-    try:
-        env_pages = _env_pages_list()
-        if env_pages:
-            return jsonify({"data": env_pages}), 200
-    except Exception:
-        pass
+# ----------------------------
+# Media proxy: message attachments served from a byte-bounded LRU disk cache (revalidated, thumbnailed, ranged)
+# ----------------------------
+MEDIA_CACHE_MAX_MB = int(os.environ.get("MEDIA_CACHE_MAX_MB", "1024"))
+MEDIA_MAX_OBJECT_MB = int(os.environ.get("MEDIA_MAX_OBJECT_MB", "200"))  # bigger objects are redirected to the CDN
+MEDIA_REVALIDATE_SEC = int(os.environ.get("MEDIA_REVALIDATE_SEC", "86400"))
+MEDIA_THUMB_SIDES = (160, 320, 640)
+MEDIA_HOSTS = (".fbcdn.net", ".fbsbx.com", ".facebook.com", ".cdninstagram.com")
+MEDIA_DIR = os.path.join(DATA_DIR, "media")
 
-    return jsonify({"error": "NOT_LOGGED_IN"}), 401
+_DB_SCHEMA += [
+    # key -> latest CDN url for one attachment; urls expire, the key (message id + slot) does not
+    """CREATE TABLE IF NOT EXISTS media_refs (
+        key TEXT PRIMARY KEY, url TEXT NOT NULL, page_id TEXT NOT NULL, message_id TEXT NOT NULL,
+        slot TEXT NOT NULL, updated REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS media_cache (
+        key TEXT PRIMARY KEY, size INTEGER NOT NULL, content_type TEXT, etag TEXT, last_modified TEXT, digest TEXT,
+        fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS media_cache_lru ON media_cache(accessed_at, size)",
+]
 
-@app.route("/api/pages/<page_id>/info")
-def api_page_info(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    fields = "name,about,description,website,location{street,city,zip,country}"
-    data, st = graph_get(page_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+# striped: a fixed set of locks shared by key hash, so the table does not grow with every object ever served
+_MEDIA_LOCKS = [threading.Lock() for _ in range(64)]
 
-# ------- Page info (POST update) -------
-@app.route("/api/pages/<page_id>/info", methods=["POST"])
-def api_page_update_info(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    body = request.get_json(force=True)
+def _media_lock(key: str) -> threading.Lock:
+    return _MEDIA_LOCKS[zlib.crc32(key.encode("utf-8")) % len(_MEDIA_LOCKS)]
 
-    payload = {}
-    # Simple fields
-    if body.get("name"): payload["name"] = body.get("name")
-    if body.get("description"): payload["description"] = body.get("description")
-    if body.get("website"): payload["website"] = body.get("website")
-    if body.get("phone"): payload["phone"] = body.get("phone")
-    # Location fields (best-effort)
-    addr = body.get("address") or {}
-    for k in ["street","city","zip","country"]:
-        if addr.get(k):
-            payload[f"location[{k}]"] = addr.get(k)
+def _media_host_ok(url: str) -> bool:
+    from urllib.parse import urlparse
+    u = urlparse(url or "")
+    return u.scheme == "https" and any(("." + (u.hostname or "")).endswith(h) for h in MEDIA_HOSTS)
 
-    # Opening hours - best-effort 'always open' by setting 00:00-23:59 for all days
-    if body.get("always_open"):
-        for day in ["mon","tue","wed","thu","fri","sat","sun"]:
-            payload[f"hours[{day}_1_open]"] = "00:00"
-            payload[f"hours[{day}_1_close]"] = "23:59"
+def _media_slots(m: Dict[str, Any]) -> List[Tuple[str, str, str, Optional[str]]]:
+    """(slot, kind, url, name) for each proxied URL in one message's attachments/shares."""
+    out = []
+    for i, a in enumerate(((m.get("attachments") or {}).get("data") or [])):
+        aid = str(a.get("id") or i)
+        if (a.get("image_data") or {}).get("url"):
+            out.append((f"a{aid}", "image", a["image_data"]["url"], a.get("name")))
+        elif (a.get("video_data") or {}).get("url"):
+            out.append((f"a{aid}", "video", a["video_data"]["url"], a.get("name")))
+        elif a.get("file_url"):
+            out.append((f"a{aid}", "file", a["file_url"], a.get("name")))
+    for i, sh in enumerate(((m.get("shares") or {}).get("data") or [])):
+        if sh.get("link") and _media_host_ok(sh["link"]):
+            out.append((f"s{i}", "image" if "fbcdn" in sh["link"] else "file", sh["link"], sh.get("name")))
+    return [x for x in out if _media_host_ok(x[2])]
 
-    if not payload:
-        return jsonify({"error":"EMPTY_UPDATE"}), 400
+def _media_key(message_id: str, slot: str) -> str:
+    return _hash_content(f"{message_id}:{slot}")[:24]
 
-    res, st = graph_post(page_id, payload, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(res), st
+def _media_attach(page_id: str, data: Any) -> List[Tuple]:
+    """Adds m["media"] = [{kind, url, thumb, name}] with proxy URLs to each message; returns the media_refs rows."""
+    rows, now = [], pytime.time()
+    for m in ((data.get("messages") or {}).get("data") or []) if isinstance(data, dict) else []:
+        if not m.get("id"):
+            continue
+        media = []
+        for slot, kind, url, name in _media_slots(m):
+            key = _media_key(m["id"], slot)
+            rows.append((key, url, str(page_id), m["id"], slot, now))
+            item = {"kind": kind, "url": f"/api/media/{key}", "name": name}
+            if kind == "image":
+                item["thumb"] = f"/api/media/{key}?thumb=320"
+            media.append(item)
+        if media:
+            m["media"] = media
+    return rows
 
-# ------- Avatar (profile picture) -------
-@app.route("/api/pages/<page_id>/avatar", methods=["POST"])
-def api_page_avatar(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "avatar" not in request.files:
-        return jsonify({"error":"MISSING_FILE"}), 400
-    file = request.files["avatar"]
-    files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
-    data, st = graph_post_multipart(f"{page_id}/picture", files, {}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+def _media_register(rows: List[Tuple]):
+    if rows:
+        _db().executemany("INSERT OR REPLACE INTO media_refs(key, url, page_id, message_id, slot, updated) VALUES (?,?,?,?,?,?)", rows)
 
-# ------- Cover: upload then set as cover -------
-@app.route("/api/pages/<page_id>/cover", methods=["POST"])
-def api_page_cover(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "cover" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
-    file = request.files["cover"]
-    files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
-    # 1) upload photo
-    up, st = graph_post_multipart(f"{page_id}/photos", files, {"published":"false"}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    if st != 200 or not isinstance(up, dict) or not up.get("id"):
-        return jsonify({"error":"UPLOAD_FAILED", "detail": up}), st
-    photo_id = str(up.get("id"))
-    # 2) set as cover (best-effort, field name may vary)
-    setres, st2 = graph_post(page_id, {"cover": photo_id}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    st3 = None
-    # Fallback: try cover_photo field if needed
-    if st2 >= 400:
-        setres2, st3 = graph_post(page_id, {"cover_photo": photo_id}, page_token, ctx_key=_ctx_key_for_page(page_id))
-        if st3 is not None and st3 < 400:
-            setres, st2 = setres2, st3
-    return jsonify(setres), st2
+def _media_path(key: str) -> str:
+    return os.path.join(MEDIA_DIR, key)
 
-# ------- Posting & Reels -------
-@app.route("/api/pages/<page_id>/post", methods=["POST"])
-def api_post_to_page(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error": "NOT_LOGGED_IN"}), 401
-    body = request.get_json(force=True)
-    message = (body.get("message") or "").trim() if hasattr(str, "trim") else (body.get("message") or "").strip()
-    if not message: return jsonify({"error": "EMPTY_MESSAGE"}), 400
-    if _recent_content_guard("post", page_id, message, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_MESSAGE", "note": "Nội dung tương tự đã được đăng gần đây (<=60 phút)."}), 429
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error": "NO_PAGE_TOKEN"}), 403
-    data, status = graph_post(f"{page_id}/feed", {"message": message}, page_token, ctx_key=_ctx_key_for_page(page_id))
+def _media_fetch(key: str, url: str, cached: Optional[sqlite3.Row]) -> Tuple[Optional[Dict[str, Any]], int]:
+    """GET (conditional when cached) into the cache; returns (cache row, upstream status)."""
+    headers = {}
+    if cached is not None:
+        if cached["etag"]: headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]: headers["If-Modified-Since"] = cached["last_modified"]
+    limit, now = MEDIA_MAX_OBJECT_MB * 1024 * 1024, pytime.time()
     try:
-        if status == 200 and isinstance(data, dict) and data.get("id"):
-            d2, s2 = graph_get(data["id"], {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-            if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+        r = _http().request("GET", url, headers=headers, stream=True, timeout=(5, 60))
+    except requests.RequestException:
+        return None, 502
+    with r:
+        if r.status_code == 304 and cached is not None:
+            _db().execute("UPDATE media_cache SET fetched_at=? WHERE key=?", (now, key))
+            return dict(cached, fetched_at=now), 304
+        if r.status_code != 200:
+            return None, r.status_code
+        if int(r.headers.get("Content-Length") or 0) > limit:
+            return None, 413
+        import hashlib
+        os.makedirs(MEDIA_DIR, exist_ok=True)
+        tmp, size, h = _temp_beside(_media_path(key)), 0, hashlib.sha256()
+        try:
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(1 << 16):
+                    size += len(chunk)
+                    if size > limit:
+                        raise OverflowError
+                    h.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp, _media_path(key))
+        except (OSError, OverflowError, requests.RequestException) as e:
+            try: os.remove(tmp)
+            except OSError: pass
+            return None, 413 if isinstance(e, OverflowError) else 502
+        for side in MEDIA_THUMB_SIDES:  # thumbnails of the old bytes are stale now
+            try: os.remove(f"{_media_path(key)}.t{side}")
+            except OSError: pass
+        row = {"key": key, "size": size, "content_type": r.headers.get("Content-Type"), "etag": r.headers.get("ETag"),
+               "last_modified": r.headers.get("Last-Modified"), "digest": h.hexdigest(), "fetched_at": now, "accessed_at": now}
+    _db().execute("INSERT OR REPLACE INTO media_cache(key, size, content_type, etag, last_modified, digest, fetched_at, accessed_at) "
+                  "VALUES (:key,:size,:content_type,:etag,:last_modified,:digest,:fetched_at,:accessed_at)", row)
+    _media_trim()
+    return row, 200
 
-@app.route("/api/pages/<page_id>/photo", methods=["POST"])
-def api_post_photo(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "photo" not in request.files: return jsonify({"error":"MISSING_PHOTO"}), 400
-    file = request.files["photo"]
-    cap = request.form.get("caption","")
-    if cap and _recent_content_guard("photo_caption", page_id, cap, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_CAPTION", "note": "Caption ảnh đã được dùng gần đây (<=60 phút)."}), 429
-    files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
-    form = {"caption": cap, "published": "true"}
-    data, status = graph_post_multipart(f"{page_id}/photos", files, form, page_token, ctx_key=_ctx_key_for_page(page_id))
-    try:
-        if status == 200 and isinstance(data, dict):
-            pid = data.get("id") or data.get("post_id")
-            if pid:
-                d2, s2 = graph_get(str(pid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-                if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                    data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+def _media_trim():
+    """Evict least recently served objects (and their thumbnails) until the cache fits MEDIA_CACHE_MAX_MB."""
+    conn = _db()
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM media_cache").fetchone()[0]
+    limit = MEDIA_CACHE_MAX_MB * 1024 * 1024
+    if total <= limit:
+        return
+    for r in conn.execute("SELECT key, size FROM media_cache ORDER BY accessed_at").fetchall():
+        if total <= limit:
+            break
+        for p in [_media_path(r["key"]), *(f"{_media_path(r['key'])}.t{s}" for s in MEDIA_THUMB_SIDES)]:
+            try: os.remove(p)
+            except OSError: pass
+        conn.execute("DELETE FROM media_cache WHERE key=?", (r["key"],))
+        total -= r["size"]
 
-@app.route("/api/pages/<page_id>/video", methods=["POST"])
-def api_post_video(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
-    file = request.files["video"]
-    desc = request.form.get("description","")
-    if desc and _recent_content_guard("video_desc", page_id, desc, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_DESCRIPTION", "note": "Mô tả video đã được dùng gần đây (<=60 phút)."}), 429
-    files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
-    form = {"description": desc}
-    data, status = graph_post_multipart(f"{page_id}/videos", files, form, page_token, ctx_key=_ctx_key_for_page(page_id))
-    try:
-        if status == 200 and isinstance(data, dict):
-            vid = data.get("id") or data.get("video_id")
-            if vid:
-                d2, s2 = graph_get(str(vid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-                if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                    data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+def _media_fresh_url(ref: sqlite3.Row) -> Optional[str]:
+    """The CDN url expired: read the message again for a new one."""
+    token = _background_page_token(ref["page_id"])
+    if not token:
+        return None
+    data, st = graph_get(ref["message_id"], {"fields": "id,attachments,shares"}, token, ctx_key=_ctx_key_for_page(ref["page_id"]))
+    if st != 200 or not isinstance(data, dict):
+        return None
+    for slot, _, url, _ in _media_slots(data):
+        if slot == ref["slot"]:
+            _db().execute("UPDATE media_refs SET url=?, updated=? WHERE key=?", (url, pytime.time(), ref["key"]))
+            return url
+    return None
 
-@app.route("/api/pages/<page_id>/reel", methods=["POST"])
-def api_post_reel(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
-    file = request.files["video"]
-    desc = request.form.get("description","")
-    start_res, st1 = reels_start(page_id, page_token)
-    if st1 != 200 or not isinstance(start_res, dict) or "video_id" not in start_res:
-        return jsonify({"error":"REELS_START_FAILED", "detail": start_res}), st1
-    video_id = start_res.get("video_id")
-    headers = {"Authorization": f"OAuth {page_token}", "offset": "0", "Content-Type": "application/octet-stream"}
-    try:
-        data_bytes = file.stream.read()
-        _wait_throttle("global")
-        ru = requests.post(f"{RUPLOAD_BASE}/{video_id}", headers=headers, data=data_bytes, timeout=600)
-        if ru.status_code >= 400:
-            try: return jsonify({"error":"REELS_RUPLOAD_FAILED", "detail": ru.json()}), ru.status_code
-            except Exception: return jsonify({"error":"REELS_RUPLOAD_FAILED", "detail": ru.text}), ru.status_code
-    except Exception as e:
-        return jsonify({"error":"REELS_RUPLOAD_EXCEPTION", "detail": str(e)}), 500
-    fin_res, st3 = reels_finish(page_id, page_token, video_id, desc)
-    if st3 != 200: return jsonify({"error":"REELS_FINISH_FAILED", "detail": fin_res}), st3
+def _media_thumb(key: str, side: int) -> Optional[str]:
+    path = f"{_media_path(key)}.t{side}"
+    if os.path.exists(path):
+        return path
+    if Image is None:
+        return None
+    tmp = None
     try:
-        vid = fin_res.get("video_id") or video_id
-        d2, s2 = graph_get(str(vid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-        if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-            fin_res["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(fin_res), 200
+        with Image.open(_media_path(key)) as im:
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((side, side), Image.LANCZOS)
+            tmp = _temp_beside(path)
+            im.convert("RGB").save(tmp, "JPEG", quality=80, optimize=True)
+        os.replace(tmp, path)
+    except Exception:
+        if tmp:
+            try: os.remove(tmp)
+            except OSError: pass
+        return None
+    return path
+
+@app.route("/api/media/<key>")
+def api_media(key):
+    """
+    Proxied attachment bytes. Cached copies are served locally (Range and If-None-Match handled by send_file),
+    revalidated upstream after MEDIA_REVALIDATE_SEC, and kept when the CDN url has since expired.
+    ?thumb=160|320|640 returns a JPEG thumbnail of an image.
+    """
+    ref = _db().execute("SELECT * FROM media_refs WHERE key=?", (key,)).fetchone()
+    if ref is None:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    with _media_lock(key):  # one upstream fetch per object however many viewers ask at once
+        row = _db().execute("SELECT * FROM media_cache WHERE key=?", (key,)).fetchone()
+        if row is not None and not os.path.exists(_media_path(key)):
+            row = None
+        now = pytime.time()
+        if row is None or now - row["fetched_at"] > MEDIA_REVALIDATE_SEC:
+            got, st = _media_fetch(key, ref["url"], row)
+            if got is None and st in (400, 403, 404, 410) and row is None:
+                url = _media_fresh_url(ref)
+                if url:
+                    got, st = _media_fetch(key, url, None)
+            if got is not None:
+                row = got
+            elif row is None:
+                if st == 413:
+                    return redirect(ref["url"])
+                return jsonify({"error": "MEDIA_UNAVAILABLE", "upstream_status": st}), 502
+            else:
+                _db().execute("UPDATE media_cache SET fetched_at=? WHERE key=?", (now, key))  # keep the copy; check again later
+        _db().execute("UPDATE media_cache SET accessed_at=? WHERE key=?", (now, key))
+    # the ETag follows the bytes: a revalidation that changes nothing keeps it, new bytes always change it
+    path, mime, etag = _media_path(key), row["content_type"] or "application/octet-stream", (row["digest"][:32] if row["digest"] else f"{key}-{row['size']}")
+    try: side = int(request.args.get("thumb") or 0)
+    except ValueError: side = 0
+    if side and mime.startswith("image/"):
+        side = min(MEDIA_THUMB_SIDES, key=lambda s: abs(s - side))
+        thumb = _media_thumb(key, side)
+        if thumb:
+            path, mime, etag = thumb, "image/jpeg", f"{etag}-t{side}"
+    resp = send_file(os.path.abspath(path), mimetype=mime, conditional=True, etag=etag, max_age=86400)
+    resp.headers["Cache-Control"] = "private, max-age=86400"
+    return resp
 
 # ----------------------------
-# INBOX APIs (new)
+# Page info snapshots: PAGE_INFO_FIELDS for every page via ?ids= reads, stored as content-addressed versions
 # ----------------------------
-@app.route("/api/pages/<page_id>/conversations")
-def api_list_conversations(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    fields = "id,link,updated_time,unread_count,participants,senders"
-    data, st = graph_get(f"{page_id}/conversations", {"fields": fields, "limit": 20}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+_DB_SCHEMA += [
+    "CREATE TABLE IF NOT EXISTS page_snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, pages INTEGER NOT NULL, errors INTEGER NOT NULL)",
+    # unchanged pages point at the same blob, so a snapshot costs one small row per page
+    "CREATE TABLE IF NOT EXISTS page_info_blobs (hash TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID",
+    """CREATE TABLE IF NOT EXISTS page_snapshot_items (
+        snapshot_id INTEGER NOT NULL, page_id TEXT NOT NULL, hash TEXT, error TEXT,
+        PRIMARY KEY (snapshot_id, page_id)) WITHOUT ROWID""",
+]
 
-@app.route("/api/pages/<page_id>/conversations/<thread_id>")
-def api_get_conversation(page_id, thread_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    fields = "id,link,messages.limit(50){id,created_time,from,to,message,attachments,shares,permalink_url},participants"
-    data, st = graph_get(thread_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-    # Map participant IDs to names to render on client nicely
+def _page_info_read(ids: List[str], user_token: Optional[str], out: Dict[str, Any], errors: Dict[str, str], calls: List[int]):
+    """
+    One ?ids= read per chunk with the user token. A chunk Graph refuses as a whole (one page we cannot read fails
+    the request) is split in halves; a single page falls back to its own page token.
+    """
+    if not ids:
+        return
+    if user_token and len(ids) > 1:
+        calls[0] += 1
+        data, st = graph_get("", {"ids": ",".join(ids), "fields": PAGE_INFO_FIELDS}, user_token, ttl=0)
+        if st == 200 and isinstance(data, dict):
+            for pid in ids:
+                if isinstance(data.get(pid), dict): out[pid] = data[pid]
+                else: errors[pid] = "MISSING_IN_RESPONSE"
+            return
+        if _is_retryable(data, st):
+            errors.update({pid: f"HTTP_{st}" for pid in ids})
+            return
+        half = len(ids) // 2
+        _page_info_read(ids[:half], user_token, out, errors, calls)
+        _page_info_read(ids[half:], user_token, out, errors, calls)
+        return
+    pid = ids[0]
+    token = get_page_access_token(pid, user_token) or user_token
+    calls[0] += 1
+    data, st = graph_get(pid, {"fields": PAGE_INFO_FIELDS}, token, ttl=0, ctx_key=_ctx_key_for_page(pid))
+    if st == 200 and isinstance(data, dict): out[pid] = data
+    else: errors[pid] = json.dumps((data or {}).get("error") if isinstance(data, dict) else data, ensure_ascii=False)[:300]
+
+def _snapshot_pages(snapshot_id: int, only: Optional[set] = None) -> Dict[str, sqlite3.Row]:
+    return {r["page_id"]: r for r in _db().execute(
+        "SELECT page_id, hash, error FROM page_snapshot_items WHERE snapshot_id=?", (snapshot_id,))
+        if only is None or r["page_id"] in only}
+
+def page_snapshot_diff(a: int, b: int, page_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Field-level changes from snapshot a to b (limited to `page_ids` if given); only pages whose content hash
+    differs are decoded. Pages that went from data to an error, or back, are listed as now_failing / recovered.
+    """
+    only = set(page_ids) if page_ids else None
+    old_rows, new_rows = _snapshot_pages(a, only), _snapshot_pages(b, only)
+    old, new = {p: r["hash"] for p, r in old_rows.items()}, {p: r["hash"] for p, r in new_rows.items()}
+    changed: Dict[str, Any] = {}
+    moved = [pid for pid in new if pid in old and new[pid] and old[pid] and new[pid] != old[pid]]
+    if moved:
+        hashes = list({old[p] for p in moved} | {new[p] for p in moved})
+        blobs = {r["hash"]: json.loads(r["data"]) for r in _db().execute(
+            f"SELECT hash, data FROM page_info_blobs WHERE hash IN ({','.join('?' * len(hashes))})", hashes)}
+        for pid in moved:
+            x, y = blobs.get(old[pid], {}), blobs.get(new[pid], {})
+            changed[pid] = {k: {"from": x.get(k), "to": y.get(k)} for k in sorted(set(x) | set(y)) if x.get(k) != y.get(k)}
+    return {"from": a, "to": b, "changed": changed,
+            "added": sorted(p for p in new if p not in old), "removed": sorted(p for p in old if p not in new),
+            "now_failing": {p: new_rows[p]["error"] for p in sorted(new) if p in old and old[p] and not new[p]},
+            "recovered": sorted(p for p in new if p in old and new[p] and not old[p])}
+
+@job_handler("page_snapshot", pool="sync", lane="read")
+def _job_page_snapshot(p: dict):
+    user_token = p.get("user_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    ids = p.get("page_ids") or _known_page_ids(user_token)
+    if not ids:
+        return {"error": "NO_PAGES"}, 400
+    out: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    calls = [0]
+    for i in range(0, len(ids), GRAPH_MAX_IDS):
+        _page_info_read(ids[i:i + GRAPH_MAX_IDS], user_token, out, errors, calls)
+    rows, blobs = [], []
+    for pid in ids:
+        if pid in out:
+            data = {k: v for k, v in out[pid].items() if k != "id"}
+            raw = json.dumps(data, ensure_ascii=False, sort_keys=True)
+            h = _hash_content(raw)[:32]
+            blobs.append((h, raw)); rows.append((pid, h, None))
+        else:
+            rows.append((pid, None, errors.get(pid, "UNKNOWN")))
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        id2name = {}
-        for pcp in (data.get("participants", {}) or {}).get("data", []) if isinstance(data, dict) else []:
-            pid = pcp.get("id"); nm = pcp.get("name")
-            if pid and nm: id2name[str(pid)] = nm
-        msgs = (data.get("messages", {}) or {}).get("data", []) if isinstance(data, dict) else []
-        for m in msgs:
-            fr = m.get("from") or {}
-            if fr.get("id") and not fr.get("name"):
-                if str(fr["id"]) in id2name:
-                    fr["name"] = id2name[str(fr["id"])]
-                    m["from"] = fr
+        # diff against the latest snapshot that read all of these pages, so a partial run is not a mass "removed"
+        marks = ",".join("?" * len(ids))
+        prev = conn.execute(f"SELECT snapshot_id FROM page_snapshot_items WHERE page_id IN ({marks}) GROUP BY snapshot_id "
+                            "HAVING COUNT(*) = ? ORDER BY snapshot_id DESC LIMIT 1", (*ids, len(ids))).fetchone()
+        prev = prev[0] if prev else conn.execute("SELECT MAX(id) FROM page_snapshots").fetchone()[0]
+        sid = conn.execute("INSERT INTO page_snapshots(created, pages, errors) VALUES (?,?,?)",
+                           (pytime.time(), len(out), len(ids) - len(out))).lastrowid
+        conn.executemany("INSERT OR IGNORE INTO page_info_blobs(hash, data) VALUES (?,?)", blobs)
+        conn.executemany("INSERT INTO page_snapshot_items(snapshot_id, page_id, hash, error) VALUES (?,?,?,?)",
+                         [(sid, *r) for r in rows])
+        conn.execute("COMMIT")
     except Exception:
-        pass
-    return jsonify(data), st
-
+        conn.execute("ROLLBACK")
+        raise
+    result = {"snapshot_id": sid, "pages": len(out), "graph_calls": calls[0],
+              "errors": [{"page_id": pid, "error": e} for pid, e in errors.items() if pid not in out]}
+    if prev:
+        result["diff"] = page_snapshot_diff(prev, sid, ids)
+    return result, 200
 
-@app.route("/api/pages/<page_id>/messages", methods=["POST"])
-def api_send_message(page_id):
+@app.route("/api/pages/snapshots", methods=["POST"])
+def api_page_snapshot_create():
+    """JSON {page_ids?: [...]} (default: every known page). Result: snapshot id, errors and the diff to the previous snapshot."""
     token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    body = request.get_json(force=True)
-    recipient_id = (body.get("recipient_id") or "").strip()
-    text = (body.get("text") or "").strip()
-    if not recipient_id or not text:
-        return jsonify({"error":"MISSING_RECIPIENT_OR_TEXT"}), 400
-    # For pages_messaging, recipient/message must be JSON strings in x-www-form-urlencoded
-    data = {
-        "recipient": json.dumps({"id": recipient_id}),
-        "message": json.dumps({"text": text}),
-        "messaging_type": "RESPONSE"
-    }
-    res, st = graph_post(f"{page_id}/messages", data, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(res), st
+    body = request.get_json(silent=True) or {}
+    page_ids = [str(x).strip() for x in (body.get("page_ids") or []) if str(x).strip()]
+    if not token and not (page_ids or _known_page_ids(None)):
+        return jsonify({"error": "NOT_LOGGED_IN"}), 401
+    return _job_accepted(enqueue_job("page_snapshot", {"page_ids": page_ids, "user_token": session.get("user_access_token")}))
+
+@app.route("/api/pages/snapshots")
+def api_page_snapshots():
+    rows = _db().execute("SELECT * FROM page_snapshots ORDER BY id DESC LIMIT ?", (max(1, min(200, request.args.get("limit", 50, type=int) or 50)),))
+    return _json_response({"data": [dict(r) for r in rows]})
+
+@app.route("/api/pages/snapshots/<int:snapshot_id>")
+def api_page_snapshot_get(snapshot_id):
+    rows = _db().execute("SELECT i.page_id, i.error, b.data FROM page_snapshot_items i LEFT JOIN page_info_blobs b ON b.hash = i.hash "
+                         "WHERE i.snapshot_id=? ORDER BY i.page_id", (snapshot_id,)).fetchall()
+    if not rows:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    return _json_response({"id": snapshot_id, "data": {r["page_id"]: json.loads(r["data"]) if r["data"] else {"error": r["error"]} for r in rows}})
+
+@app.route("/api/pages/snapshots/diff")
+def api_page_snapshot_diff():
+    """?from=&to= snapshot ids (default: the two most recent) &page_ids=a,b to compare only those pages."""
+    try:
+        a, b = request.args.get("from", type=int), request.args.get("to", type=int)
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    page_ids = [x.strip() for x in (request.args.get("page_ids") or "").split(",") if x.strip()]
+    if a is None or b is None:
+        recent = [r[0] for r in _db().execute("SELECT id FROM page_snapshots ORDER BY id DESC LIMIT 2")]
+        if len(recent) < 2:
+            return jsonify({"error": "NEED_TWO_SNAPSHOTS"}), 404
+        b, a = (b or recent[0]), (a or recent[1])
+    return _json_response(page_snapshot_diff(a, b, page_ids or None))
 
 # ----------------------------
 # AI writer & diagnostics/config/exchange
@@ -1445,6 +5332,63 @@ Hashtags:
 # ----------------------------
 # Diagnostics/config/token
 # ----------------------------
+# ------- Webhook: signature check on the raw body, redelivery dedupe -------
+WEBHOOK_REQUIRE_SIGNATURE = os.environ.get("WEBHOOK_REQUIRE_SIGNATURE", "0") == "1"
+WEBHOOK_DEDUPE_MAX = int(os.environ.get("WEBHOOK_DEDUPE_MAX", "50000"))
+WEBHOOK_DEDUPE_TTL_SEC = int(os.environ.get("WEBHOOK_DEDUPE_TTL_SEC", "86400"))
+
+_WEBHOOK_SEEN: "OrderedDict[str, float]" = OrderedDict()  # key -> first seen, oldest first
+_WEBHOOK_SEEN_LOCK = threading.Lock()
+
+def _app_secrets() -> List[str]:
+    # any app in the pool may be the one subscribed to this page
+    return [x for x in [app_cfg()[1], *(a["app_secret"] for a in _APPS.values())] if x]
+
+def _webhook_signature_ok(raw: bytes) -> bool:
+    import hashlib, hmac
+    secrets = _app_secrets()
+    if not secrets:
+        return not WEBHOOK_REQUIRE_SIGNATURE
+    sig = request.headers.get("X-Hub-Signature-256") or ""
+    if not sig.startswith("sha256="):
+        return False
+    sig = sig[7:].strip().lower()
+    return any(hmac.compare_digest(hmac.new(sec.encode("utf-8"), raw, hashlib.sha256).hexdigest(), sig) for sec in secrets)
+
+def _webhook_event_keys(en: dict) -> List[Tuple[str, str, Any]]:
+    """(dedupe key, list name, item) for every event of one entry: messaging by mid, changes by object id + time."""
+    page = str(en.get("id") or "")
+    out = []
+    for m in en.get("messaging", []) or []:
+        msg = m.get("message") or {}
+        ident = msg.get("mid") or f"{(m.get('sender') or {}).get('id')}:{m.get('timestamp')}:{','.join(sorted(k for k in m if k not in ('sender', 'recipient', 'timestamp')))}"
+        out.append((f"{page}|m|{ident}", "messaging", m))
+    for chg in en.get("changes", []) or []:
+        val = chg.get("value") or {}
+        ident = val.get("mid") or val.get("comment_id") or val.get("post_id") or val.get("id") or ""
+        stamp = val.get("created_time") or val.get("timestamp") or en.get("time")
+        out.append((f"{page}|c|{chg.get('field')}|{ident}|{val.get('verb', '')}|{stamp}", "changes", chg))
+    return out
+
+def _webhook_dedupe(data: dict) -> int:
+    """Drop events already seen from `data` in place; returns how many events are left."""
+    now = pytime.time()
+    left = 0
+    with _WEBHOOK_SEEN_LOCK:
+        while _WEBHOOK_SEEN and (len(_WEBHOOK_SEEN) > WEBHOOK_DEDUPE_MAX or next(iter(_WEBHOOK_SEEN.values())) < now - WEBHOOK_DEDUPE_TTL_SEC):
+            _WEBHOOK_SEEN.popitem(last=False)
+        for en in data.get("entry", []) or []:
+            if not isinstance(en, dict): continue
+            keep: Dict[str, list] = {"messaging": [], "changes": []}
+            for key, lst, item in _webhook_event_keys(en):
+                if key in _WEBHOOK_SEEN: continue
+                _WEBHOOK_SEEN[key] = now
+                keep[lst].append(item)
+            for lst, items in keep.items():
+                if lst in en: en[lst] = items
+            left += len(keep["messaging"]) + len(keep["changes"])
+    return left
+
 @app.route("/webhook", methods=["GET", "POST"])
 def webhook():
     if request.method == "GET":
@@ -1453,31 +5397,60 @@ def webhook():
         if verify == SETTINGS.get("webhook_verify_token"):
             return challenge or "", 200
         return "Forbidden", 403
+    raw = request.get_data(cache=False)
+    if not _webhook_signature_ok(raw):
+        return "Invalid signature", 403
     try:
-        data = request.get_json(force=True)
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
     except Exception:
         data = {"error": "invalid json"}
-    SETTINGS["_last_events"].append({"ts": int(pytime.time()), "data": data})
-    SETTINGS["_last_events"] = SETTINGS["_last_events"][-100:]
-    
-    try:
-        entries = (data or {}).get("entry", [])
-        for en in entries:
-            for chg in en.get("changes", []):
-                val = chg.get("value", {})
-                # message events
-                for m in val.get("messages", []) or []:
-                    sender = (m.get("from") or (m.get("sender") or {}).get("id"))
-                    text = (m.get("text", {}) or {}).get("body") or m.get("message")
-                    broadcast({"type":"message", "page_id": val.get("page") or val.get("page_id"), "sender_id": sender, "text": text, "time": m.get("timestamp")})
-                for mr in val.get("message_reads", []) or []:
-                    broadcast({"type":"message_reads", "page_id": val.get("page") or val.get("page_id"), "watermark": val.get("watermark")})
-    except Exception:
-        pass
+    if isinstance(data, dict) and data.get("entry") and not _webhook_dedupe(data):
+        return "ok", 200  # redelivery: every event in it was already handled
+    entries = data.get("entry") if isinstance(data, dict) else None
+    if isinstance(entries, list) and entries:
+        event_log_append([((str(en.get("id")) if en.get("id") else None) if isinstance(en, dict) else None, en) for en in entries])
+    else:
+        event_log_append([(None, data)])
     return "ok", 200
+
 @app.route("/webhook/events")
 def webhook_events():
-    return jsonify(SETTINGS.get("_last_events", [])[-20:]), 200
+    # polled every 5 s by every open tab: answer from the event counter before serializing anything
+    etag = f"ev-{event_log_head()}"
+    if _etag_matches(etag):
+        return _not_modified(etag)
+    return _json_response(event_log_tail(20), 200, etag=etag)
+
+@app.route("/api/events")
+def api_events():
+    """Replay the webhook log: ?from=<offset>&page_id=&since=<unix ts>&limit=; continue with `next`."""
+    try:
+        offset = int(request.args.get("from", "0"))
+        limit = max(1, min(int(request.args.get("limit", "100")), 1000))
+        since = float(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        return jsonify({"error": "INVALID_ARGS"}), 400
+    recs, nxt = event_log_read(offset, limit, request.args.get("page_id") or None, since)
+    return _json_response({"data": recs, "next": nxt, "head": event_log_head()})
+
+@app.route("/api/events/consumers")
+def api_event_consumers():
+    rows = _db().execute("SELECT name, offset, locked_by, locked_at, updated FROM event_cursors ORDER BY name").fetchall()
+    head = event_log_head()
+    return jsonify({"head": head, "data": [dict(r, lag_bytes=max(0, head - int(r["offset"]))) for r in rows]}), 200
+
+@app.route("/api/events/consumers/<name>/replay", methods=["POST"])
+def api_event_consumer_replay(name):
+    """Rewind a consumer to `from` (default: oldest retained event) so it rebuilds its state from the log."""
+    if name not in EVENT_CONSUMERS:
+        return jsonify({"error": "UNKNOWN_CONSUMER"}), 404
+    body = request.get_json(silent=True) or {}
+    segs = _segments()
+    try: offset = int(body.get("from", segs[0] if segs else 0))
+    except (TypeError, ValueError): return jsonify({"error": "INVALID_OFFSET"}), 400
+    _db().execute("UPDATE event_cursors SET offset=?, updated=? WHERE name=?", (offset, pytime.time(), name))
+    _EVENT_LOG["wake"].set()
+    return jsonify({"ok": True, "name": name, "offset": offset}), 200
 
 @app.route("/api/usage")
 def api_usage():
@@ -1485,9 +5458,300 @@ def api_usage():
     return jsonify({
         "cooldown_remaining": max(0, int(SETTINGS.get("cooldown_until",0) or 0) - now),
         "last_usage": SETTINGS.get("last_usage", {}),
+        "apps": _app_pool_status(),
+        "lanes": _lane_stats(),
         "poll_intervals": SETTINGS.get("poll_intervals")
     }), 200
 
+# ----------------------------
+# Async (ASGI) views for Graph-bound endpoints
+# (publishing only enqueues a job, so it stays on the regular thread path)
+# ----------------------------
+ASYNC_VIEWS: Dict[str, Any] = {}
+
+def _async_view(endpoint: str):
+    """Register a coroutine twin for a Flask endpoint; used only when served through `asgi_app`."""
+    def deco(fn):
+        ASYNC_VIEWS[endpoint] = fn
+        return fn
+    return deco
+
+@_async_view("api_list_pages")
+async def api_list_pages_async():
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if token:
+        data, status = await graph_get_async("me/accounts", {"limit": 200}, token, ttl=0)
+        return _json_response(data, status)
+    try:
+        env_pages = await asyncio.to_thread(_env_pages_list)
+        if env_pages:
+            return _json_response({"data": env_pages}, 200)
+    except Exception:
+        pass
+    return jsonify({"error": "NOT_LOGGED_IN"}), 401
+
+async def _async_page_token(page_id: str):
+    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    if not token: return None, (jsonify({"error":"NOT_LOGGED_IN"}), 401)
+    page_token = await asyncio.to_thread(get_page_access_token, page_id, token)
+    if not page_token: return None, (jsonify({"error":"NO_PAGE_TOKEN"}), 403)
+    return page_token, None
+
+@_async_view("api_page_info")
+async def api_page_info_async(page_id):
+    page_token, err = await _async_page_token(page_id)
+    if err: return err
+    fields = "name,about,description,website,location{street,city,zip,country}"
+    data, st = await graph_get_async(page_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    return jsonify(data), st
+
+@_async_view("api_list_conversations")
+async def api_list_conversations_async(page_id):
+    page_token, err = await _async_page_token(page_id)
+    if err: return err
+    data, st = await graph_get_async(f"{page_id}/conversations", dict(CONVERSATION_LIST_PARAMS), page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    return _json_response(data, st)
+
+@_async_view("api_get_conversation")
+async def api_get_conversation_async(page_id, thread_id):
+    page_token, err = await _async_page_token(page_id)
+    if err: return err
+    data, st = await graph_get_async(thread_id, dict(CONVERSATION_PARAMS), page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
+    _conversation_names(data)
+    if st == 200:
+        await asyncio.to_thread(_media_register, _media_attach(page_id, data))
+    return _json_response(data, st)
+
+@_async_view("api_send_message")
+async def api_send_message_async(page_id):
+    page_token, err = await _async_page_token(page_id)
+    if err: return err
+    data, err = _send_message_form(request.get_json(force=True))
+    if err: return err
+    res, st = await graph_post_async(f"{page_id}/messages", data, page_token, ctx_key=_ctx_key_for_page(page_id))
+    return jsonify(res), st
+
+# ----------------------------
+# ASGI entry point: `uvicorn app:asgi_app` (the Procfile keeps serving the WSGI `app`)
+# ----------------------------
+def _asgi_environ(scope: dict, body: bytes) -> dict:
+    import io, sys
+    headers = scope.get("headers") or []
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": (scope.get("query_string") or b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for raw_name, raw_value in headers:
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "HTTP_" + name
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _wsgi_call(environ: dict):
+    out = {}
+    def start_response(status, headers, exc_info=None):
+        out["status"], out["headers"] = int(status.split(" ", 1)[0]), headers
+    it = app.wsgi_app(environ, start_response)
+    try:
+        body = b"".join(it)
+    finally:
+        if hasattr(it, "close"): it.close()
+    return out["status"], out["headers"], body
+
+async def _asgi_dispatch_async(environ: dict, view):
+    """Run one coroutine view inside a real Flask request context (session, PIN gate, hooks all apply)."""
+    with app.request_context(environ):
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = await view(**(request.view_args or {}))
+            resp = app.make_response(rv)
+            resp = app.process_response(resp)
+        except Exception as e:
+            try:
+                resp = app.make_response(app.handle_user_exception(e))  # HTTPExceptions and registered handlers
+            except Exception:
+                # what Flask would turn into a 500 on the WSGI path; here it would otherwise escape the ASGI app
+                app.logger.exception("async view %s failed", request.endpoint)
+                resp = app.make_response((jsonify({"error": "INTERNAL_ERROR"}), 500))
+            resp = app.process_response(resp)
+        body = b"".join(resp.iter_encoded())
+        return resp.status_code, list(resp.headers.items()), body
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await _async_client_close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    chunks = []
+    while True:
+        msg = await receive()
+        chunks.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            break
+    environ = _asgi_environ(scope, b"".join(chunks))
+    view = None
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+        view = ASYNC_VIEWS.get(endpoint)
+    except Exception:
+        view = None
+    if view is not None:
+        status, headers, body = await _asgi_dispatch_async(environ, view)
+    else:
+        # everything else (UI, webhook, config, ...) runs the regular Flask app on a worker thread
+        status, headers, body = await asyncio.to_thread(_wsgi_call, environ)
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+@app.route("/api/debug/traces")
+def api_debug_traces():
+    try: limit = max(1, min(int(request.args.get("limit", "50")), TRACE_MAX))
+    except Exception: limit = 50
+    try: min_ms = float(request.args.get("min_ms", "0") or 0)
+    except Exception: min_ms = 0.0
+    items = [t for t in list(SETTINGS["_traces"]) if (t.get("dur_ms") or 0) >= min_ms][-limit:]
+    items.reverse()
+    return jsonify({
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "profile_threshold_ms": TRACE_PROFILE_MS,
+        "data": [{"id": t["id"], "ts": t["ts"], "name": t["name"], "status": t["status"], "dur_ms": t["dur_ms"],
+                  "has_profile": bool(t.get("profile"))} for t in items]
+    }), 200
+
+@app.route("/api/debug/traces/<trace_id>")
+def api_debug_trace(trace_id):
+    for t in list(SETTINGS["_traces"]):
+        if t["id"] == trace_id:
+            return jsonify(t), 200
+    return jsonify({"error": "TRACE_NOT_FOUND"}), 404
+
+# ----------------------------
+# Startup warmup (in the gunicorn master under --preload) and health/readiness probes
+# ----------------------------
+WARMUP = os.environ.get("WARMUP", "auto")  # "1" always, "0" never, "auto" when started by gunicorn
+READY_PROBE_TTL_SEC = float(os.environ.get("READY_PROBE_TTL_SEC", "10"))
+_STARTED_AT = pytime.time()
+_WARM: Dict[str, Any] = {"state": "cold", "steps": {}, "errors": {}, "pid": None, "lock": threading.Lock()}
+_PROBES: Dict[str, Any] = {"ts": 0.0, "pid": None, "deps": {}}
+# a --preload master only forks: its workers start their background threads after the fork instead
+_PRELOAD_MASTER = "--preload" in sys.argv[1:] or "--preload" in os.environ.get("GUNICORN_CMD_ARGS", "")
+
+def warmup():
+    """Do what the first requests would otherwise pay for: token directory, ENV page names, UI assets, DB schema,
+    and (outside a --preload master) the background threads, so due jobs and scheduled posts run without a request."""
+    with _WARM["lock"]:
+        if _WARM["state"] != "cold":
+            return
+        _WARM["state"] = "warming"
+    steps = (("tokens", load_tokens),
+             ("env_tokens", _env_get_tokens),
+             ("env_pages", lambda: _env_pages_list(refresh=True)),
+             ("ui_assets", lambda: UI_ASSETS or _build_ui_assets()),
+             ("db", lambda: _db().execute("SELECT 1").fetchone()))
+    if JOB_WORKERS_ENABLED and not _PRELOAD_MASTER:
+        steps += (("background", _start_background),)
+    for name, fn in steps:
+        t0 = pytime.time()
+        try:
+            fn()
+            _WARM["steps"][name] = round((pytime.time() - t0) * 1000.0, 1)
+        except Exception as e:
+            _WARM["errors"][name] = str(e)[:300]
+    _WARM.update(state="warm", pid=os.getpid())
+
+def _after_fork_in_child():
+    # a forked worker inherits the master's warm caches but must not reuse its sockets or held locks
+    global _BREAKER_LOCK, _APPS_LOCK
+    _HTTP.update(pid=None, session=None)
+    _ASYNC_CLIENT.update(client=None, loop=None)
+    _BREAKER_LOCK, _APPS_LOCK = threading.Lock(), threading.Lock()
+    _WARM["lock"] = threading.Lock()
+    _EVENT_LOG.update(lock=threading.Lock(), maps_lock=threading.Lock())
+    _MEDIA_LOCKS[:] = [threading.Lock() for _ in _MEDIA_LOCKS]
+    _PROBES.update(ts=0.0, pid=None, deps={})
+    _JOB_STATE["lock"] = threading.Lock()
+    if JOB_WORKERS_ENABLED:
+        # off the fork hook itself: starting the workers reads the DB (pending schedules, permalinks)
+        threading.Thread(target=_start_background, name="background-start", daemon=True).start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def _probe_dependencies() -> Dict[str, Any]:
+    now = pytime.time()
+    if _PROBES["pid"] == os.getpid() and now - _PROBES["ts"] < READY_PROBE_TTL_SEC:
+        return _PROBES["deps"]
+    deps: Dict[str, Any] = {}
+    t0 = pytime.time()
+    try:
+        _db().execute("SELECT 1").fetchone()
+        deps["sqlite"] = {"ok": True, "ms": round((pytime.time() - t0) * 1000.0, 1)}
+    except Exception as e:
+        deps["sqlite"] = {"ok": False, "error": str(e)[:200]}
+    t0 = pytime.time()
+    try:
+        # unauthenticated hit on the API host: costs no quota and leaves a warm connection in this worker's pool
+        r = _http().get(GRAPH_BASE, timeout=3)
+        deps["graph"] = {"ok": r.status_code < 500, "status": r.status_code, "ms": round((pytime.time() - t0) * 1000.0, 1)}
+    except requests.RequestException as e:
+        deps["graph"] = {"ok": False, "error": str(e)[:200], "ms": round((pytime.time() - t0) * 1000.0, 1)}
+    _PROBES.update(ts=now, pid=os.getpid(), deps=deps)
+    return deps
+
+@app.route("/healthz")
+def healthz():
+    return jsonify({"ok": True, "pid": os.getpid(), "uptime_sec": int(pytime.time() - _STARTED_AT), "version": VERSION}), 200
+
+@app.route("/readyz")
+def readyz():
+    if _WARM["state"] == "cold":
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    deps = _probe_dependencies()
+    # Graph being unreachable is reported but does not take the worker out of rotation
+    ready = _WARM["state"] == "warm" and deps["sqlite"]["ok"]
+    return jsonify({
+        "ready": ready,
+        "warm": {"state": _WARM["state"], "in_master": _WARM["pid"] not in (None, os.getpid()),
+                 "steps_ms": _WARM["steps"], "errors": _WARM["errors"]},
+        "deps": deps,
+        "pid": os.getpid(),
+        "cooldown_remaining": _respect_cooldown(),
+    }), 200 if ready else 503
+
+if WARMUP == "1" or (WARMUP == "auto" and "gunicorn" in os.path.basename((sys.argv or [""])[0])):
+    warmup()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", "5000"))
     app.run(host="0.0.0.0", port=port, debug=True, use_reloader=False)
@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("JOB_WORKERS", "0")
+os.environ.setdefault("PAGE_TOKENS", json.dumps({"1": "t1", "2": "t2", "3": "t3"}))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, body, headers=None):
+        self.status_code, self.body, self.headers = status_code, body, headers or {}
+        self.text = body.decode("latin-1") if isinstance(body, bytes) else json.dumps(body)
+
+    def json(self):
+        return self.body
+
+    def iter_content(self, size):
+        raw = self.body if isinstance(self.body, bytes) else self.text.encode()
+        for i in range(0, len(raw), size):
+            yield raw[i:i + size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeGraph:
+    """Stands in for requests.Session.request: `routes` maps a URL suffix to a (status, body) or a callable."""
+
+    def __init__(self):
+        self.routes, self.calls = {}, []
+
+    def __call__(self, session, method, url, **kw):
+        auth = (kw.get("headers") or {}).get("Authorization", "")
+        self.calls.append((method, url, dict(kw.get("params") or {}), dict(kw.get("data") or {}), auth[len("Bearer "):]))
+        for suffix, out in self.routes.items():
+            if url.split("?")[0].endswith(suffix):
+                out = out(method, url, kw) if callable(out) else out
+                return out if isinstance(out, FakeResponse) else FakeResponse(*out)
+        return FakeResponse(200, {})
+
+
+@pytest.fixture
+def app_env(tmp_path, monkeypatch):
+    """A fresh database, data dir and tokens file per test; no throttling between Graph calls."""
+    monkeypatch.setattr(A, "DB_FILE", str(tmp_path / "app.db"))
+    monkeypatch.setattr(A, "DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(A, "EVENT_LOG_DIR", str(tmp_path / "data" / "events"))
+    monkeypatch.setattr(A, "MEDIA_DIR", str(tmp_path / "data" / "media"))
+    monkeypatch.setitem(A._EVENT_LOG, "maps", {})
+    monkeypatch.setattr(A, "_BREAKERS", {})
+    monkeypatch.setattr(A, "TOKENS_FILE", str(tmp_path / "tokens.json"))
+    with open(A.TOKENS_FILE, "w") as f:
+        json.dump({"user_long": {"access_token": "u"}}, f)
+    monkeypatch.setattr(A._DB_LOCAL, "conn", None, raising=False)
+    monkeypatch.setitem(A._TOKENS_CACHE, "mtime", None)
+    monkeypatch.setitem(A._TOKEN_HEALTH, "dead", {})
+    monkeypatch.setitem(A._TOKEN_HEALTH, "ts", 0.0)
+    monkeypatch.setitem(A.SETTINGS["throttle"], "global_min_interval", 0.0)
+    monkeypatch.setitem(A.SETTINGS["throttle"], "per_page_min_interval", 0.0)
+    yield A
+    conn = getattr(A._DB_LOCAL, "conn", None)
+    if conn is not None:
+        conn.close()
+    A._DB_LOCAL.conn = None
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    fake = FakeGraph()
+    monkeypatch.setattr(A.requests.Session, "request", lambda session, method, url, **kw: fake(session, method, url, **kw))
+    return fake
+
+
+@pytest.fixture
+def client(app_env):
+    return A.app.test_client()
+
+
+@pytest.fixture
+def run_jobs(app_env):
+    """Run every queued job once, in this thread."""
+    def run():
+        for row in A._db().execute("SELECT * FROM jobs WHERE status='queued' AND run_after <= ?", (A.pytime.time(),)).fetchall():
+            A._run_job(row)
+    return run
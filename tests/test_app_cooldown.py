@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture
+def pool(app_env, monkeypatch):
+    """A second app "b" that holds page 9's token and is cooling down for ten minutes."""
+    now = app_env.pytime.time()
+    monkeypatch.setitem(app_env._APPS, "b", {"app_id": "b", "app_secret": "", "user_token": "", "page_tokens": {"9": "tb"},
+                                             "cooldown_until": now + 600, "last_usage": {}, "usage_top": 0, "discovered": True})
+    monkeypatch.setitem(app_env._TOKEN_APP, "tb", "b")
+    monkeypatch.setitem(app_env.SETTINGS, "cooldown_until", 0)
+    monkeypatch.setitem(app_env.JOB_HANDLERS, "flaky", {"fn": lambda p: ({"error": {"code": 2}}, 503), "pool": "publish", "lane": "publish"})
+    return now
+
+
+def _retry_in(A, job_id, now):
+    return A._db().execute("SELECT run_after FROM jobs WHERE id=?", (job_id,)).fetchone()[0] - now
+
+
+def test_retry_waits_for_the_jobs_own_app(app_env, graph, run_jobs, pool):
+    cooling = app_env.enqueue_job("flaky", {"page_id": "9", "page_token": "tb"})
+    healthy = app_env.enqueue_job("flaky", {"page_id": "1", "page_token": "t1"})
+    run_jobs()
+    assert _retry_in(app_env, cooling, pool) > 600
+    assert _retry_in(app_env, healthy, pool) < app_env.JOB_BACKOFF_MAX
+
+
+def test_default_app_cooldown_does_not_hold_back_other_apps(app_env, pool, monkeypatch):
+    monkeypatch.setitem(app_env._APPS["b"], "cooldown_until", 0)
+    monkeypatch.setitem(app_env.SETTINGS, "cooldown_until", pool + 600)
+    assert app_env._job_retry_delay(1, "b") < app_env.JOB_BACKOFF_MAX
+    assert app_env._job_retry_delay(1) > 600
+
+
+def test_scheduled_post_waits_for_its_pages_app(app_env, graph, pool, monkeypatch):
+    monkeypatch.setattr(app_env, "_ensure_scheduler", lambda: None)
+    sid = app_env.schedule_post("feed", "9", {"page_id": "9", "page_token": "tb", "message": "x"}, pool)["id"]
+    app_env._fire_scheduled(sid)
+    row = app_env._db().execute("SELECT status, fire_at FROM scheduled_posts WHERE id=?", (sid,)).fetchone()
+    assert row["status"] == "pending" and row["fire_at"] > pool + 600
+
+
+def test_page_token_comes_from_the_app_with_most_headroom(app_env, graph, pool, monkeypatch):
+    monkeypatch.setitem(app_env._APPS["b"]["page_tokens"], "1", "tb1")
+    monkeypatch.setitem(app_env._TOKEN_APP, "tb1", "b")
+    assert app_env.get_page_access_token("1", "u") == "t1"  # b is cooling down
+    monkeypatch.setitem(app_env._APPS["b"], "cooldown_until", 0)
+    monkeypatch.setitem(app_env.SETTINGS, "usage_top", 90)
+    assert app_env.get_page_access_token("1", "u") == "tb1"
@@ -0,0 +1,53 @@
+import asyncio
+import json
+
+import pytest
+
+THREAD = {
+    "id": "t1",
+    "participants": {"data": [{"id": "u1", "name": "Lan"}, {"id": "1", "name": "Page"}]},
+    "messages": {"data": [{"id": "m1", "message": "hi", "from": {"id": "u1"}}]},
+}
+
+
+@pytest.fixture
+def asgi(app_env, graph, monkeypatch):
+    monkeypatch.setattr(app_env, "httpx", None)  # async Graph calls fall back to the (faked) sync session
+    graph.routes["/t1"] = (200, THREAD)
+    graph.routes["/1/messages"] = (200, {"recipient_id": "u1", "message_id": "mid"})
+
+    def call(method, path, body=None):
+        raw = json.dumps(body).encode() if body is not None else b""
+        scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+                 "headers": [(b"content-type", b"application/json")]}
+        sent, msgs = [], [{"type": "http.request", "body": raw}]
+
+        async def receive():
+            return msgs.pop(0)
+
+        async def send(msg):
+            sent.append(msg)
+
+        asyncio.run(app_env.asgi_app(scope, receive, send))
+        return sent[0]["status"], json.loads(sent[1]["body"] or b"null")
+    return call
+
+
+def test_async_conversation_matches_sync(asgi, client):
+    status, data = asgi("GET", "/api/pages/1/conversations/t1")
+    sync = client.get("/api/pages/1/conversations/t1")
+    assert status == 200 and data == sync.get_json()
+    assert data["messages"]["data"][0]["from"]["name"] == "Lan"
+
+
+def test_async_send_validates_like_sync(asgi, client):
+    assert asgi("POST", "/api/pages/1/messages", {"recipient_id": "u1"}) == (400, {"error": "MISSING_RECIPIENT_OR_TEXT"})
+    status, data = asgi("POST", "/api/pages/1/messages", {"recipient_id": "u1", "text": "hello"})
+    assert status == 200 and data["message_id"] == "mid"
+
+
+def test_async_view_error_is_a_json_500(asgi, app_env, monkeypatch):
+    async def boom(*a, **kw):
+        raise RuntimeError("unexpected")
+    monkeypatch.setattr(app_env, "graph_get_async", boom)
+    assert asgi("GET", "/api/pages/1/conversations/t1") == (500, {"error": "INTERNAL_ERROR"})
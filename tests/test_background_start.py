@@ -0,0 +1,39 @@
+import threading
+import types
+
+import pytest
+
+
+@pytest.fixture
+def started(app_env, graph, monkeypatch):
+    """Record which background starters run, without starting real threads."""
+    calls = []
+    monkeypatch.setattr(app_env, "JOB_WORKERS_ENABLED", True)
+    for name in ("_ensure_job_workers", "_ensure_scheduler", "_ensure_permalink_resolver", "_ensure_event_consumers"):
+        monkeypatch.setattr(app_env, name, lambda name=name: calls.append(name))
+    monkeypatch.setattr(app_env, "_WARM", dict(app_env._WARM, state="cold", steps={}, errors={}, lock=threading.Lock()))
+    return calls
+
+
+def test_warmup_starts_workers_and_scheduler(app_env, started, monkeypatch):
+    monkeypatch.setattr(app_env, "_PRELOAD_MASTER", False)
+    app_env.warmup()
+    assert started == ["_ensure_job_workers", "_ensure_scheduler", "_ensure_permalink_resolver", "_ensure_event_consumers"]
+    assert "background" in app_env._WARM["steps"]
+
+
+def test_preload_master_leaves_it_to_the_forked_workers(app_env, started, monkeypatch):
+    monkeypatch.setattr(app_env, "_PRELOAD_MASTER", True)
+    app_env.warmup()
+    assert started == []
+    # the fork hook resets per-process state; keep that to this test and run its thread inline
+    for name in ("_BREAKER_LOCK", "_APPS_LOCK", "_MEDIA_LOCKS"):
+        monkeypatch.setattr(app_env, name, getattr(app_env, name))
+    monkeypatch.setattr(app_env, "_MEDIA_LOCKS", list(app_env._MEDIA_LOCKS))
+    for d in ("_HTTP", "_ASYNC_CLIENT", "_WARM", "_EVENT_LOG", "_PROBES", "_JOB_STATE"):
+        for k, v in getattr(app_env, d).items():
+            monkeypatch.setitem(getattr(app_env, d), k, v)
+    inline = lambda target, **kw: types.SimpleNamespace(start=target)
+    monkeypatch.setattr(app_env, "threading", types.SimpleNamespace(Lock=threading.Lock, Thread=inline))
+    app_env._after_fork_in_child()
+    assert started == ["_ensure_job_workers", "_ensure_scheduler", "_ensure_permalink_resolver", "_ensure_event_consumers"]
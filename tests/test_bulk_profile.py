@@ -0,0 +1,26 @@
+def test_bulk_info_reports_each_page(client, app_env, graph, run_jobs):
+    graph.routes["/v20.0/1"] = (200, {"success": True})
+    graph.routes["/v20.0/2"] = (400, {"error": {"code": 100, "message": "Invalid parameter"}})
+    r = client.post("/api/pages/bulk/info", json={"page_ids": ["1", "2", "9", "1"], "description": "hi"})
+    assert r.status_code == 202
+    run_jobs()
+    res = app_env.get_job(r.get_json()["job_id"])["result"]
+    assert (res["total"], res["ok"], res["failed"]) == (3, 1, 2)
+    assert res["results"]["9"]["data"]["error"] == "NO_PAGE_TOKEN" and res["results"]["2"]["status"] == 400
+    posted = sorted((c[1].rsplit("/", 1)[-1], c[3], c[4]) for c in graph.calls if c[0] == "POST")
+    assert posted == [("1", {"description": "hi"}, "t1"), ("2", {"description": "hi"}, "t2")]
+
+
+def test_bulk_needs_pages_and_an_update(client, graph):
+    assert client.post("/api/pages/bulk/info", json={"page_ids": ["1"]}).get_json()["error"] == "EMPTY_UPDATE"
+    assert client.post("/api/pages/bulk/info", json={"page_ids": [" "], "description": "x"}).get_json()["error"] == "NO_PAGES"
+    r = client.post("/api/pages/bulk/info", json={"page_ids": ["9"], "description": "x"})
+    assert r.status_code == 403 and r.get_json()["results"]["9"]["data"]["error"] == "NO_PAGE_TOKEN"
+
+
+def test_bulk_pages_stay_in_the_job_lane(app_env, monkeypatch):
+    seen = []
+    monkeypatch.setitem(app_env._BULK_PROFILE_OPS, "info", lambda pg: (seen.append(app_env._current_lane()), ({}, 200))[1])
+    with app_env.graph_lane("publish"):
+        res, st = app_env._job_bulk_profile({"op": "info", "pages": [{"page_id": "1"}, {"page_id": "2"}], "info": {}})
+    assert st == 200 and res["ok"] == 2 and seen == ["publish", "publish"]
@@ -0,0 +1,58 @@
+import pytest
+
+
+@pytest.fixture
+def comments(graph):
+    """A post whose comments are created at t = 1..N, served newest first, 100 per page with index cursors."""
+    times = list(range(1, 251))
+
+    def route(method, url, kw):
+        params = kw.get("params") or {}
+        newest_first = sorted(times, reverse=True)
+        start = int(params.get("after") or 0)
+        page = newest_first[start:start + int(params["limit"])]
+        nxt = start + len(page)
+        paging = {"cursors": {"after": str(nxt)}, "next": "more"} if nxt < len(newest_first) else {}
+        return 200, {"data": [{"id": f"c{t}", "created_time": t, "message": str(t)} for t in page], "paging": paging}
+
+    graph.routes["/p1/comments"] = route
+    return times
+
+
+def _backfill(A):
+    out, st = A._job_comment_backfill({"page_id": "1", "page_token": "t1", "post_ids": ["p1"]})
+    assert st == 200
+    return out["posts"]["p1"]["data"]
+
+
+def _state(A):
+    row = A._db().execute("SELECT synced_until FROM comment_sync WHERE post_id='p1'").fetchone()
+    return (row["synced_until"] if row else None), A._db().execute("SELECT COUNT(*) FROM comments").fetchone()[0]
+
+
+def test_capped_backfill_resumes_below_the_last_page(app_env, comments, monkeypatch):
+    monkeypatch.setattr(app_env, "COMMENT_BACKFILL_MAX_PAGES", 1)
+    assert _backfill(app_env) == {"fetched": 100, "resume": True}
+    assert _state(app_env) == (None, 100)
+    assert _backfill(app_env) == {"fetched": 100, "resume": True}
+    assert _state(app_env) == (None, 200)
+    assert _backfill(app_env) == {"fetched": 50}
+    assert _state(app_env) == (250, 250)
+    assert app_env._db().execute("SELECT COUNT(*) FROM comment_sync_gap").fetchone()[0] == 0
+
+
+def test_after_gap_closes_only_new_comments_are_read(app_env, comments, monkeypatch):
+    monkeypatch.setattr(app_env, "COMMENT_BACKFILL_MAX_PAGES", 5)
+    assert _backfill(app_env) == {"fetched": 250}
+    comments.append(251)
+    assert _backfill(app_env) == {"fetched": 1}
+    assert _state(app_env) == (251, 251)
+
+
+def test_expired_cursor_restarts_from_the_top(app_env, comments, graph, monkeypatch):
+    monkeypatch.setattr(app_env, "COMMENT_BACKFILL_MAX_PAGES", 1)
+    _backfill(app_env)
+    graph.routes["/p1/comments"] = (400, {"error": {"code": 100, "message": "Invalid cursor"}})
+    out, _ = app_env._job_comment_backfill({"page_id": "1", "page_token": "t1", "post_ids": ["p1"]})
+    assert out["failed"] == 1
+    assert app_env._db().execute("SELECT COUNT(*) FROM comment_sync_gap").fetchone()[0] == 0
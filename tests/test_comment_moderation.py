@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def stored(app_env):
+    """Comments known from webhook events: c1, c2 on page 1 and c3 on page 2."""
+    app_env._ingest_comment_events([
+        {"page_id": pid, "data": {"id": pid, "changes": [{"field": "feed", "value": {
+            "item": "comment", "verb": "add", "comment_id": cid, "post_id": f"{pid}_p", "message": cid,
+            "from": {"id": "u", "name": "U"}, "created_time": 1700000000}}]}}
+        for pid, cid in (("1", "c1"), ("1", "c2"), ("2", "c3"))])
+
+
+@pytest.fixture
+def batch(graph):
+    """Graph batch endpoint: per-op verdicts by comment id (default 200)."""
+    verdicts = {}
+
+    def run(method, url, kw):
+        ops = json.loads(kw["data"]["batch"])
+        return 200, [{"code": verdicts.get(op["relative_url"], 200), "body": json.dumps({"success": True})} for op in ops]
+    graph.routes["/v20.0/"] = run
+    return verdicts
+
+
+def _status(A, cid):
+    return A._db().execute("SELECT status FROM comments WHERE comment_id=?", (cid,)).fetchone()["status"]
+
+
+def test_known_comments_are_grouped_by_page(client, app_env, stored, batch, graph, run_jobs):
+    r = client.post("/api/comments/bulk", json={"action": "hide", "comment_ids": ["c1", "c3", "c2", "zz"]})
+    body = r.get_json()
+    assert r.status_code == 202 and set(body["jobs"]) == {"1", "2"} and body["unknown"] == ["zz"]
+    run_jobs()
+    assert [c[4] for c in graph.calls if c[0] == "POST"] == ["t1", "t2"]
+    assert {_status(app_env, c) for c in ("c1", "c2", "c3")} == {"hidden"}
+    assert app_env.get_job(body["jobs"]["1"])["result"]["ok"] == 2
+
+
+def test_retry_only_resends_what_failed(client, app_env, stored, batch, graph, run_jobs):
+    batch["c2"] = 500
+    job_id = client.post("/api/comments/bulk", json={"action": "delete", "comment_ids": ["c1", "c2"]}).get_json()["jobs"]["1"]
+    run_jobs()
+    assert app_env.get_job(job_id)["status"] == "queued" and _status(app_env, "c1") == "deleted"
+    del batch["c2"]
+    app_env._db().execute("UPDATE jobs SET run_after=0 WHERE id=?", (job_id,))
+    run_jobs()
+    ops = [json.loads(c[3]["batch"]) for c in graph.calls if c[0] == "POST"]
+    assert [[op["relative_url"] for op in o] for o in ops] == [["c1", "c2"], ["c2"]]
+    assert app_env.get_job(job_id)["status"] == "done" and _status(app_env, "c2") == "deleted"
+
+
+def test_bad_requests_are_rejected(client, stored):
+    assert client.post("/api/comments/bulk", json={"action": "pin", "comment_ids": ["c1"]}).get_json()["error"] == "INVALID_ACTION"
+    assert client.post("/api/comments/bulk", json={"action": "reply", "comment_ids": ["c1"]}).get_json()["error"] == "MISSING_MESSAGE"
+    assert client.post("/api/comments/bulk", json={"action": "hide", "comment_ids": []}).get_json()["error"] == "NO_COMMENTS"
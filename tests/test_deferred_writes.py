@@ -0,0 +1,23 @@
+import json
+
+
+def test_deferred_write_keeps_its_lane(app_env, graph, run_jobs):
+    lanes = []
+    graph.routes["/messages"] = lambda method, url, kw: (lanes.append(app_env._current_lane()), (200, {"message_id": "m1"}))[1]
+    with app_env.app.test_request_context(), app_env.graph_lane("interactive"):
+        data, st = app_env._defer_write("me/messages", "t1", "page:1", {"message": "hi"}, None)
+    assert st == 202 and data["deferred"]
+    row = app_env._db().execute("SELECT payload FROM jobs WHERE id=?", (data["job_id"],)).fetchone()
+    assert json.loads(row["payload"])["lane"] == "interactive"
+    app_env._db().execute("UPDATE jobs SET run_after=0")
+    run_jobs()
+    assert lanes == ["interactive"]
+    assert app_env.get_job(data["job_id"])["status"] == "done"
+
+
+def test_deferred_write_without_lane_runs_as_publish(app_env, graph, run_jobs):
+    lanes = []
+    graph.routes["/feed"] = lambda method, url, kw: (lanes.append(app_env._current_lane()), (200, {"id": "1_1"}))[1]
+    job_id = app_env.enqueue_job("graph_write", {"path": "1/feed", "data": {"message": "hi"}, "token": "t1"})
+    run_jobs()
+    assert lanes == ["publish"] and app_env.get_job(job_id)["status"] == "done"
@@ -0,0 +1,67 @@
+import pytest
+
+
+@pytest.fixture
+def consumer(app_env, monkeypatch):
+    seen = []
+    monkeypatch.setitem(app_env.EVENT_CONSUMERS, "probe", lambda recs: seen.extend(r["data"]["n"] for r in recs))
+    return seen
+
+
+def test_records_read_back_in_order_with_a_cursor(app_env):
+    offsets = app_env.event_log_append([("1", {"n": 1}), ("2", {"n": 2}), (None, {"n": 3})])
+    assert offsets[0] == 0 and offsets == sorted(offsets) and app_env.event_log_head() > offsets[-1]
+    first, nxt = app_env.event_log_read(0, 2)
+    assert [r["data"]["n"] for r in first] == [1, 2] and nxt == offsets[2]
+    rest, end = app_env.event_log_read(nxt, 10)
+    assert [r["page_id"] for r in rest] == [None] and end == app_env.event_log_head()
+
+
+def test_page_and_time_filters_use_the_index(app_env):
+    app_env.event_log_append([("1", {"n": 1}), ("2", {"n": 2}), ("1", {"n": 3})])
+    recs, _ = app_env.event_log_read(0, 10, page_id="1")
+    assert [r["data"]["n"] for r in recs] == [1, 3]
+    assert app_env.event_log_read(0, 10, since=app_env.pytime.time() + 60)[0] == []
+
+
+def test_segments_roll_and_retention_drops_the_oldest(app_env, monkeypatch):
+    monkeypatch.setattr(app_env, "EVENT_SEGMENT_BYTES", 64)
+    for n in range(4):
+        app_env.event_log_append([("1", {"n": n, "pad": "x" * 40})])
+    assert len(app_env._segments()) == 4
+    assert [r["data"]["n"] for r in app_env.event_log_read(0, 10)[0]] == [0, 1, 2, 3]
+    monkeypatch.setattr(app_env, "EVENT_RETENTION_BYTES", 200)
+    app_env._event_log_retention()
+    segs = app_env._segments()
+    assert len(segs) < 4 and [r["data"]["n"] for r in app_env.event_log_read(0, 10)[0]] == list(range(4 - len(segs), 4))
+    assert [r["data"]["n"] for r in app_env.event_log_read(0, 10, page_id="1")[0]] == list(range(4 - len(segs), 4))
+
+
+def test_torn_tail_is_not_returned(app_env):
+    app_env.event_log_append([("1", {"n": 1})])
+    with open(app_env._segment_path(0), "ab") as f:
+        f.write(app_env._EVENT_HDR.pack(100, 0.0, 0) + b'{"page_id"')
+    recs, nxt = app_env.event_log_read(0, 10)
+    assert [r["data"]["n"] for r in recs] == [1] and nxt < app_env.event_log_head()
+
+
+def test_consumer_resumes_from_its_cursor_and_can_replay(client, app_env, consumer):
+    app_env.event_log_append([("1", {"n": 0})])  # before the consumer existed: not fed
+    assert app_env._drive_consumer("probe", app_env.EVENT_CONSUMERS["probe"]) is False
+    app_env.event_log_append([("1", {"n": 1}), ("1", {"n": 2})])
+    while app_env._drive_consumer("probe", app_env.EVENT_CONSUMERS["probe"]):
+        pass
+    assert consumer == [1, 2]
+    lag = client.get("/api/events/consumers").get_json()["data"]
+    assert [(c["name"], c["lag_bytes"]) for c in lag] == [("probe", 0)]
+    assert client.post("/api/events/consumers/probe/replay", json={}).get_json()["offset"] == 0
+    app_env._drive_consumer("probe", app_env.EVENT_CONSUMERS["probe"])
+    assert consumer == [1, 2, 0, 1, 2]
+
+
+def test_events_endpoint_pages_through_the_log(client, app_env):
+    app_env.event_log_append([(str(p), {"n": p}) for p in range(5)])
+    first = client.get("/api/events?limit=3").get_json()
+    rest = client.get(f"/api/events?from={first['next']}").get_json()
+    assert [r["data"]["n"] for r in first["data"] + rest["data"]] == list(range(5)) and rest["next"] == rest["head"]
+    assert client.get("/api/events?from=x").status_code == 400
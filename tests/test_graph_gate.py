@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+def _wait(A, scope, timeout=5.0):
+    t = threading.Thread(target=A._wait_throttle, args=(f"{scope}:key", scope, "read"), daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
+
+
+def test_dispatch_error_does_not_stop_the_gate(app_env, monkeypatch):
+    real, calls = app_env._gate_pick, []
+    def flaky(scope, now):
+        calls.append(scope)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return real(scope, now)
+    monkeypatch.setattr(app_env, "_gate_pick", flaky)
+    assert _wait(app_env, "gate-test-flaky")
+    assert app_env._GATE["thread"].is_alive()
+
+
+def test_dead_dispatcher_is_restarted(app_env):
+    gt = app_env._gate()
+    dead = threading.Thread(target=lambda: None)
+    dead.start(); dead.join()
+    gt["thread"] = dead
+    assert _wait(app_env, "gate-test-dead")
+    assert gt["thread"] is not dead and gt["thread"].is_alive()
+
+
+def test_stalled_gate_falls_back_to_spacing_the_call(app_env, monkeypatch):
+    monkeypatch.setattr(app_env, "_gate_pick", lambda scope, now: (None, float("inf")))  # never grants
+    monkeypatch.setattr(app_env, "GATE_CHECK_SEC", 0.05)
+    monkeypatch.setattr(app_env, "GATE_STALL_SEC", 0.1)
+    t0 = time.time()
+    assert _wait(app_env, "gate-test-stall")
+    assert time.time() - t0 < 2.0
+    assert not app_env._gate()["waiters"]["gate-test-stall"]["read"]
+    assert app_env.SETTINGS["last_call_ts"]["gate-test-stall"] >= t0
+
+
+def test_lanes_share_a_scope_by_weight(app_env, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS["throttle"], "global_min_interval", 1.0)
+    order, gt = [], app_env._gate()
+    with gt["cond"]:  # the dispatcher cannot run meanwhile; grant one call per interval by hand
+        for lane in ["publish"] * 4 + ["interactive"] * 4:
+            app_env._gate_enqueue({"key": "gate-test-lanes", "scope": "gate-test-lanes", "lane": lane, "ts": 0.0,
+                                   "grant": lambda lane=lane: order.append(lane[0])})
+        app_env.SETTINGS["last_call_ts"]["gate-test-lanes"] = 0.0
+        for i in range(8):
+            app_env._gate_pass(1.0 + i)
+    assert "".join(order) == "ipiiippp"
@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.fixture
+def flaky(app_env, graph, monkeypatch):
+    """/1/feed answers with the queued (status, body) pairs, then 200."""
+    monkeypatch.setattr(app_env, "RETRY_BASE_DELAY", 0.0)
+    queue = []
+    graph.routes["/1/feed"] = lambda m, u, kw: queue.pop(0) if queue else (200, {"data": [], "id": "1_1"})
+    return queue
+
+
+def _feed_calls(graph):
+    return len([c for c in graph.calls if c[1].endswith("/1/feed")])
+
+
+def test_reads_are_retried_through_transient_errors(app_env, graph, flaky):
+    flaky += [(503, {"error": {"message": "busy"}}), (500, {"error": {"code": 2, "message": "try again"}})]
+    assert app_env.graph_get("1/feed", {}, "t1")[1] == 200 and _feed_calls(graph) == 3
+
+
+def test_permanent_errors_are_not_retried(app_env, graph, flaky):
+    flaky.append((400, {"error": {"code": 100, "message": "Invalid parameter"}}))
+    assert app_env.graph_get("1/feed", {}, "t1")[1] == 400 and _feed_calls(graph) == 1
+
+
+def test_breaker_opens_after_repeated_failures_and_closes_on_success(app_env, graph, flaky, monkeypatch):
+    monkeypatch.setattr(app_env, "RETRY_MAX_ATTEMPTS", 1)
+    flaky += [(503, {"error": {"message": "busy"}})] * app_env.CB_FAILURE_THRESHOLD
+    for _ in range(app_env.CB_FAILURE_THRESHOLD):
+        app_env.graph_get("1/feed", {}, "t1")
+    data, st = app_env.graph_get("1/feed", {}, "t1")
+    assert st == 503 and data["error"] == "CIRCUIT_OPEN" and _feed_calls(graph) == app_env.CB_FAILURE_THRESHOLD
+    app_env._BREAKERS[data["endpoint"]]["open_until"] = 0.0
+    assert app_env.graph_get("1/feed", {}, "t1")[1] == 200
+    assert app_env._BREAKERS[data["endpoint"]]["failures"] == 0
+
+
+def test_idempotency_key_replays_the_stored_success(app_env, graph, flaky):
+    first = app_env.graph_post("1/feed", {"message": "x"}, "t1", idempotency_key="k1")
+    again = app_env.graph_post("1/feed", {"message": "x"}, "t1", idempotency_key="k1")
+    assert first == again == ({"data": [], "id": "1_1"}, 200) and _feed_calls(graph) == 1
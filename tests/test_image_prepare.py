@@ -0,0 +1,53 @@
+import os
+import threading
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _staged(tmp_path, name="big.png", side=3000):
+    path = str(tmp_path / name)
+    Image.new("RGB", (side, side // 2), "red").save(path, "PNG")
+    return {"path": path, "filename": name, "mimetype": "image/png"}
+
+
+def _run_together(fn, n=8):
+    out, barrier = [], threading.Barrier(n)
+    def one():
+        barrier.wait()
+        out.append(fn())
+    threads = [threading.Thread(target=one) for _ in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return out
+
+
+def test_concurrent_prepare_of_one_image(app_env, tmp_path):
+    staged = _staged(tmp_path)
+    results = _run_together(lambda: app_env.prepare_image(staged, "photo"))
+    assert len({r["path"] for r in results}) == 1 and results[0]["path"] != staged["path"]
+    with Image.open(results[0]["path"]) as im:
+        assert max(im.size) == app_env.IMAGE_PROFILES["photo"]["max_side"]
+    cache = os.path.dirname(results[0]["path"])
+    assert not [n for n in os.listdir(cache) if n.endswith(".tmp")]
+
+
+def test_unreadable_image_leaves_no_temp_file(app_env, tmp_path):
+    path = tmp_path / "broken.png"
+    path.write_bytes(b"\x89PNG not really")
+    staged = {"path": str(path), "filename": "broken.png", "mimetype": "image/png"}
+    assert app_env.prepare_image(staged, "photo") is staged
+    cache = os.path.join(app_env.DATA_DIR, "imgcache")
+    assert not os.listdir(cache)
+
+
+def test_concurrent_thumbnails_of_one_object(app_env, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_env, "MEDIA_DIR", str(tmp_path / "media"))
+    os.makedirs(app_env.MEDIA_DIR)
+    Image.new("RGB", (1200, 800), "blue").save(app_env._media_path("k1"), "JPEG")
+    results = _run_together(lambda: app_env._media_thumb("k1", 320))
+    assert set(results) == {app_env._media_path("k1") + ".t320"}
+    with Image.open(results[0]) as im:
+        assert max(im.size) == 320
+    assert not [n for n in os.listdir(app_env.MEDIA_DIR) if n.endswith(".tmp")]
@@ -0,0 +1,45 @@
+import pytest
+
+
+@pytest.fixture
+def threads(graph):
+    """Conversations per page; updated_time strings sort like Graph's ISO timestamps."""
+    data = {"1": [("a", "2024-01-05", 1), ("b", "2024-01-02", 0)],
+            "2": [("c", "2024-01-04", 2), ("d", "2024-01-01", 0)],
+            "3": [("e", "2024-01-03", 0)]}
+    for pid, rows in data.items():
+        graph.routes[f"/{pid}/conversations"] = lambda m, u, kw, rows=rows: (
+            200, {"data": [{"id": t, "updated_time": ut, "unread_count": n} for t, ut, n in rows]})
+    return graph
+
+
+def _inbox(client, query=""):
+    r = client.get("/api/inbox?page_ids=1,2,3" + query)
+    assert r.status_code == 200
+    return r.get_json()
+
+
+def test_pages_are_merged_newest_first_and_paged(client, threads):
+    first = _inbox(client, "&limit=3")
+    assert [(t["id"], t["page_id"]) for t in first["data"]] == [("a", "1"), ("c", "2"), ("e", "3")]
+    assert first["unread"]["total"] == 3 and first["unread"]["threads_with_unread"] == 2
+    rest = _inbox(client, "&limit=3&cursor=" + first["paging"]["next_cursor"])
+    assert [t["id"] for t in rest["data"]] == ["b", "d"] and rest["paging"]["next_cursor"] is None
+
+
+def test_fresh_pages_are_served_from_the_store(client, app_env, threads):
+    _inbox(client)
+    calls = len(threads.calls)
+    _inbox(client)
+    assert len(threads.calls) == calls
+    app_env.event_log_append([("2", {"id": "2", "messaging": []})])
+    _inbox(client)
+    assert [c[1].split("/")[-2] for c in threads.calls[calls:]] == ["2"]
+
+
+def test_failed_page_keeps_its_last_list(client, app_env, threads, monkeypatch):
+    monkeypatch.setattr(app_env, "RETRY_MAX_ATTEMPTS", 1)
+    _inbox(client)
+    threads.routes["/2/conversations"] = (500, {"error": {"message": "down"}})
+    out = _inbox(client, "&refresh=1")
+    assert "2" in out["pages"]["errors"] and {t["id"] for t in out["data"]} == {"a", "b", "c", "d", "e"}
@@ -0,0 +1,62 @@
+import pytest
+
+
+def _metrics(*pairs):
+    return {"data": [{"name": n, "values": [{"value": v}]} for n, v in pairs]}
+
+
+@pytest.fixture
+def posts(app_env, graph):
+    """Two tracked posts on page 1 (campaign c1), one reel on page 2; Graph serves their metrics by ?ids=."""
+    now = app_env.pytime.time()
+    app_env._insights_track("1", "1_a", "feed", "c1", now - 3600)
+    app_env._insights_track("1", "1_b", "photo", "c1", now - 7200)
+    app_env._insights_track("2", "2_v", "reel", "c2", now - 3600)
+    objs = {"1_a": {"insights": _metrics(("post_impressions", 100), ("post_impressions_unique", 80)),
+                    "reactions": {"summary": {"total_count": 5}}, "shares": {"count": 2}},
+            "1_b": {"insights": _metrics(("post_impressions", 50), ("post_clicks", 3)),
+                    "comments": {"summary": {"total_count": 4}}},
+            "2_v": {"video_insights": _metrics(("total_video_impressions", 30), ("total_video_views", 20))}}
+
+    def ids_read(method, url, kw):
+        return 200, {i: objs[i] for i in kw["params"]["ids"].split(",")}
+    graph.routes["/v20.0/"] = ids_read
+    graph.routes["/insights"] = (200, {"data": [{"name": "page_impressions", "values": [
+        {"value": 7, "end_time": "2024-01-01T08:00:00+0000"}, {"value": 9, "end_time": "2024-01-02T08:00:00+0000"}]}]})
+    return objs
+
+
+def test_collect_then_aggregate_by_campaign_and_page(client, app_env, posts):
+    out, st = app_env._job_insights_collect({})
+    assert st == 200 and out["posts_collected"] == 3 and out["page_values"] == 4
+    by_campaign = {d["campaign"]: d for d in client.get("/api/insights/summary").get_json()["data"]}
+    assert (by_campaign["c1"]["posts"], by_campaign["c1"]["impressions"], by_campaign["c1"]["reach"]) == (2, 150, 80)
+    assert (by_campaign["c1"]["reactions"], by_campaign["c1"]["comments"], by_campaign["c1"]["shares"]) == (5, 4, 2)
+    assert by_campaign["c2"]["video_views"] == 20
+    pages = client.get("/api/insights/summary?group=page&page_id=2").get_json()["data"]
+    assert [(d["page"], d["impressions"]) for d in pages] == [("2", 30)]
+    weekly = client.get("/api/insights/pages?page_id=1&bucket=week").get_json()["data"]
+    assert sum(d["value"] for d in weekly) == 16
+
+
+def test_collected_posts_wait_for_the_next_interval(app_env, posts, graph):
+    app_env._job_insights_collect({})
+    reads = len([c for c in graph.calls if c[1].endswith("/v20.0/")])
+    assert app_env._job_insights_collect({})[0]["posts_due"] == 0
+    assert len([c for c in graph.calls if c[1].endswith("/v20.0/")]) == reads
+
+
+def test_refused_metrics_fall_back_to_public_counters(app_env, posts, graph):
+    def ids_read(method, url, kw):
+        if "insights" in kw["params"]["fields"]:
+            return 400, {"error": {"code": 10, "message": "Requires read_insights permission"}}
+        return 200, {i: {k: v for k, v in posts[i].items() if "insights" not in k} for i in kw["params"]["ids"].split(",")}
+    graph.routes["/v20.0/"] = ids_read
+    app_env._job_insights_collect({})
+    row = app_env._db().execute("SELECT impressions, reactions, error FROM insight_posts WHERE post_id='1_a'").fetchone()
+    assert (row["impressions"], row["reactions"]) == (0, 5) and "read_insights" in row["error"]
+
+
+def test_summary_rejects_unknown_groups(client, app_env):
+    r = client.get("/api/insights/summary?group=month")
+    assert r.status_code == 400 and r.get_json()["error"] == "BAD_GROUP"
@@ -0,0 +1,67 @@
+import io
+import json
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def photo_job(client, app_env, graph, run_jobs):
+    """A photo publish that Graph rejects once; returns its job id and staged file path."""
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), "red").save(buf, "PNG")
+    graph.routes["/1/photos"] = (400, {"error": {"code": 100, "message": "Invalid parameter"}})
+    job_id = client.post("/api/pages/1/photo", content_type="multipart/form-data",
+                         data={"caption": "c", "photo": (io.BytesIO(buf.getvalue()), "p.png")}).get_json()["job_id"]
+    run_jobs()
+    payload = json.loads(app_env._db().execute("SELECT payload FROM jobs WHERE id=?", (job_id,)).fetchone()[0])
+    return job_id, payload["file"]["path"]
+
+
+def test_failed_upload_keeps_its_file_and_can_be_retried(client, app_env, graph, run_jobs, photo_job):
+    job_id, path = photo_job
+    assert app_env.get_job(job_id)["status"] == "failed" and os.path.exists(path)
+    graph.routes["/1/photos"] = (200, {"id": "1_5", "post_id": "1_5"})
+    assert client.post(f"/api/jobs/{job_id}/retry").status_code == 200
+    run_jobs()
+    assert app_env.get_job(job_id)["status"] == "done" and not os.path.exists(path)
+
+
+def test_retry_without_the_file_is_refused(client, photo_job):
+    job_id, path = photo_job
+    os.remove(path)
+    r = client.post(f"/api/jobs/{job_id}/retry")
+    assert r.status_code == 409 and r.get_json()["error"] == "STAGED_FILE_GONE"
+
+
+def test_uploads_gc_removes_old_files_of_failed_jobs_only(app_env, photo_job, monkeypatch):
+    _, path = photo_job
+    assert app_env._job_uploads_gc({})[0]["removed"] == 0
+    monkeypatch.setattr(app_env, "JOB_FILE_KEEP_SEC", -1)
+    assert app_env._job_uploads_gc({})[0]["removed"] == 1 and not os.path.exists(path)
+
+
+def _running(A, locked_at):
+    job_id = A.enqueue_job("publish_feed", {"page_id": "1", "message": "x"})
+    A._db().execute("UPDATE jobs SET status='running', locked_at=? WHERE id=?", (locked_at, job_id))
+    return job_id
+
+
+def test_stale_running_job_is_reclaimed(app_env):
+    job_id = _running(app_env, app_env.pytime.time() - app_env.JOB_STALE_SEC - 1)
+    assert app_env._claim_job(["publish_feed"])["id"] == job_id
+
+
+def test_heartbeat_keeps_a_long_job_from_being_reclaimed(app_env, monkeypatch):
+    job_id = _running(app_env, app_env.pytime.time() - app_env.JOB_STALE_SEC - 1)
+    monkeypatch.setattr(app_env, "JOB_HEARTBEAT_SEC", 0.01)
+    monkeypatch.setitem(app_env._JOB_STATE, "running", {job_id})
+    threading.Thread(target=app_env._job_heartbeat_loop, daemon=True).start()
+    locked_at = lambda: app_env._db().execute("SELECT locked_at FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+    for _ in range(500):
+        if locked_at() > app_env.pytime.time() - 5:
+            break
+        app_env.pytime.sleep(0.01)
+    assert app_env._claim_job(["publish_feed"]) is None
@@ -0,0 +1,60 @@
+import json
+
+
+def _stored_payloads(A):
+    return [r[0] for r in A._db().execute("SELECT payload FROM jobs UNION ALL SELECT payload FROM scheduled_posts")]
+
+
+def _feed_tokens(graph):
+    return [c[4] for c in graph.calls if c[1].endswith("/feed")]
+
+
+def test_tokens_are_not_stored_but_used(client, app_env, graph, run_jobs):
+    graph.routes["/feed"] = (200, {"id": "1_1"})
+    client.post("/api/pages/1/post", json={"message": "hello"})
+    assert not [p for p in _stored_payloads(app_env) if "t1" in p]
+    run_jobs()
+    assert _feed_tokens(graph) == ["t1"]
+
+
+def test_token_is_looked_up_again_in_another_process(client, app_env, graph, run_jobs):
+    graph.routes["/feed"] = (200, {"id": "1_1"})
+    job_id = client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["job_id"]
+    app_env._JOB_TOKENS.clear()  # what a different worker (or a restart) sees
+    run_jobs()
+    assert app_env.get_job(job_id)["status"] == "done" and _feed_tokens(graph) == ["t1"]
+
+
+def test_job_fails_when_no_token_is_left(app_env, graph, run_jobs):
+    job_id = app_env.enqueue_job("publish_feed", {"page_id": "404", "page_token": "gone", "message": "x"})
+    app_env._JOB_TOKENS.clear()
+    run_jobs()
+    job = app_env.get_job(job_id)
+    assert job["status"] == "failed" and job["error"] == "NO_PAGE_TOKEN" and not _feed_tokens(graph)
+
+
+def test_scheduled_and_bulk_payloads_hold_no_tokens(client, app_env, graph):
+    client.post("/api/schedule", json={"type": "feed", "page_ids": ["1", "2"], "at": 4102444800, "message": "later"})
+    client.post("/api/pages/bulk/info", json={"page_ids": ["1", "2"], "description": "hi"})
+    payloads = _stored_payloads(app_env)
+    assert len(payloads) == 3
+    assert not [p for p in payloads if any(t in p for t in ('"t1"', '"t2"', '"page_token": '))]
+    bulk = json.loads(next(p for p in payloads if '"pages"' in p))
+    assert bulk["_tokens"] == ["pages"] and [pg["page_id"] for pg in bulk["pages"]] == ["1", "2"]
+
+
+def test_progress_written_back_by_a_job_holds_no_token(client, app_env, graph, run_jobs, monkeypatch):
+    monkeypatch.setattr(app_env, "RETRY_MAX_ATTEMPTS", 1)
+    graph.routes["/v20.0/"] = (500, {"error": {"message": "down"}})
+    r = client.post("/api/comments/bulk", json={"action": "hide", "comment_ids": ["c1"], "page_id": "1"})
+    run_jobs()
+    payload = app_env._db().execute("SELECT payload FROM jobs WHERE id=?", (r.get_json()["jobs"]["1"],)).fetchone()[0]
+    assert '"results"' in payload and "t1" not in payload
+
+
+def test_requeueing_an_existing_job_id_keeps_its_tokens(app_env, graph, run_jobs):
+    graph.routes["/feed"] = (200, {"id": "1_1"})
+    app_env.enqueue_job("publish_feed", {"page_id": "1", "page_token": "t1", "message": "x"}, job_id="fixed")
+    app_env.enqueue_job("publish_feed", {"page_id": "1", "page_token": "other", "message": "x"}, job_id="fixed")
+    run_jobs()
+    assert app_env.get_job("fixed")["status"] == "done" and _feed_tokens(graph) == ["t1"]
@@ -0,0 +1,21 @@
+import pytest
+
+
+@pytest.fixture
+def events(app_env):
+    app_env.event_log_append([("1", {"type": "message", "text": "x" * 200}) for _ in range(20)])
+
+
+@pytest.mark.parametrize("path", ["/webhook/events", "/api/events"])
+def test_compressed_body_revalidates_with_its_own_etag(client, events, path):
+    first = client.get(path, headers={"Accept-Encoding": "gzip"})
+    assert first.headers["Content-Encoding"] == "gzip" and first.headers["ETag"].endswith('-gzip"')
+    again = client.get(path, headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.headers["ETag"] == first.headers["ETag"]
+
+
+def test_identity_body_keeps_the_plain_etag(client, events):
+    first = client.get("/webhook/events")
+    assert "Content-Encoding" not in first.headers and not first.headers["ETag"].endswith('-gzip"')
+    again = client.get("/webhook/events", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.headers["ETag"] == first.headers["ETag"]
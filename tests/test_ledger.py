@@ -0,0 +1,87 @@
+import io
+
+import pytest
+
+
+@pytest.fixture
+def feed_ok(graph):
+    graph.routes["/feed"] = (200, {"id": "1_100"})
+    return graph
+
+
+def _photo(client, page_id, data, caption="same caption"):
+    return client.post(f"/api/pages/{page_id}/photo", content_type="multipart/form-data",
+                       data={"caption": caption, "photo": (io.BytesIO(data), "p.png")})
+
+
+@pytest.fixture
+def png():
+    from PIL import Image
+    def make(color):
+        buf = io.BytesIO()
+        Image.new("RGB", (8, 8), color).save(buf, "PNG")
+        return buf.getvalue()
+    return make
+
+
+def test_same_text_twice_is_a_duplicate(client, feed_ok):
+    assert client.post("/api/pages/1/post", json={"message": "hello"}).status_code == 202
+    r = client.post("/api/pages/1/post", json={"message": "hello"})
+    assert r.status_code == 429 and r.get_json()["error"] == "DUPLICATE_MESSAGE"
+    assert client.post("/api/pages/2/post", json={"message": "hello"}).status_code == 202
+
+
+def test_cancelled_job_releases_its_claim(client, app_env, feed_ok):
+    job_id = client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["job_id"]
+    assert client.post(f"/api/jobs/{job_id}/cancel").status_code == 200
+    row = app_env._db().execute("SELECT status FROM publish_ledger WHERE job_id=?", (job_id,)).fetchone()
+    assert row["status"] == "cancelled"
+    assert client.post("/api/pages/1/post", json={"message": "hello"}).status_code == 202
+
+
+def test_failed_enqueue_cancels_the_claim(client, app_env, feed_ok, monkeypatch):
+    def boom(*a, **kw):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(app_env, "enqueue_job", boom)
+    with pytest.raises(RuntimeError):
+        app_env._enqueue_publish("publish_feed", "feed", {"page_id": "1", "page_token": "t1", "message": "hello"}, "DUPLICATE_MESSAGE")
+    assert [r["status"] for r in app_env._db().execute("SELECT status FROM publish_ledger")] == ["cancelled"]
+
+
+def test_photo_duplicate_check_includes_the_file(client, app_env, graph, png):
+    graph.routes["/photos"] = (200, {"id": "p1"})
+    assert _photo(client, "1", png("red")).status_code == 202
+    assert _photo(client, "1", png("blue")).status_code == 202  # same caption, different image
+    r = _photo(client, "1", png("red"))
+    assert r.status_code == 429 and r.get_json()["error"] == "DUPLICATE_CAPTION"
+    hashes = {r["content_hash"] for r in app_env._db().execute("SELECT content_hash FROM publish_ledger")}
+    assert len(hashes) == 2 and app_env._hash_content("same caption") not in hashes
+
+
+def test_published_row_keeps_the_claimed_hash(client, app_env, graph, png, run_jobs):
+    graph.routes["/photos"] = (200, {"id": "p1"})
+    job_id = _photo(client, "1", png("red")).get_json()["job_id"]
+    claimed = app_env._db().execute("SELECT content_hash FROM publish_ledger WHERE job_id=?", (job_id,)).fetchone()[0]
+    run_jobs()
+    row = app_env._db().execute("SELECT status, content_hash, post_id FROM publish_ledger WHERE job_id=?", (job_id,)).fetchone()
+    assert (row["status"], row["content_hash"], row["post_id"]) == ("published", claimed, "p1")
+
+
+def test_campaign_resume_lists_cancelled_pages(client, app_env, feed_ok):
+    ids = [client.post(f"/api/pages/{p}/post", json={"message": "hi", "campaign_id": "c1"}).get_json()["job_id"] for p in ("1", "2")]
+    client.post(f"/api/jobs/{ids[1]}/cancel")
+    out = client.get("/api/ledger/campaigns/c1?page_ids=1,2").get_json()
+    assert out["remaining"] == ["2"]
+
+
+def test_ledger_paging_keeps_rows_that_share_a_timestamp(client, app_env):
+    db = app_env._db()
+    for jid in ("j1", "j2", "j3", "j4"):
+        db.execute("INSERT INTO publish_ledger(job_id, page_id, kind, content_hash, status, created, updated) "
+                   "VALUES (?, '1', 'feed', 'h', 'published', ?, ?)", (jid, 100.0 if jid != "j4" else 50.0, 100.0))
+    seen, q = [], "/api/ledger?limit=2"
+    while q:
+        out = client.get(q).get_json()
+        seen += [r["job_id"] for r in out["data"]]
+        q = f"/api/ledger?limit=2&before={out['before']}&before_id={out['before_id']}" if out["before"] is not None else None
+    assert seen == ["j3", "j2", "j1", "j4"]
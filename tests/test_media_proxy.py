@@ -0,0 +1,44 @@
+import pytest
+
+from conftest import FakeResponse
+
+
+@pytest.fixture
+def media(app_env, graph, tmp_path, monkeypatch):
+    """One proxied attachment (key k1) whose CDN bytes the test controls; revalidated on every request."""
+    monkeypatch.setattr(app_env, "MEDIA_DIR", str(tmp_path / "media"))
+    monkeypatch.setattr(app_env, "MEDIA_REVALIDATE_SEC", -1)
+    app_env._db().execute("INSERT INTO media_refs(key, url, page_id, message_id, slot, updated) VALUES "
+                          "('k1', 'https://scontent.fbcdn.net/x.bin', '1', 'm1', 'a1', 0)")
+    cdn = {"body": b"first bytes", "etag": '"v1"'}
+
+    def route(method, url, kw):
+        if kw.get("headers", {}).get("If-None-Match") == cdn["etag"]:
+            return FakeResponse(304, b"")
+        return FakeResponse(200, cdn["body"], {"Content-Type": "application/octet-stream", "ETag": cdn["etag"]})
+
+    graph.routes["/x.bin"] = route
+    return cdn
+
+
+def test_revalidation_keeps_the_etag(client, media):
+    first = client.get("/api/media/k1")
+    assert first.status_code == 200 and first.data == b"first bytes"
+    again = client.get("/api/media/k1")
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert client.get("/api/media/k1", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+
+def test_new_bytes_of_the_same_size_change_the_etag(client, media):
+    first = client.get("/api/media/k1")
+    media.update(body=b"other bytes", etag='"v2"')
+    second = client.get("/api/media/k1", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200 and second.data == b"other bytes"
+    assert second.headers["ETag"] != first.headers["ETag"]
+
+
+def test_locks_do_not_grow_with_keys(app_env):
+    n = len(app_env._MEDIA_LOCKS)
+    locks = {id(app_env._media_lock(f"key{i}")) for i in range(1000)}
+    assert len(app_env._MEDIA_LOCKS) == n and len(locks) <= n
+    assert app_env._media_lock("key1") is app_env._media_lock("key1")
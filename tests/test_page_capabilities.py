@@ -0,0 +1,34 @@
+def _post_router(errors):
+    """Reject the first field of each POST that appears in `errors` (field -> Graph error body)."""
+    sent = []
+    def route(method, url, kw):
+        data = kw.get("data") or {}
+        sent.append(dict(data))
+        for field, err in errors.items():
+            if field in data:
+                return 400, {"error": err}
+        return 200, {"success": True}
+    return route, sent
+
+
+def test_value_error_is_not_learned_as_unsupported(app_env, graph):
+    route, sent = _post_router({"website": {"code": 100, "message": "(#100) Param website must be a valid URL"}})
+    graph.routes["/v20.0/1"] = route
+    res, st = app_env.update_page_info("1", "t1", {"website": "not a url"})
+    assert st == 400 and len(sent) == 1
+    assert "website" not in app_env._cap_known("1", "info_field")
+
+
+def test_unsupported_field_falls_back_to_its_variant(app_env, graph):
+    route, sent = _post_router({"description": {"code": 100, "message": "(#100) Tried accessing nonexisting field (description)"}})
+    graph.routes["/v20.0/1"] = route
+    res, st = app_env.update_page_info("1", "t1", {"description": "hello"})
+    assert st == 200 and sent[-1] == {"about": "hello"}
+    assert app_env._cap_known("1", "info_field") == {"description": False, "about": True}
+
+
+def test_permission_error_is_learned(app_env, graph):
+    route, _ = _post_router({"website": {"code": 200, "message": "(#200) Requires pages_manage_metadata to update website"}})
+    graph.routes["/v20.0/1"] = route
+    app_env.update_page_info("1", "t1", {"website": "https://x.example"})
+    assert app_env._cap_known("1", "info_field").get("website") is False
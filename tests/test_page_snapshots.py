@@ -0,0 +1,60 @@
+import pytest
+
+
+@pytest.fixture
+def pages(graph):
+    """Page info served by ?ids= reads; a page whose state is an error fails the batch and its own read."""
+    state = {"1": {"name": "One"}, "2": {"name": "Two"}}
+
+    def batch(method, url, kw):
+        ids = kw["params"]["ids"].split(",")
+        if any("error" in state[p] for p in ids):
+            return 400, {"error": {"code": 100, "message": "cannot read"}}
+        return 200, {p: dict(state[p], id=p) for p in ids}
+
+    def single(pid):
+        return lambda method, url, kw: (400, state[pid]) if "error" in state[pid] else (200, dict(state[pid], id=pid))
+
+    graph.routes["/v20.0/"] = batch
+    for pid in state:
+        graph.routes[f"/v20.0/{pid}"] = single(pid)
+    return state
+
+
+def _snap(A, ids):
+    out, st = A._job_page_snapshot({"page_ids": ids, "user_token": "u"})
+    assert st == 200
+    return out
+
+
+def test_partial_snapshot_is_not_a_mass_removal(app_env, pages):
+    _snap(app_env, ["1", "2"])
+    pages["1"]["name"] = "Uno"
+    out = _snap(app_env, ["1"])
+    assert out["diff"]["removed"] == [] and out["diff"]["changed"] == {"1": {"name": {"from": "One", "to": "Uno"}}}
+
+
+def test_full_snapshot_diffs_against_last_covering_one(app_env, pages):
+    first = _snap(app_env, ["1", "2"])["snapshot_id"]
+    _snap(app_env, ["1"])
+    out = _snap(app_env, ["1", "2"])
+    assert out["diff"]["from"] == first and out["diff"]["removed"] == []
+
+
+def test_error_transitions_are_reported(app_env, pages):
+    _snap(app_env, ["1", "2"])
+    pages["2"] = {"error": {"code": 10, "message": "no access"}}
+    out = _snap(app_env, ["1", "2"])
+    assert list(out["diff"]["now_failing"]) == ["2"] and "no access" in out["diff"]["now_failing"]["2"]
+    assert out["diff"]["recovered"] == []
+    pages["2"] = {"name": "Two"}
+    out = _snap(app_env, ["1", "2"])
+    assert out["diff"]["recovered"] == ["2"] and out["diff"]["now_failing"] == {}
+
+
+def test_diff_endpoint_can_be_limited_to_pages(client, app_env, pages):
+    a = _snap(app_env, ["1", "2"])["snapshot_id"]
+    pages["1"]["name"] = "Uno"; pages["2"]["name"] = "Dos"
+    b = _snap(app_env, ["1", "2"])["snapshot_id"]
+    out = client.get(f"/api/pages/snapshots/diff?from={a}&to={b}&page_ids=2").get_json()
+    assert list(out["changed"]) == ["2"]
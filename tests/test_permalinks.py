@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture
+def pending(app_env, monkeypatch):
+    monkeypatch.setattr(app_env, "_ensure_permalink_resolver", lambda: None)
+    monkeypatch.setitem(app_env._PERMALINKS, "pending", {})
+    for pid in ("1", "2", "3"):
+        app_env.queue_permalink({}, f"{pid}_9", pid, f"t{pid}")
+    return app_env._PERMALINKS["pending"]
+
+
+def _resolve(A):
+    for user, batch in A._permalink_batches(A.pytime.time()):
+        A._resolve_permalink_batch(batch, user)
+
+
+def _urls(A):
+    return {r[0]: (r[1], r[2]) for r in A._db().execute("SELECT object_id, status, permalink_url FROM permalinks")}
+
+
+def test_one_read_covers_every_page(app_env, graph, pending):
+    graph.routes["/v20.0/"] = lambda m, url, kw: (200, {i: {"permalink_url": f"https://fb/{i}"} for i in kw["params"]["ids"].split(",")})
+    _resolve(app_env)
+    assert [(c[2]["ids"], c[4]) for c in graph.calls] == [("1_9,2_9,3_9", "u")]
+    assert _urls(app_env)["2_9"] == ("resolved", "https://fb/2_9") and not pending
+
+
+def test_ids_missing_for_the_user_are_read_with_the_page_token(app_env, graph, pending):
+    graph.routes["/v20.0/"] = (200, {"1_9": {"permalink_url": "https://fb/1_9"}, "2_9": {"id": "2_9"}})
+    graph.routes["/v20.0/2_9"] = (200, {"permalink_url": "https://fb/2_9"})
+    graph.routes["/v20.0/3_9"] = (200, {"id": "3_9"})  # video still processing
+    _resolve(app_env)
+    assert [c[4] for c in graph.calls] == ["u", "t2", "t3"]
+    urls = _urls(app_env)
+    assert urls["1_9"][0] == urls["2_9"][0] == "resolved" and urls["3_9"] == ("pending", None)
+    assert list(pending) == ["3_9"] and pending["3_9"]["attempts"] == 1
+
+
+def test_without_a_user_token_batches_are_per_page(app_env, graph, pending):
+    with open(app_env.TOKENS_FILE, "w") as f:
+        f.write("{}")
+    batches = app_env._permalink_batches(app_env.pytime.time())
+    assert sorted((user, list(b)) for user, b in batches) == [(None, ["1_9"]), (None, ["2_9"]), (None, ["3_9"])]
@@ -0,0 +1,40 @@
+import requests
+
+
+def _ledger(A, job_id):
+    return A._db().execute("SELECT status FROM publish_ledger WHERE job_id=?", (job_id,)).fetchone()["status"]
+
+
+def _feed_calls(graph):
+    return [c for c in graph.calls if c[1].endswith("/feed")]
+
+
+def test_sent_write_that_errors_is_not_posted_again(client, app_env, graph, run_jobs):
+    graph.routes["/feed"] = (503, {"error": {"code": 2, "message": "Service temporarily unavailable"}})
+    job_id = client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["job_id"]
+    run_jobs()
+    run_jobs()
+    job = app_env.get_job(job_id)
+    assert job["status"] == "failed" and job["error"] == "UNKNOWN_OUTCOME"
+    assert len(_feed_calls(graph)) == 1
+    # it may be live, so the same text is still a duplicate on that page
+    assert _ledger(app_env, job_id) == "unknown"
+    assert client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["error"] == "DUPLICATE_MESSAGE"
+
+
+def test_write_that_never_left_is_requeued(client, app_env, graph, run_jobs, monkeypatch):
+    def refuse(method, url, kw):
+        raise requests.ConnectTimeout("connect timed out")
+    graph.routes["/feed"] = refuse
+    monkeypatch.setattr(app_env, "RETRY_MAX_ATTEMPTS", 1)
+    job_id = client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["job_id"]
+    run_jobs()
+    assert app_env.get_job(job_id)["status"] == "queued" and _ledger(app_env, job_id) == "queued"
+
+
+def test_rejected_write_fails_and_frees_the_text(client, app_env, graph, run_jobs):
+    graph.routes["/feed"] = (400, {"error": {"code": 100, "message": "Invalid parameter"}})
+    job_id = client.post("/api/pages/1/post", json={"message": "hello"}).get_json()["job_id"]
+    run_jobs()
+    assert app_env.get_job(job_id)["status"] == "failed" and _ledger(app_env, job_id) == "failed"
+    assert client.post("/api/pages/1/post", json={"message": "hello"}).status_code == 202
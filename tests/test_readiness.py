@@ -0,0 +1,38 @@
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def cold(app_env, graph, monkeypatch):
+    monkeypatch.setattr(app_env, "_WARM", dict(app_env._WARM, state="cold", steps={}, errors={}, pid=None, lock=threading.Lock()))
+    monkeypatch.setattr(app_env, "_PROBES", {"ts": 0.0, "pid": None, "deps": {}})
+    monkeypatch.setattr(app_env, "JOB_WORKERS_ENABLED", False)
+    return app_env
+
+
+def test_cold_worker_is_not_ready_until_warm(client, cold, monkeypatch):
+    warm, kicked = cold.warmup, threading.Event()
+    monkeypatch.setattr(cold, "warmup", kicked.set)
+    r = client.get("/readyz")
+    assert r.status_code == 503 and r.get_json()["ready"] is False and kicked.wait(5)
+    warm()
+    r = client.get("/readyz")
+    body = r.get_json()
+    assert r.status_code == 200 and body["ready"] and body["warm"]["state"] == "warm"
+    assert set(body["warm"]["steps_ms"]) >= {"tokens", "env_pages", "ui_assets", "db"} and body["warm"]["errors"] == {}
+
+
+def test_graph_outage_does_not_take_the_worker_out(client, cold, graph):
+    cold.warmup()
+    graph.routes[cold.GRAPH_BASE] = (502, {})
+    body = client.get("/readyz").get_json()
+    assert body["ready"] and body["deps"]["graph"]["ok"] is False and body["deps"]["sqlite"]["ok"]
+
+
+def test_probe_results_are_cached(client, cold, graph):
+    cold.warmup()
+    client.get("/readyz")
+    client.get("/readyz")
+    assert len([c for c in graph.calls if c[1] == cold.GRAPH_BASE]) == 1
+    assert client.get("/healthz").get_json()["ok"] is True
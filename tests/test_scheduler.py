@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.fixture
+def schedule(client, app_env):
+    def create(page_ids, at, message="later"):
+        r = client.post("/api/schedule", json={"type": "feed", "page_ids": page_ids, "at": at, "message": message})
+        assert r.status_code == 200, r.get_json()
+        return r.get_json()["data"]
+    return create
+
+
+def test_fires_are_spread_and_pages_kept_apart(app_env, schedule):
+    at = app_env.pytime.time() + 3600
+    items = schedule(["1", "2", "3"], at) + schedule(["1"], at, "again")
+    fires = sorted(x["fire_at"] for x in items)
+    assert all(b - a >= app_env.SCHEDULE_SPREAD_SEC for a, b in zip(fires, fires[1:]))
+    same_page = sorted(x["fire_at"] for x in items if x["page_id"] == "1")
+    assert same_page[1] - same_page[0] >= app_env.SCHEDULE_PAGE_GAP_SEC
+    assert all(x["due_at"] == at for x in items)
+
+
+def test_due_post_is_published_once(client, app_env, graph, schedule, run_jobs):
+    graph.routes["/1/feed"] = (200, {"id": "1_7"})
+    sid = schedule(["1"], app_env.pytime.time())[0]["id"]
+    app_env._fire_scheduled(sid)
+    app_env._fire_scheduled(sid)
+    run_jobs()
+    row = client.get("/api/schedule?page_id=1").get_json()["data"][0]
+    assert row["status"] == "fired" and app_env.get_job(row["job_id"])["status"] == "done"
+    assert [c[4] for c in graph.calls if c[1].endswith("/1/feed")] == ["t1"]
+
+
+def test_cancelled_or_moved_posts_do_not_fire(client, app_env, schedule):
+    now = app_env.pytime.time()
+    cancelled, moved = schedule(["1", "2"], now)
+    assert client.delete(f"/api/schedule/{cancelled['id']}").status_code == 200
+    app_env._db().execute("UPDATE scheduled_posts SET fire_at=? WHERE id=?", (now + 600, moved["id"]))
+    app_env._fire_scheduled(cancelled["id"])
+    app_env._fire_scheduled(moved["id"])
+    assert app_env._db().execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
+    assert client.delete(f"/api/schedule/{cancelled['id']}").status_code == 409
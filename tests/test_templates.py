@@ -0,0 +1,33 @@
+def test_variants_are_distinct(app_env):
+    out = app_env.expand_template("{Hi|Hello|Hey} {there|friend}", 10, seed=1)
+    assert len(out) == 6 and len(set(out)) == 6
+
+
+def test_slots_are_filled(client):
+    r = client.post("/api/templates/expand", json={"template": "Sale at {{shop}}", "slots": {"shop": ["A", "B"]}, "count": 5})
+    assert r.status_code == 200 and sorted(r.get_json()["variants"]) == ["Sale at A", "Sale at B"]
+
+
+def test_unbound_slots_are_rejected(client):
+    r = client.post("/api/templates/expand", json={"template": "{Hi|Hey} {{name}}, see {{link}} {{name}}", "slots": {"link": "x"}})
+    assert r.status_code == 400
+    assert r.get_json() == {"error": "UNBOUND_SLOTS", "missing": ["name"]}
+
+
+def test_schedule_rejects_unbound_slots(client, graph):
+    r = client.post("/api/schedule", json={"type": "feed", "page_ids": ["1"], "at": 4102444800, "message": "Hi {{name}}"})
+    assert r.status_code == 400 and r.get_json()["missing"] == ["name"]
+
+
+def test_pages_get_variants_they_have_not_used(app_env, client, graph):
+    graph.routes["/feed"] = (200, {"id": "1_1"})
+    assert client.post("/api/pages/1/post", json={"message": "Hi A"}).status_code == 202
+    variants, short = app_env.template_for_pages("Hi {A|B}", ["1", "2"])
+    assert not short and variants["1"] == "Hi B" and variants["2"] == "Hi A"
+    variants, short = app_env.template_for_pages("Hi {A|B}", ["1", "2", "3"])
+    assert len(set(variants.values())) == len(variants) and short == ["3"]
+
+
+def test_literal_group_inside_a_choice_keeps_its_braces(app_env):
+    assert sorted(app_env.expand_template("Hi {there|{x}}!", 10)) == ["Hi there!", "Hi {x}!"]
+    assert sorted(app_env.expand_template("{x {y|z}}", 10)) == ["{x y}", "{x z}"]
@@ -0,0 +1,38 @@
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def health(app_env, graph, monkeypatch):
+    """tokens.json with a soon-expiring page token (9) and an invalid one (8); debug_token verdicts per token."""
+    monkeypatch.setitem(app_env.SETTINGS, "app", {"app_id": "app", "app_secret": "s"})
+    app_env.save_tokens({"user_long": {"access_token": "u"}, "pages": {"9": "old9", "8": "bad8"}})
+    verdicts = {"old9": {"is_valid": True, "expires_at": time.time() + 86400},
+                "bad8": {"is_valid": False, "error": {"message": "Session has expired"}}}
+
+    def batch(method, url, kw):
+        ops = json.loads(kw["data"]["batch"])
+        toks = [op["relative_url"].split("input_token=")[1] for op in ops]
+        return 200, [{"code": 200, "body": json.dumps({"data": verdicts.get(t, {"is_valid": True, "expires_at": 0})})} for t in toks]
+
+    graph.routes["/v20.0/"] = batch
+    return graph
+
+
+def test_invalid_token_is_evicted_and_expiring_one_replaced(health, app_env):
+    health.routes["/me/accounts"] = (200, {"data": [{"id": "9", "access_token": "new9"}]})
+    out, st = app_env._job_token_health({})
+    assert st == 200 and out["unhealthy"] == 1 and out["expiring"] == 1
+    assert out["evicted"] == 1 and out["replaced"] == 1
+    assert app_env.load_tokens()["pages"] == {"9": "new9"}
+
+
+def test_expiring_token_is_kept_when_no_replacement(health, app_env, monkeypatch):
+    monkeypatch.setattr(app_env, "RETRY_MAX_ATTEMPTS", 1)
+    health.routes["/me/accounts"] = (500, {"error": {"message": "down"}})
+    out, _ = app_env._job_token_health({})
+    assert out["replaced"] == 0
+    assert app_env.load_tokens()["pages"] == {"9": "old9"}
+    assert app_env.token_usable("old9") and not app_env.token_usable("bad8")
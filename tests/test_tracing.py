@@ -0,0 +1,56 @@
+from collections import deque
+
+
+def _trace(client, trace_id):
+    return client.get(f"/api/debug/traces/{trace_id}").get_json()
+
+
+def test_forced_trace_records_graph_spans(client, app_env, graph, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "_traces", deque(maxlen=10))
+    graph.routes["/1/conversations"] = (200, {"data": []})
+    r = client.get("/api/pages/1/conversations", headers={"X-Trace": "1"})
+    tr = _trace(client, r.headers["X-Trace-Id"])
+    assert tr["name"] == "GET /api/pages/1/conversations" and tr["status"] == 200
+    spans = [c["name"] for c in tr["root"]["children"]]
+    assert "graph.get" in spans
+    assert next(c for c in tr["root"]["children"] if c["name"] == "graph.get")["attrs"]["status"] == 200
+
+
+def test_untraced_requests_leave_no_trace(client, app_env, graph, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "_traces", deque(maxlen=10))
+    r = client.get("/api/pages/1/conversations")
+    assert "X-Trace-Id" not in r.headers and client.get("/api/debug/traces").get_json()["data"] == []
+
+
+def test_span_error_is_recorded_and_trace_closed(app_env, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "_traces", deque(maxlen=10))
+    app_env._trace_start("job x")
+    try:
+        with app_env._trace_span("step"):
+            raise ValueError("boom")
+    except ValueError:
+        pass
+    tr = app_env._trace_finish(500)
+    assert tr["root"]["children"][0]["attrs"]["error"] == "boom" and not app_env._trace_active()
+
+
+def test_slow_traces_keep_a_profile(client, app_env, graph, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "_traces", deque(maxlen=10))
+    monkeypatch.setattr(app_env, "TRACE_PROFILE_MS", 1)
+    monkeypatch.setattr(app_env, "graph_get", lambda *a, **kw: (app_env.pytime.sleep(0.01), ({"data": []}, 200))[1])
+    r = client.get("/api/pages/1/conversations", headers={"X-Trace": "1"})
+    assert "cumulative" in _trace(client, r.headers["X-Trace-Id"])["profile"]
+    listed = client.get("/api/debug/traces?min_ms=5").get_json()["data"]
+    assert [t["has_profile"] for t in listed] == [True]
+
+
+def test_throttle_span_covers_the_wait(app_env, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "_traces", deque(maxlen=10))
+    monkeypatch.setitem(app_env.SETTINGS["throttle"], "per_page_min_interval", 0.2)
+    app_env.SETTINGS["last_call_ts"]["trace-throttle"] = app_env.pytime.time()
+    app_env._trace_start("job x")
+    app_env._wait_throttle("trace-throttle", "trace-throttle-scope", "read")
+    tr = app_env._trace_finish(200)
+    span = tr["root"]["children"][0]
+    assert span["name"] == "throttle" and span["dur_ms"] >= 150 and span["attrs"]["sleep_ms"] >= 150
+    assert span["start_ms"] < 50
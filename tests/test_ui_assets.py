@@ -0,0 +1,26 @@
+import gzip
+import re
+
+
+def test_index_links_hashed_immutable_assets(client):
+    page = client.get("/")
+    assert page.headers["Cache-Control"] == "no-cache" and "<style>" not in page.get_data(as_text=True)
+    srcs = re.findall(r'(?:href|src)="(/assets/[^"]+)"', page.get_data(as_text=True))
+    assert any(s.endswith(".css") for s in srcs) and any(s.endswith(".js") for s in srcs)
+    for src in srcs:
+        r = client.get(src)
+        assert r.status_code == 200 and r.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+
+
+def test_assets_are_served_precompressed_and_revalidate(client):
+    src = re.search(r'src="(/assets/[^"]+\.js)"', client.get("/").get_data(as_text=True)).group(1)
+    plain = client.get(src)
+    zipped = client.get(src, headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["Content-Encoding"] == "gzip" and gzip.decompress(zipped.get_data()) == plain.get_data()
+    assert zipped.headers["ETag"] != plain.headers["ETag"] and zipped.headers["Vary"] == "Accept-Encoding"
+    again = client.get(src, headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]})
+    assert again.status_code == 304 and not again.get_data()
+
+
+def test_unknown_asset_is_404(client):
+    assert client.get("/assets/app.000000000000.js").status_code == 404
@@ -0,0 +1,52 @@
+import hashlib
+import hmac
+import json
+from collections import OrderedDict
+
+import pytest
+
+
+@pytest.fixture
+def hook(client, app_env, monkeypatch):
+    monkeypatch.setitem(app_env.SETTINGS, "app", {"app_id": "a", "app_secret": "sekret"})
+    monkeypatch.setattr(app_env, "_WEBHOOK_SEEN", OrderedDict())
+
+    def post(body, secret="sekret"):
+        raw = json.dumps(body).encode()
+        sig = "sha256=" + hmac.new(secret.encode(), raw, hashlib.sha256).hexdigest()
+        return client.post("/webhook", data=raw, headers={"X-Hub-Signature-256": sig, "Content-Type": "application/json"})
+    return post
+
+
+def _entry(*mids):
+    return {"object": "page", "entry": [{"id": "1", "time": 1, "messaging": [
+        {"sender": {"id": "u"}, "recipient": {"id": "1"}, "timestamp": 1, "message": {"mid": m, "text": m}} for m in mids]}]}
+
+
+def _logged(A):
+    return [m["message"]["mid"] for r in A.event_log_read(0, 100)[0] for m in r["data"].get("messaging", [])]
+
+
+def test_bad_or_missing_signature_is_refused(client, app_env, hook):
+    assert hook(_entry("m1"), secret="wrong").status_code == 403
+    assert client.post("/webhook", json=_entry("m1")).status_code == 403
+    assert _logged(app_env) == []
+
+
+def test_pool_app_secrets_are_accepted(app_env, hook, monkeypatch):
+    monkeypatch.setitem(app_env._APPS, "b", {"app_secret": "other"})
+    assert hook(_entry("m1"), secret="other").status_code == 200
+
+
+def test_redelivery_is_dropped_and_new_events_kept(app_env, hook):
+    assert hook(_entry("m1", "m2")).status_code == 200
+    assert hook(_entry("m1", "m2")).status_code == 200
+    assert hook(_entry("m2", "m3")).status_code == 200
+    assert _logged(app_env) == ["m1", "m2", "m3"]
+
+
+def test_seen_keys_expire(app_env, hook, monkeypatch):
+    hook(_entry("m1"))
+    monkeypatch.setattr(app_env, "WEBHOOK_DEDUPE_TTL_SEC", -1)
+    hook(_entry("m1"))
+    assert _logged(app_env) == ["m1", "m1"]